@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import re
 import numpy as np
 import random
 from typing import List, Tuple, Dict
@@ -9,6 +8,7 @@ import sys
 import logging
 from numba import jit, njit, prange
 import os
+from local_search import neighbour_lists, local_search
 
 logger = logging.getLogger()
 
@@ -171,12 +171,94 @@ def construct_single_solution_numba(distances, pheromones, heuristic, n_cities,
     total_distance += distances[current_city, path[0]]
     return path, total_distance
 
+@njit(nogil=True, parallel=True)
+def construct_solutions_candidates_numba(distances, pheromones, heuristic, candidates, n_cities, alpha, beta, n_ants, seeds, start_city=0):
+    """Batch solution construction where each ant only considers the current city's nearest candidates,
+    falling back to scanning every unvisited city once those are all visited"""
+    all_paths = np.empty((n_ants, n_cities), dtype=np.int32)
+    all_distances = np.empty(n_ants, dtype=np.float64)
+    n_candidates = candidates.shape[1]
+
+    for ant_idx in prange(n_ants):
+        np.random.seed(seeds[ant_idx])
+
+        current_city = start_city
+        all_paths[ant_idx, 0] = current_city
+        unvisited = np.ones(n_cities, dtype=np.bool_)
+        unvisited[current_city] = False
+        probabilities = np.empty(max(n_candidates, n_cities), dtype=np.float64)
+        choices = np.empty(max(n_candidates, n_cities), dtype=np.int32)
+        total_distance = 0.0
+
+        for step in range(1, n_cities):
+            # unvisited candidates of the current city
+            n_choices = 0
+            for i in range(n_candidates):
+                city = candidates[current_city, i]
+                if unvisited[city]:
+                    choices[n_choices] = city
+                    n_choices += 1
+
+            # ...or every unvisited city, if they've all been visited
+            if n_choices == 0:
+                for city in range(n_cities):
+                    if unvisited[city]:
+                        choices[n_choices] = city
+                        n_choices += 1
+
+            total_prob = 0.0
+            for i in range(n_choices):
+                city = choices[i]
+                probabilities[i] = pheromones[current_city, city] ** alpha * heuristic[current_city, city] ** beta
+                total_prob += probabilities[i]
+
+            # Roulette wheel selection (uniform if every choice has zero probability)
+            next_city_idx = n_choices - 1
+            if total_prob > 0:
+                r = np.random.random() * total_prob
+                cumulative = 0.0
+                for i in range(n_choices):
+                    cumulative += probabilities[i]
+                    if r <= cumulative:
+                        next_city_idx = i
+                        break
+            else:
+                next_city_idx = np.random.randint(n_choices)
+
+            next_city = choices[next_city_idx]
+            total_distance += distances[current_city, next_city]
+            all_paths[ant_idx, step] = next_city
+            unvisited[next_city] = False
+            current_city = next_city
+
+        total_distance += distances[current_city, all_paths[ant_idx, 0]]
+        all_distances[ant_idx] = total_distance
+
+    return all_paths, all_distances
+
+@njit(nogil=True)
+def deposit_pheromones_numba(pheromones, all_paths, all_distances, q, symmetric):
+    """Deposit q / distance along every edge of every ant's (closed) path"""
+    n_ants, n_cities = all_paths.shape
+    for ant_idx in range(n_ants):
+        if all_distances[ant_idx] <= 0:
+            continue
+        deposit = q / all_distances[ant_idx]
+        for step in range(n_cities):
+            from_city = all_paths[ant_idx, step]
+            to_city = all_paths[ant_idx, (step + 1) % n_cities]
+            pheromones[from_city, to_city] += deposit
+            if symmetric:
+                pheromones[to_city, from_city] += deposit
+
 class FastAntColonyTSP:
     def __init__(self, distance_matrix: np.ndarray, n_ants: int = None, 
                  n_iterations: int = 100, alpha: float = 1.0, beta: float = 2.0,
                  evaporation_rate: float = 0.5, q: float = 100, 
                  use_sparse: bool = True, batch_size: int = None, 
-                 symmetric: bool = True, start_city: int = 0):
+                 symmetric: bool = True, start_city: int = 0, n_candidates: int = 16,
+                 mmas: bool = False, mmas_deposit: str = 'iteration', p_best: float = 0.05,
+                 stagnation: int = 20, local_search_time: float = None):
         """
         Optimized Ant Colony Optimization for TSP with parallel batch processing
         
@@ -192,8 +274,18 @@ class FastAntColonyTSP:
             batch_size: Process ants in batches of this size (None = all at once)
             symmetric: True for undirected graphs, False for directed (asymmetric TSP)
             start_city: City index to always start tours from (default: 0)
+            n_candidates: Only consider each city's n_candidates nearest neighbours when choosing the next
+                city, unless they've all been visited (None = always consider every unvisited city)
+            mmas: Use MAX-MIN Ant System: only one ant deposits each iteration, pheromones are clamped to
+                [tau_min, tau_max], and they're reset to tau_max when the search stagnates
+            mmas_deposit: Which ant deposits in MMAS mode: 'iteration' (iteration-best) or 'best' (best-so-far)
+            p_best: MMAS's estimated probability of constructing the best tour once converged, which sets
+                tau_min relative to tau_max
+            stagnation: Reset the MMAS pheromones after this many iterations without improvement
+            local_search_time: If set, improve each iteration's best tour with local_search.py for up to this
+                many seconds before depositing pheromones
         """
-        self.distances = distance_matrix.astype(np.float64)
+        self.distances = np.asarray(distance_matrix, dtype=np.float64) # N.B. not a copy if it's already float64, e.g. in shared memory
         self.n_cities = len(distance_matrix)
         
         # For large problems, use fewer ants
@@ -234,6 +326,12 @@ class FastAntColonyTSP:
         finite_mask = np.isfinite(self.distances) & (self.distances > 0)
         self.heuristic[finite_mask] = 1.0 / self.distances[finite_mask]
         
+        # Candidate lists: each city's nearest successors, nearest first
+        if n_candidates and n_candidates < self.n_cities - 1:
+            self.candidates = neighbour_lists(self.distances, n_candidates)[0]
+        else:
+            self.candidates = None
+
         # For sparse graphs
         if use_sparse:
             large_value = 128 # np.percentile(self.distances[finite_mask], 95) if np.any(finite_mask) else 1e6
@@ -242,22 +340,42 @@ class FastAntColonyTSP:
         else:
             self.valid_connections = None
         
+        if mmas_deposit not in ('iteration', 'best'):
+            raise ValueError(f"mmas_deposit must be 'iteration' or 'best', got {mmas_deposit}")
+        self.mmas = mmas
+        self.mmas_deposit = mmas_deposit
+        self.p_best = p_best
+        self.stagnation = stagnation
+        self.tau_min = 0.0
+        self.tau_max = np.inf
+        self.local_search_time = local_search_time
+        if local_search_time:
+            self.ls_candidates = neighbour_lists(self.distances)
+
         self.best_path = None
         self.best_distance = float('inf')
+        self.no_improvement = 0
         self.convergence_data = []
         
         logger.info(f"Initialized ACO with {self.n_ants} ants for {self.n_cities} cities")
         logger.info(f"Starting city: {self.start_city}")
         logger.info(f"Graph type: {'Symmetric (undirected)' if self.symmetric else 'Asymmetric (directed)'}")
         logger.info(f"Using batch size: {self.batch_size} (numba parallel processing)")
+        if self.candidates is not None:
+            logger.info(f"Using candidate lists of the {self.candidates.shape[1]} nearest cities")
+        if self.mmas:
+            logger.info(f"Using MAX-MIN Ant System ({self.mmas_deposit}-best deposit, p_best {self.p_best}, reset after {self.stagnation} stagnant iterations)")
+        if self.local_search_time:
+            logger.info(f"Improving each iteration's best tour with up to {self.local_search_time}s of local search")
         if use_sparse and hasattr(self, 'valid_connections'):
             density = np.mean(self.valid_connections)
             logger.info(f"Graph density: {density:.3f} ({np.sum(self.valid_connections)} valid edges)")
     
-    def _construct_solutions_batch(self) -> Tuple[List[List[int]], List[float]]:
-        """Construct solutions using numba parallel batch processing"""
-        all_paths = []
-        all_distances = []
+    def _construct_solutions_batch(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Construct solutions using numba parallel batch processing, returning (n_ants, n_cities) paths and
+        their distances"""
+        all_paths = np.empty((self.n_ants, self.n_cities), dtype=np.int32)
+        all_distances = np.empty(self.n_ants, dtype=np.float64)
         
         # Process ants in batches
         for start_idx in range(0, self.n_ants, self.batch_size):
@@ -268,15 +386,19 @@ class FastAntColonyTSP:
             seeds = np.random.randint(0, 2**31, size=batch_size)
             
             # Process batch in parallel
-            batch_paths, batch_distances = construct_solutions_batch_numba(
-                self.distances, self.pheromones, self.heuristic, 
-                self.n_cities, self.alpha, self.beta, batch_size, seeds, self.start_city
-            )
+            if self.candidates is not None:
+                batch_paths, batch_distances = construct_solutions_candidates_numba(
+                    self.distances, self.pheromones, self.heuristic, self.candidates,
+                    self.n_cities, self.alpha, self.beta, batch_size, seeds, self.start_city
+                )
+            else:
+                batch_paths, batch_distances = construct_solutions_batch_numba(
+                    self.distances, self.pheromones, self.heuristic, 
+                    self.n_cities, self.alpha, self.beta, batch_size, seeds, self.start_city
+                )
             
-            # Convert to lists and append
-            for i in range(batch_size):
-                all_paths.append(batch_paths[i].tolist())
-                all_distances.append(float(batch_distances[i]))
+            all_paths[start_idx:end_idx] = batch_paths
+            all_distances[start_idx:end_idx] = batch_distances
         
         return all_paths, all_distances
     
@@ -289,30 +411,64 @@ class FastAntColonyTSP:
         )
         return path_array.tolist(), float(distance)
     
-    def _update_pheromones_vectorized(self, all_paths: List[List[int]], all_distances: List[float]):
+    def _update_pheromones_vectorized(self, all_paths: np.ndarray, all_distances: np.ndarray):
         """Vectorized pheromone update - handles both symmetric and asymmetric cases"""
         # Evaporation
         self.pheromones *= (1 - self.evaporation_rate)
         
-        # Batch deposit pheromones
-        for path, distance in zip(all_paths, all_distances):
-            if distance > 0:
-                pheromone_deposit = self.q / distance
-                path_array = np.array(path)
-                from_cities = path_array
-                to_cities = np.roll(path_array, -1)
-                
-                # Always update the direction traveled
-                self.pheromones[from_cities, to_cities] += pheromone_deposit
-                
-                # For symmetric graphs, also update reverse direction
-                if self.symmetric:
-                    self.pheromones[to_cities, from_cities] += pheromone_deposit
+        # Deposit pheromones for every ant in one go
+        deposit_pheromones_numba(self.pheromones, all_paths, all_distances, self.q, self.symmetric)
     
-    def solve(self, verbose: bool = True, early_stopping: int = 50) -> Tuple[List[int], float]:
-        """Solve TSP using optimized batch ACO"""
+    def _improve(self, path: np.ndarray, deadline: float = None) -> Tuple[np.ndarray, float]:
+        """Improve a tour with local search, keeping it starting at start_city"""
+        limit = time.time() + self.local_search_time
+        if deadline is not None:
+            limit = min(limit, deadline)
+        path = local_search(self.distances, path, limit, candidates=self.ls_candidates, verbose=False)
+        path = np.roll(path, -int(np.flatnonzero(path == self.start_city)[0]))
+        return path, float(self.distances[path, np.roll(path, -1)].sum())
+
+    def _update_mmas_bounds(self):
+        """tau_max = q / (rho * best distance), and tau_min such that, once converged, an ant picks the
+        best tour with probability p_best (as per Stützle & Hoos' MAX-MIN Ant System)"""
+        self.tau_max = self.q / (self.evaporation_rate * max(self.best_distance, 1))
+        choices = self.candidates.shape[1] if self.candidates is not None else self.n_cities
+        p_dec = self.p_best ** (1 / self.n_cities)
+        self.tau_min = min(self.tau_max, self.tau_max * (1 - p_dec) / (max(1, choices / 2 - 1) * p_dec))
+
+    def _reset_mmas_pheromones(self):
+        self.pheromones.fill(self.tau_max)
+
+    def _update_pheromones_mmas(self, path: np.ndarray, distance: float):
+        """MMAS pheromone update: evaporate, deposit along a single tour, and clamp to [tau_min, tau_max]"""
+        self.pheromones *= (1 - self.evaporation_rate)
+        deposit_pheromones_numba(self.pheromones, path[np.newaxis, :], np.array([distance]), self.q, self.symmetric)
+        np.clip(self.pheromones, self.tau_min, self.tau_max, out=self.pheromones)
+
+    def adopt(self, path: List[int], distance: float):
+        """Take on a (better) tour found elsewhere, e.g. by another island, as our best so far, and
+        reinforce it with pheromones"""
+        if distance >= self.best_distance:
+            return
+        path = np.asarray(path, dtype=np.int32)
+        self.best_path = path.tolist()
+        self.best_distance = float(distance)
+        self.no_improvement = 0
+        if self.mmas:
+            self._update_mmas_bounds()
+            self._update_pheromones_mmas(path, self.best_distance)
+        else:
+            deposit_pheromones_numba(self.pheromones, path[np.newaxis, :], np.array([self.best_distance]), self.q, self.symmetric)
+
+    def solve(self, verbose: bool = True, early_stopping: int = 50, deadline: float = None,
+              n_iterations: int = None) -> Tuple[List[int], float]:
+        """Solve TSP using optimized batch ACO, stopping early at the given time.time() deadline if any.
+        Can be called repeatedly to carry on where it left off, for n_iterations (default: self.n_iterations)
+        more iterations each time."""
         start_time = time.time()
-        no_improvement = 0
+        first_iteration = len(self.convergence_data)
+        if n_iterations is None:
+            n_iterations = self.n_iterations
         
         # Warm up numba compilation
         if verbose:
@@ -320,7 +476,7 @@ class FastAntColonyTSP:
             _ = self._construct_solution_single()
             logger.info("Compilation complete, starting optimization...")
         
-        for iteration in range(self.n_iterations):
+        for iteration in range(first_iteration, first_iteration + n_iterations):
             iteration_start = time.time()
             
             # Construct solutions in batches
@@ -328,17 +484,37 @@ class FastAntColonyTSP:
             
             # Update best solution
             iteration_best_idx = np.argmin(all_distances)
-            iteration_best_distance = all_distances[iteration_best_idx]
+            iteration_best_path = all_paths[iteration_best_idx]
+            iteration_best_distance = float(all_distances[iteration_best_idx])
+            if self.local_search_time:
+                iteration_best_path, iteration_best_distance = self._improve(iteration_best_path, deadline)
+                all_paths[iteration_best_idx] = iteration_best_path
+                all_distances[iteration_best_idx] = iteration_best_distance
             
             if iteration_best_distance < self.best_distance:
+                first = self.best_path is None
                 self.best_distance = iteration_best_distance
-                self.best_path = all_paths[iteration_best_idx].copy()
-                no_improvement = 0
+                self.best_path = iteration_best_path.tolist()
+                self.no_improvement = 0
+                if self.mmas:
+                    self._update_mmas_bounds()
+                    if first:
+                        self._reset_mmas_pheromones()
             else:
-                no_improvement += 1
+                self.no_improvement += 1
             
             # Update pheromones
-            self._update_pheromones_vectorized(all_paths, all_distances)
+            if self.mmas:
+                if self.mmas_deposit == 'best':
+                    self._update_pheromones_mmas(np.array(self.best_path, dtype=np.int32), self.best_distance)
+                else:
+                    self._update_pheromones_mmas(iteration_best_path, iteration_best_distance)
+                if self.stagnation and self.no_improvement > 0 and self.no_improvement % self.stagnation == 0:
+                    if verbose:
+                        logger.info(f"Stagnated for {self.no_improvement} iterations; resetting pheromones")
+                    self._reset_mmas_pheromones()
+            else:
+                self._update_pheromones_vectorized(all_paths, all_distances)
             
             # Record convergence
             avg_distance = np.mean(all_distances)
@@ -358,25 +534,23 @@ class FastAntColonyTSP:
                       f"Speed = {ants_per_sec:.1f} ants/sec (batch parallel)")
             
             # Early stopping
-            if early_stopping > 0 and no_improvement >= early_stopping:
+            if early_stopping > 0 and self.no_improvement >= early_stopping:
                 if verbose:
                     logger.info(f"Early stopping at iteration {iteration + 1}")
                 break
+
+            if deadline is not None and time.time() >= deadline:
+                if verbose:
+                    logger.info(f"Out of time at iteration {iteration + 1}")
+                break
         
         return self.best_path, self.best_distance
 
 if __name__ == "__main__":
-    distances = None
-    n = 0
-
-    f = open("hq-matrix2")
-    for j, line in enumerate(f.readlines()):
-        row = re.sub(r'^.*\|', '', line).split()
-        if distances is None:
-            n = len(row)
-            distances = np.zeros((n, n), dtype=int)
-        distances[j] = row
-    f.close()
+    # as saved by calc_segmented_tsp.py: the segments' distance matrix, and their (start_sg_id, end_sg_id)
+    distances = np.load("hq-matrix.npy", mmap_mode='r')
+    segs = np.load("hq-segs.npy", mmap_mode='r')
+    n = len(distances)
 
     # Initialize ACO solver
     aco = FastAntColonyTSP(
@@ -412,34 +586,24 @@ if __name__ == "__main__":
         logger.fatal(f"observerd distance {total_dist} doesn't match {best_distance}")
         sys.exit(1)
 
-    # set the new ordering
-    segments = [None] * n
-    f = open("hq-segs2")
-    for j, line in enumerate(f.readlines()):
-        match = re.match(r'.*segment #(.*?) (\d+) -> (\d+)', line)
-        seg_id = int(match[1])
-        start_sg_id = int(match[2])
-        end_sg_id = int(match[3])
-        ordering = best_path.index(seg_id)
-        segments[seg_id] = [ start_sg_id, end_sg_id, ordering ]
-        logger.info(f"segment #{seg_id} { [ start_sg_id, end_sg_id, ordering ] }")
-    f.close()
+    # set the new ordering
+    orderings = np.empty(n, dtype=np.int64)
+    orderings[best_path] = np.arange(n)
+    segments = [ [ int(segs[seg_id][0]), int(segs[seg_id][1]), int(orderings[seg_id]) ] for seg_id in range(n) ]
+    for seg_id in range(n):
+        logger.info(f"segment #{seg_id} { segments[seg_id] }")
 
     import psycopg2
-    from psycopg2.extras import execute_values
+    from ordering import write_ordering
     conn = psycopg2.connect("dbname=test") #, cursor_factory=LoggingCursor)
     conn.set_session(autocommit=True)
     cursor = conn.cursor()
-    execute_values(
-        cursor,
-        """
-        UPDATE minhashes SET ordering = data.ordering
-        FROM (VALUES %s) AS data(start_sg_id, end_sg_id, ordering)
-        WHERE minhashes.sg_id >= data.start_sg_id
-        AND minhashes.sg_id <= data.end_sg_id
-        AND room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
-        """,
-        segments,
-        template=None,
-        page_size=1000
-    )
+
+    # each SG gets its own gapped label (see ordering.py), in the order of its segment in the tour
+    cursor.execute("SELECT sg_id FROM minhashes WHERE room_id = '!OGEhHVWSdvArJzumhm:matrix.org' ORDER BY sg_id")
+    sg_ids = np.array([ row[0] for row in cursor.fetchall() ], dtype=np.int64)
+    ordered_ids = []
+    for seg_id in best_path:
+        (start, end) = (int(segs[seg_id][0]), int(segs[seg_id][1]))
+        ordered_ids.extend(sg_ids[np.searchsorted(sg_ids, start):np.searchsorted(sg_ids, end, side='right')].tolist())
+    write_ordering(cursor, ordered_ids)
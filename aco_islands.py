@@ -0,0 +1,142 @@
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+# Island-model ACO: several independent FastAntColonyTSP colonies (aco.py), each in its own process
+# with its own seed (and optionally its own parameters), which periodically share their best tours.
+#
+# aco.py only parallelises within a colony (via prange over the ants), so more cores just mean more
+# ants per iteration. Independent colonies explore different parts of the search space instead, and
+# migrating the best tour between them every `migration_interval` iterations stops the laggards from
+# wasting their time.
+#
+# The distance matrix lives in a single multiprocessing.shared_memory block which every island maps,
+# rather than being copied into each process (FastAntColonyTSP doesn't copy float64 matrices). The
+# islands' best tours live in a second block: a (n_islands, N) array of tours plus their lengths,
+# which each island writes its own row of, and reads everyone's rows from, under a lock.
+#
+# The islands are started from a forkserver rather than forked: once a numba parallel kernel has run (e.g.
+# local_search.py's, which aco_islands_tour runs after the islands are done) TBB's worker threads stop a
+# forked parent from ever exiting. The islands only need the shared memory blocks' names, but the
+# caller's main module has to be safe to import (i.e. have a __main__ guard), as each island re-imports
+# it. The forkserver preloads aco.py, so the islands don't each have to import numba.
+#
+# Each island reports its convergence (best length every iteration, and when it last improved) back
+# to the parent at the end, which logs them.
+
+logger = logging.getLogger()
+
+def _run_island(island, n_islands, shms, n, params, n_iterations, migration_interval, deadline, lock):
+    from aco import FastAntColonyTSP
+
+    (dist_shm, tours_shm, lengths_shm) = shms
+    distances = np.ndarray((n, n), dtype=np.float64, buffer=dist_shm.buf)
+    tours = np.ndarray((n_islands, n), dtype=np.int32, buffer=tours_shm.buf)
+    lengths = np.ndarray(n_islands, dtype=np.float64, buffer=lengths_shm.buf)
+
+    colony = FastAntColonyTSP(distance_matrix=distances, **params)
+    migrations = 0
+    done = 0
+    while done < n_iterations and (deadline is None or time.time() < deadline):
+        iterations = min(migration_interval, n_iterations - done)
+        colony.solve(verbose=False, early_stopping=0, deadline=deadline, n_iterations=iterations)
+        done = len(colony.convergence_data)
+
+        # publish our best tour, and adopt the best of everyone's if it's better
+        with lock:
+            if colony.best_distance < lengths[island]:
+                tours[island] = colony.best_path
+                lengths[island] = colony.best_distance
+            best = int(np.argmin(lengths))
+            (best_tour, best_length) = (tours[best].copy(), float(lengths[best]))
+        if best != island and best_length < colony.best_distance:
+            colony.adopt(best_tour, best_length)
+            migrations += 1
+
+    return {
+        'island': island,
+        'path': colony.best_path,
+        'distance': colony.best_distance,
+        'iterations': done,
+        'migrations': migrations,
+        'convergence': [ c['best_distance'] for c in colony.convergence_data ],
+    }
+
+def _island(island, n_islands, shm_names, n, params, seed, n_iterations, migration_interval, deadline, lock, results):
+    from numba import set_num_threads
+
+    # share the cores out between the islands, rather than every island's prange using all of them
+    set_num_threads(max(1, (os.cpu_count() or 1) // n_islands))
+    np.random.seed(seed)
+
+    shms = [ shared_memory.SharedMemory(name=name) for name in shm_names ]
+    try:
+        # N.B. the colony (and its views of the shared memory) must be gone before we can close it
+        results.put(_run_island(island, n_islands, shms, n, params, n_iterations, migration_interval, deadline, lock))
+    finally:
+        for shm in shms:
+            shm.close()
+
+def solve_islands(distances, n_islands=None, n_iterations=100, migration_interval=10, seed=0,
+                  island_params=None, deadline=None, **params):
+    """Solve a TSP with n_islands FastAntColonyTSP colonies in separate processes, sharing their best tours
+    every migration_interval iterations. params are passed to every colony, overridden by island_params[i]
+    (if given) for island i. Returns the best (path, distance) found, and each island's report."""
+    n = len(distances)
+    if n_islands is None:
+        n_islands = len(island_params) if island_params else min(4, os.cpu_count() or 1)
+    island_params = island_params or [{}] * n_islands
+
+    dist_shm = shared_memory.SharedMemory(create=True, size=n * n * 8)
+    tours_shm = shared_memory.SharedMemory(create=True, size=max(1, n_islands * n * 4))
+    lengths_shm = shared_memory.SharedMemory(create=True, size=n_islands * 8)
+    shms = (dist_shm, tours_shm, lengths_shm)
+    try:
+        np.ndarray((n, n), dtype=np.float64, buffer=dist_shm.buf)[:] = distances
+        np.ndarray(n_islands, dtype=np.float64, buffer=lengths_shm.buf)[:] = np.inf
+
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['aco_islands', 'aco'])
+        lock = ctx.Lock()
+        results = ctx.Queue()
+        processes = []
+        for island in range(n_islands):
+            process = ctx.Process(target=_island, args=(
+                island, n_islands, [ shm.name for shm in shms ], n, { **params, **island_params[island] },
+                seed + island, n_iterations, migration_interval, deadline, lock, results,
+            ))
+            process.start()
+            processes.append(process)
+
+        # drain the results before joining, as a process can't exit until its queued results are read
+        reports = []
+        while len(reports) < n_islands:
+            try:
+                reports.append(results.get(timeout=1))
+            except queue.Empty:
+                if not any(p.is_alive() for p in processes):
+                    break
+        for process in processes:
+            process.join()
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    if not reports:
+        raise RuntimeError("no ACO islands finished")
+    reports.sort(key=lambda r: r['island'])
+    for r in reports:
+        convergence = r['convergence']
+        last_improved = next((i for i in range(len(convergence) - 1, 0, -1) if convergence[i] < convergence[i - 1]), 0)
+        logger.info(
+            f"island {r['island']}: best {r['distance']:.0f} after {r['iterations']} iterations "
+            f"(first {convergence[0] if convergence else float('inf'):.0f}, last improved at iteration {last_improved + 1}, "
+            f"{r['migrations']} migrations in)"
+        )
+    best = min(reports, key=lambda r: r['distance'])
+    return (best['path'], best['distance']), reports
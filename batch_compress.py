@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import psycopg2
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import sys
+import time
+import traceback
+
+# Compresses every room (or the given ones) with calc_pipeline.py, across a pool of worker processes.
+#
+# Rooms range from a handful of SGs to HQ's 82K SGs and 16.9M state rows, so we estimate each room's peak
+# RAM from its SG and state row counts, and bin-pack the rooms into batches against a per-worker share of
+# the memory budget (first-fit decreasing): big rooms end up in a batch of their own, and small ones get
+# batched together so we don't pay for a process per room. Batches are then handed out biggest first,
+# as long as the estimates of the batches in flight fit in the memory budget: when the biggest waiting
+# batch doesn't fit, the biggest one that does goes instead. Each batch runs in a fresh
+# process (max_tasks_per_child=1), so a big room's RAM is given back once it's done.
+#
+# N.B. the workers come from a ProcessPoolExecutor rather than a multiprocessing.Pool: they aren't daemonic,
+# so the TSP solvers can start processes of their own (elkai under a time budget, hybrid, aco_islands), and
+# a worker getting killed (e.g. by the OOM killer) surfaces as a BrokenProcessPool rather than a hang. When
+# that happens, the rooms which were being compressed get marked as failed, the ones which hadn't started
+# yet get requeued, and we carry on with a fresh pool. The workers are started from a forkserver (which
+# max_tasks_per_child needs), with calc_pipeline preloaded.
+#
+# Progress is tracked per room in a compress_progress table, so the run can be interrupted and resumed:
+# rooms which are already done get skipped (unless --redo), and rooms which failed get retried.
+#
+# CREATE TABLE compress_progress (
+#   room_id text primary key,
+#   status text not null, -- 'running', 'done' or 'failed'
+#   sgs bigint,
+#   state_rows bigint,
+#   seconds float,
+#   error text,
+#   updated_at timestamptz not null default now()
+# );
+#
+# Usage: batch_compress.py [--redo] [room_id ...]
+
+DB_CONFIG = {
+    'database': 'test',
+}
+
+logger = logging.getLogger()
+
+workers = os.cpu_count()
+memory_budget = 32 * 1024 * 1024 * 1024 # bytes, across all the workers
+
+# rough peak RAM per room for calc_pipeline.py: the interned deltas (and their symbols) per state row,
+# plus the signatures and cached state chunks per SG, plus a fixed overhead per process.
+bytes_per_state_row = 120
+bytes_per_sg = 8 * 1024
+bytes_per_room = 64 * 1024 * 1024
+
+def estimate_bytes(sgs, state_rows):
+    return bytes_per_room + bytes_per_sg * sgs + bytes_per_state_row * state_rows
+
+def list_rooms(cursor, room_ids=None):
+    """Returns [ (room_id, sgs, state_rows) ] for every room in state_groups (or just the given ones)"""
+    logger.info("counting SGs and state rows per room")
+    where = "WHERE room_id = ANY(%s)" if room_ids else ""
+    args = [list(room_ids)] if room_ids else []
+    cursor.execute(f"SELECT room_id, count(*) FROM state_groups {where} GROUP BY room_id", args)
+    sgs = dict(cursor.fetchall())
+    cursor.execute(f"SELECT room_id, count(*) FROM state_groups_state {where} GROUP BY room_id", args)
+    state_rows = dict(cursor.fetchall())
+    return [ (room_id, sgs[room_id], state_rows.get(room_id, 0)) for room_id in sorted(sgs) ]
+
+def pack_batches(rooms, capacity):
+    """First-fit decreasing bin-packing of [ (room_id, estimated_bytes) ] into batches of no more than
+    capacity bytes each (bar rooms which are bigger than that on their own). Returns [ (bytes, [ room_ids ]) ]
+    biggest first."""
+    batches = []
+    for (room_id, size) in sorted(rooms, key=lambda r: -r[1]):
+        for batch in batches:
+            if batch[0] + size <= capacity:
+                batch[0] += size
+                batch[1].append(room_id)
+                break
+        else:
+            batches.append([size, [room_id]])
+    return [ (size, room_ids) for (size, room_ids) in batches ]
+
+def set_progress(cursor, room_id, status, summary=None, error=None):
+    summary = summary or {}
+    cursor.execute("""
+        INSERT INTO compress_progress (room_id, status, sgs, state_rows, seconds, error, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, now())
+        ON CONFLICT (room_id) DO UPDATE SET
+            status = excluded.status, sgs = excluded.sgs, state_rows = excluded.state_rows,
+            seconds = excluded.seconds, error = excluded.error, updated_at = excluded.updated_at
+    """, [room_id, status, summary.get('sgs'), summary.get('state_rows'), summary.get('seconds'), error])
+
+def compress_batch(room_ids):
+    """Runs in a worker process: compresses each room in turn, recording its progress"""
+    from calc_pipeline import compress_room
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.set_session(autocommit=True)
+    cursor = conn.cursor()
+    results = []
+    try:
+        for room_id in room_ids:
+            set_progress(cursor, room_id, 'running')
+            try:
+                summary = compress_room(room_id)
+                set_progress(cursor, room_id, 'done', summary)
+                results.append((room_id, 'done', summary))
+            except Exception:
+                error = traceback.format_exc()
+                logger.error(f"failed to compress {room_id}: {error}")
+                set_progress(cursor, room_id, 'failed', error=error)
+                results.append((room_id, 'failed', None))
+    finally:
+        conn.close()
+    return results
+
+def _init_worker(level):
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=level,
+        format='%(asctime)s.%(msecs)03d - %(processName)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+def _new_executor():
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['calc_pipeline'])
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=ctx, max_tasks_per_child=1,
+        initializer=_init_worker, initargs=(logger.getEffectiveLevel(),),
+    )
+
+def run(room_ids=None, redo=False):
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.set_session(autocommit=True)
+    cursor = conn.cursor()
+
+    rooms = list_rooms(cursor, room_ids)
+    if not redo:
+        cursor.execute("SELECT room_id FROM compress_progress WHERE status = 'done'")
+        done = { row[0] for row in cursor.fetchall() }
+        skipped = [ r for r in rooms if r[0] in done ]
+        rooms = [ r for r in rooms if r[0] not in done ]
+        if skipped:
+            logger.info(f"skipping {len(skipped)} rooms which are already done")
+
+    counts = { room_id: (sgs, state_rows) for (room_id, sgs, state_rows) in rooms }
+    estimates = { room_id: estimate_bytes(sgs, state_rows) for (room_id, sgs, state_rows) in rooms }
+    batches = pack_batches(list(estimates.items()), memory_budget // workers)
+    total_sgs = sum(sgs for (sgs, _) in counts.values())
+    logger.info(f"compressing {len(rooms)} rooms ({total_sgs} SGs) in {len(batches)} batches across {workers} workers")
+    for (size, batch) in batches:
+        if size > memory_budget:
+            logger.warning(f"{batch} is estimated to need {size / 2**30:.1f}GB, over the whole memory budget")
+
+    cursor.execute("SELECT now()")
+    [started_at] = cursor.fetchone()
+    start = time.time()
+    done_rooms = 0
+    done_sgs = 0
+    failed = []
+
+    def finished(room_id, status, summary):
+        nonlocal done_rooms, done_sgs
+        done_rooms += 1
+        done_sgs += counts[room_id][0]
+        if status == 'failed':
+            failed.append(room_id)
+        elapsed = time.time() - start
+        logger.info(
+            f"[{done_rooms}/{len(rooms)} rooms, {done_sgs * 100 / max(1, total_sgs):.1f}% of SGs, {elapsed:.0f}s] "
+            f"{room_id}: {status}" + (f", {summary['sgs']} SGs -> {summary['state_rows']} state rows in {summary['seconds']:.1f}s" if summary else "")
+        )
+
+    executor = _new_executor()
+    try:
+        pending = list(batches)
+        in_flight = {} # { Future: (bytes, [ room_ids ]) }
+        while pending or in_flight:
+            # start as many batches as fit in the memory budget (but always at least one), biggest first. A batch
+            # which doesn't fit in what's left of the budget doesn't hold up any smaller ones which do.
+            in_flight_bytes = sum(size for (size, _) in in_flight.values())
+            while pending and len(in_flight) < workers:
+                fits = [ i for (i, (size, _)) in enumerate(pending) if not in_flight or in_flight_bytes + size <= memory_budget ]
+                if not fits:
+                    break
+                (size, batch) = pending.pop(max(fits, key=lambda i: pending[i][0]))
+                in_flight[executor.submit(compress_batch, batch)] = (size, batch)
+                in_flight_bytes += size
+
+            (ready, _) = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = []
+            for future in ready:
+                (size, batch) = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    broken.append(batch)
+                    continue
+                for (room_id, status, summary) in results:
+                    finished(room_id, status, summary)
+
+            if broken:
+                # a worker died, which takes every batch in flight down with it
+                logger.warning("a worker process died; restarting the pool")
+                executor.shutdown(wait=True, cancel_futures=True)
+                broken.extend(batch for (_, batch) in in_flight.values())
+                in_flight = {}
+                for batch in broken:
+                    # N.B. only trust progress from this run: a room might have failed last time round
+                    cursor.execute("""
+                        SELECT room_id, status FROM compress_progress WHERE room_id = ANY(%s) AND updated_at >= %s
+                    """, [batch, started_at])
+                    statuses = dict(cursor.fetchall())
+                    requeue = []
+                    for room_id in batch:
+                        status = statuses.get(room_id)
+                        if status == 'running':
+                            set_progress(cursor, room_id, 'failed', error="worker process died")
+                            finished(room_id, 'failed', None)
+                        elif status in ('done', 'failed'):
+                            finished(room_id, status, None)
+                        else:
+                            requeue.append(room_id)
+                    if requeue:
+                        pending.insert(0, (sum(estimates[room_id] for room_id in requeue), requeue))
+                executor = _new_executor()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        conn.close()
+
+    if failed:
+        logger.warning(f"{len(failed)} rooms failed (see compress_progress): {failed}")
+    logger.info(f"done in {time.time() - start:.0f}s")
+    return failed
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d - %(processName)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    args = sys.argv[1:]
+    redo = '--redo' in args
+    room_ids = [ a for a in args if a != '--redo' ]
+    failed = run(room_ids or None, redo=redo)
+    sys.exit(1 if failed else 0)
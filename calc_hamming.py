@@ -4,9 +4,8 @@ import psycopg2
 from psycopg2.extras import execute_values
 import logging
 import sys
-import numpy as np
 from scipy.sparse.csgraph import minimum_spanning_tree
-from scipy.sparse import csr_matrix
+from knn_graph import knn_graph
 # from scipy.spatial.distance import pdist, squareform
 # from scipy.cluster.hierarchy import linkage, leaves_list
 # from psycopg2.extensions import register_adapter, AsIs
@@ -15,6 +14,9 @@ from scipy.sparse import csr_matrix
 
 # Go through the minhashes table, calculating the hamming distance between all LSH bands
 # and then BFS through the MST to order them
+#
+# N.B. a dense N×N distance matrix over every SG is 7K² for #nvi, and impossible for HQ's 82K (let alone
+# 410K), so we only calculate distances to each SG's k nearest neighbours (as found via LSH), as a sparse graph.
 
 # ALTER TABLE minhashes ADD COLUMN IF NOT EXISTS ordering BIGINT;
 
@@ -33,12 +35,14 @@ conn = psycopg2.connect("dbname=test") #, cursor_factory=LoggingCursor)
 conn.set_session(autocommit=True)
 cursor = conn.cursor()
 
-cursor.execute("SELECT sg_id, lsh_bands FROM minhashes order by sg_id");
+cursor.execute("SELECT sg_id, lsh_bands, minhash FROM minhashes order by sg_id");
 sg_id_list = []
 sig_list = []
-for (sg_id, sig) in cursor.fetchall():
+minhash_list = []
+for (sg_id, sig, minhash) in cursor.fetchall():
     sg_id_list.append(sg_id)
     sig_list.append(sig)
+    minhash_list.append(minhash)
 
 cursor.execute("UPDATE minhashes SET branch=NULL");
 
@@ -50,26 +54,21 @@ sig_len = len(sig_list[0])
 def distance(sig1, sig2):
     return sig_len - len(set(sig1) & set(sig2))
 
-def order_sigs(sigs):
+knn_k = 16 # neighbours per SG in the candidate graph
+
+def order_sigs(sigs, minhashes):
     n = len(sigs)
     
     print(f"Ordering {n} sigs using BFS on MST...")
     
-    # Build distance matrix
-    print("Building distance matrix...")
-    distances = np.zeros((n, n))
-    for i in range(n):
-        for j in range(i+1, n):
-            dist = distance(sigs[i], sigs[j])
-            distances[i][j] = distances[j][i] = dist
-        
-        if (i + 1) % 1000 == 0:
-            print(f"Distances calculated: {i + 1}/{n}")
+    # Build the sparse kNN graph (rather than a dense distance matrix)
+    print("Building kNN graph...")
+    distances = knn_graph(sigs, minhashes, k=knn_k)
     
     # Find MST
     print("Building minimum spanning tree...")
     
-    mst = minimum_spanning_tree(csr_matrix(distances))
+    mst = minimum_spanning_tree(distances)
     
     # Convert to adjacency list
     print("Converting MST to adjacency list...")
@@ -101,7 +100,7 @@ def order_sigs(sigs):
         ordered.append(node)
         
         # Add neighbors to queue in order of distance (closest first)
-        neighbors = [(distances[node][neighbor], neighbor) for neighbor in adj[node] if not visited[neighbor]]
+        neighbors = [(distances[node, neighbor], neighbor) for neighbor in adj[node] if not visited[neighbor]]
         neighbors.sort()  # Sort by distance, closest first
         
         for _, neighbor in neighbors:
@@ -121,7 +120,7 @@ def order_sigs(sigs):
 #     [ 0x7FFFFFFF, 0x7FFFFFFF, 0x7FFFFFFF, 0x7FFFFFFF, 0x7FFFFFFF, 0x7FFFFFFF, 0x7FFFFFFF, 0x7FFFFFFF ], 
 # ]
 
-ordering = order_sigs(sig_list)
+ordering = order_sigs(sig_list, minhash_list)
 
 ordered_ids = [ sg_id_list[order] for order in ordering ]
 
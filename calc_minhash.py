@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
 import psycopg2
-from psycopg2.extras import execute_values
 import logging
 import sys
-import numpy as np
-from datasketch import MinHashLSH, MinHash
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from copy_writer import CopyWriter
+from state_loader import stream_state_groups_state
+from minhashing import calc_minhash, calc_minhash_batch, MinHasher, IncrementalMinHash, to_s32, lsh_bands
+from symbols import SymbolTable, state_set_array
+from state_sets import StateBitmap
 
 # Go through each SG chronologically, calculating:
 #  * current state set as of that SG
@@ -23,6 +29,7 @@ DB_CONFIG = {
 #   room_id text,
 #   minhash integer[], -- 128 minhash values
 #   lsh_bands integer[], -- 16 LSH bands (hashed from the above), so 16 hashes of 8 minhash values
+#                        -- (minhashing.py's lsh_band_count & lsh_band_width; N.B. hashed in python, not via the old hash_array())
 #   add_count int,
 #   gone_count int
 # );
@@ -44,45 +51,87 @@ room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
 conn = psycopg2.connect(**DB_CONFIG)
 conn.set_session(autocommit=True)
 
-table = []
+# a separate non-autocommit connection, so we can stream state_groups_state through a server-side cursor
+read_conn = psycopg2.connect(**DB_CONFIG)
+
+# we intern event_ids and (type, state_key) pairs as dense ints as we load them, so state dicts
+# are { pair_id: event_id } and state sets are copy-on-write bitmaps of event IDs (see state_sets.py).
+events = SymbolTable()
+pairs = SymbolTable()
+
+# rows get streamed into the minhashes table as we go, rather than all being inserted at the end
+minhashes_writer = CopyWriter(
+    conn,
+    'minhashes',
+    ['sg_id', 'room_id', 'minhash', 'lsh_bands', 'add_count', 'gone_count'],
+    types=['int8', 'text', 'int4[]', 'int4[]', 'int4', 'int4'],
+    format='binary',
+)
 
+# There are two alternative ways of minhashing each SG's state set:
+#
+#  * incrementally (incremental_minhash, the default): we maintain the minhash from each SG's add/gone
+#    deltas, so the cost per SG is proportional to the delta (typically 1-10 events in HQ) rather than the
+#    size of the room state.
+#  * from scratch: this is CPU bound, and was the bulk of our runtime (30m for 50,000 SGs of HQ on M1), so
+#    we farm it out to a pool of worker processes in batches while the main thread gets on with resolving
+#    state sets. Set minhash_workers = 0 to minhash inline instead.
+#
+# The pool is only used (and started) when incremental_minhash is off.
+incremental_minhash = True
+state_minhash = IncrementalMinHash(MinHasher(symbols=events)) # the minhash of state_set, when incremental_minhash is set
+
+minhash_workers = os.cpu_count() or 1 # when incremental_minhash is off
+minhash_batch_size = 200 # SGs per batch sent to a worker
+minhash_max_in_flight = 4 * max(minhash_workers, 1) # batches in flight before we block, to bound RAM
+
+minhash_pool = None
+if minhash_workers and not incremental_minhash:
+    # we explicitly fork, as spawn (the macOS default) would re-run this whole script in each worker
+    minhash_pool = ProcessPoolExecutor(max_workers=minhash_workers, mp_context=multiprocessing.get_context('fork'))
+
+minhash_batch = [] # [ (sg_id, event_ids) ] waiting to be sent to the pool
+minhash_counts = {} # minhash_counts[sg_id] = (add_count, gone_count) for SGs whose minhash is in flight
+minhash_futures = deque() # batches in flight, in order of submission (and so sg_id)
+
+def queue_minhash(sg_id, state_set, add_count, gone_count):
+    if minhash_pool is None:
+        add_row(sg_id, calc_minhash(events.lookup_many(state_set.to_array())), add_count, gone_count)
+        return
+
+    minhash_batch.append((sg_id, events.lookup_many(state_set.to_array())))
+    minhash_counts[sg_id] = (add_count, gone_count)
+    if len(minhash_batch) >= minhash_batch_size:
+        flush_minhashes()
+
+def flush_minhashes(max_in_flight=minhash_max_in_flight):
+    global minhash_batch
+    if minhash_pool is None:
+        return
+
+    if minhash_batch:
+        minhash_futures.append(minhash_pool.submit(calc_minhash_batch, minhash_batch))
+        minhash_batch = []
+
+    while len(minhash_futures) > max_in_flight:
+        results = minhash_futures.popleft().result()
+        # batches come back in submission order, but make sure rows are added in sg_id order regardless
+        results.sort(key=lambda r: r[0])
+        for (sg_id, minhash) in results:
+            (add_count, gone_count) = minhash_counts.pop(sg_id)
+            add_row(sg_id, minhash, add_count, gone_count)
+
+# we calculate the LSH bands here as we go, rather than as a huge UPDATE of the whole minhashes
+# table afterwards, so each row only gets written once.
 def add_row(sg_id, minhash, add_count, gone_count):
     logger.debug(f"adding {sg_id} {add_count} {gone_count}")
-    row = [sg_id, room_id, minhash, add_count, gone_count]
-    table.append(row)
+    bands = lsh_bands(minhash).tolist()
+    row = [sg_id, room_id, minhash, bands, add_count, gone_count]
+    minhashes_writer.write(row)
 
 def dump_state():
-    c = conn.cursor()
-    execute_values(
-        c,
-        "INSERT INTO minhashes (sg_id, room_id, minhash, add_count, gone_count) VALUES %s",
-        table,
-        page_size=1000,
-    )
-
-    # FIXME: lots of scope for memoizing obviously
-    c.execute("""
-    UPDATE minhashes
-    SET lsh_bands = ARRAY[
-        hash_array(minhash[1:8]),
-        hash_array(minhash[9:16]),
-        hash_array(minhash[17:24]),
-        hash_array(minhash[25:32]),
-        hash_array(minhash[33:40]),
-        hash_array(minhash[41:48]),
-        hash_array(minhash[49:56]),
-        hash_array(minhash[57:64]),
-        hash_array(minhash[65:72]),
-        hash_array(minhash[73:80]),
-        hash_array(minhash[81:88]),
-        hash_array(minhash[89:96]),
-        hash_array(minhash[97:104]),
-        hash_array(minhash[105:112]),
-        hash_array(minhash[113:120]),
-        hash_array(minhash[121:128])
-    ];
-    """)
-    c.close()
+    # flush whatever rows are still buffered
+    minhashes_writer.close()
 
     # query as:
     # select sg_id,add_count,gone_count,ARRAY(SELECT LPAD(TO_HEX(x), 8, '0') FROM UNNEST(lsh_bands) AS x) from minhashes order by sg_id;
@@ -148,86 +197,94 @@ def get_state_dict(sg_id):
 # grab the ordered SGs and their state in one swoop, so we don't have to keep fishing out state events.
 # Problem: selects from sg or sgs table ordered by SG ID is slow as there's no index on both room_id and SG ID.
 #
-# so instead, let's load in batches of 5000 (which is good anyway), explicitly querying the rows from the
-# ordered state_group_edges table.
+# so instead, we explicitly query the rows for the SG IDs from the state_group_edges table, streaming them
+# through a single server-side cursor (rather than ~800 round trips of 100 SG batches for HQ).
 logger.info("loading SG state")
 
-# state_groups[sg_id] = { (event_type, state_key): event_id }
+# state_groups[sg_id] = { pair_id: event_id }
 state_groups = {}
 
-state_set = set() # the set of event_ids in current state as of last_sg_id
+# state_bitmaps[sg_id] = the StateBitmap of state_groups[sg_id], for the SGs still in state_groups.
+# Each SG's bitmap is derived from its prev's, so they share all the chunks its delta doesn't touch.
+state_bitmaps = {}
+
+state_set = StateBitmap() # the event IDs in current state as of last_sg_id
 last_sg_id = None # the SG id being accumulated
-sg = {} # sg[(type,key)] = event_id. the current stategroup being accumulated (with id last_sg_id)
-type_dict = {} # type_dict[evemt_id] = (type,key) for remembering the type of a given event id
+sg = {} # sg[pair_id] = event_id. the current stategroup being accumulated (with id last_sg_id)
+type_dict = {} # type_dict[event_id] = pair_id for remembering the type of a given event id
 
 sg_id_list = sorted(sg_id_set)
 del sg_id_set
 
-batch_size = 100
-for i in range(0, len(sg_id_list), batch_size):
-    slice = sg_id_list[i:i+batch_size]
-    #logger.debug(slice)
-
-    logger.info(f"i={i}, (sg {sg_id_list[i]})")
-
-    cursor.execute("""
-        SELECT state_group, type, state_key, event_id
-        FROM state_groups_state 
-        WHERE state_group = ANY(%s)
-        ORDER BY state_group
-    """, [slice])
-
-    for (sg_id, event_type, state_key, event_id) in cursor.fetchall():
-        logger.debug('')
-        logger.debug(f"Checking {sg_id} {event_type} {state_key} {event_id}")
-        logger.debug('')
-        type_dict[event_id] = (event_type, state_key)
-
-        def handle_last_sg(state_set):
-            state_groups[last_sg_id] = sg
-            logger.debug(f"Handling sg {last_sg_id}")
-            logger.debug(f"prev_edges[{last_sg_id}] = { prev_edges.get(last_sg_id, None) }")
-            for prev in prev_edges.get(last_sg_id, []):
-                logger.debug(f"next_edges[{prev}] = { next_edges.get(prev, None) }")
-
-            new_state_set = set(get_state_dict(last_sg_id).values())
-
-            new_ids = new_state_set - state_set
-            gone_ids = state_set - new_state_set
-            logger.debug(f"new_ids {new_ids}")
-            logger.debug(f"gone_ids {gone_ids}")
-
-            logger.debug(f"len(new_state_set)={len(new_state_set)} len(state_set)={len(state_set)}")
-
-            # todo: parallelise this somehow. it's not even using 1 thread.
-            # on M1, it takes 30m for 50,000 state groups in HQ
-            mh = MinHash()
-            for e in new_state_set:
-                mh.update(e.encode('utf8'))
-            minhash = mh.hashvalues.astype(np.int64)
-            minhash_s32 = ((minhash % (2**32)) - 2**31).astype(np.int32).tolist()
-            add_count = len(new_ids)
-            gone_count = len(gone_ids)
-            #logger.debug(f"calculated minhash {minhash}")
-
-            add_row(last_sg_id, minhash_s32, add_count, gone_count)
-
-            return (new_state_set)
-
-        # build up the event IDs in this state group
-        if sg_id == last_sg_id:
-            sg[(event_type, state_key)] = event_id
-            continue
+for (sg_id, event_type, state_key, event_id) in stream_state_groups_state(read_conn, sg_id_list):
+    logger.debug('')
+    logger.debug(f"Checking {sg_id} {event_type} {state_key} {event_id}")
+    logger.debug('')
+    event_id = events.intern(event_id)
+    pair_id = pairs.intern((event_type, state_key))
+    type_dict[event_id] = pair_id
+
+    def handle_last_sg(state_set):
+        state_groups[last_sg_id] = sg
+        logger.debug(f"Handling sg {last_sg_id}")
+        logger.debug(f"prev_edges[{last_sg_id}] = { prev_edges.get(last_sg_id, None) }")
+        for prev in prev_edges.get(last_sg_id, []):
+            logger.debug(f"next_edges[{prev}] = { next_edges.get(prev, None) }")
+
+        # grab our prev's state before get_state_dict merges it into ours (and maybe purges it)
+        prevs = list(prev_edges.get(last_sg_id, []))
+        base = None
+        if len(prevs) == 1 and prevs[0] in state_bitmaps:
+            base = (state_bitmaps[prevs[0]], state_groups[prevs[0]])
+
+        new_state_dict = get_state_dict(last_sg_id)
+        if base is not None:
+            new_state_set = base[0].with_delta(base[1], sg)
+        else:
+            new_state_set = StateBitmap.from_ids(state_set_array(new_state_dict))
+
+        for prev_id in prevs:
+            if prev_id not in state_groups:
+                state_bitmaps.pop(prev_id, None)
+        if last_sg_id in state_groups:
+            state_bitmaps[last_sg_id] = new_state_set
+
+        # N.B. this only has to look at the chunks which differ between the two bitmaps
+        (new_ids, gone_ids) = state_set.diff(new_state_set)
+        logger.debug(f"new_ids {new_ids}")
+        logger.debug(f"gone_ids {gone_ids}")
+
+        logger.debug(f"len(new_state_set)={len(new_state_set)} len(state_set)={len(state_set)}")
+
+        add_count = len(new_ids)
+        gone_count = len(gone_ids)
+        if incremental_minhash:
+            state_minhash.update(new_ids, gone_ids)
+            add_row(last_sg_id, to_s32(state_minhash.signature()).tolist(), add_count, gone_count)
         else:
-            if last_sg_id is not None:
-                state_set = handle_last_sg(state_set)
+            queue_minhash(last_sg_id, new_state_set, add_count, gone_count)
 
-            # get going on the new sg
-            last_sg_id = sg_id
-            sg = { (event_type, state_key): event_id }
+        return (new_state_set)
+
+    # build up the event IDs in this state group
+    if sg_id == last_sg_id:
+        sg[pair_id] = event_id
+        continue
+    else:
+        if last_sg_id is not None:
+            state_set = handle_last_sg(state_set)
+
+        # get going on the new sg
+        last_sg_id = sg_id
+        sg = { pair_id: event_id }
 
 # flush the last sg
 handle_last_sg(state_set)
 
-# finally, dump the state table to the DB.
+# wait for any minhashes still in flight
+flush_minhashes(0)
+if minhash_pool is not None:
+    minhash_pool.shutdown()
+
+# finally, flush the rest of the minhashes table to the DB.
 dump_state()
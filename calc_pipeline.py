@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import psycopg2
+import logging
+import sys
+import time
+import numpy as np
+from copy_writer import CopyWriter
+from state_loader import stream_state_groups_state
+from minhashing import MinHasher, IncrementalMinHash, to_s32, lsh_bands, lsh_band_count, num_perm
+from symbols import SymbolTable
+from state_sets import StateBitmap
+from state_cache import StateCache
+from state_resolver import resolve_state
+from lsh_index import LSHIndex
+from segmenting import find_segments
+from distance_matrix import segment_distances
+from tsp_solvers import solve_tsp
+from ordering import spaced_labels
+
+# Runs the whole pipeline for a room in a single process: calc_minhash.py -> calc_segmented_tsp.py ->
+# calc_state.py.
+#
+# Run as three scripts, each one reconnects to postgres, reloads the SG DAG, and refetches either
+# state_groups_state (16.9M rows for HQ) or minhashes from scratch. Here we load the DAG and stream
+# state_groups_state once, keep each SG's interned delta in RAM, and pass the signatures and the ordering
+# between the phases in memory. The only things written out are the minhashes rows (with their ordering)
+# and the state rows.
+#
+# The phases are the same as the scripts' (and share their code, via state_resolver.py and segmenting.py):
+#  * minhash: resolve each SG's state in sg_id order, and minhash it incrementally from the diffs.
+#  * order: cut the SGs into sections wherever the state jumps, and the sections into segments at their
+#    branch points (found via an in-memory LSHIndex), then order the segments by TSP.
+#  * state: resolve each SG's state in the new order, and write out a state row per lifetime of each event.
+#
+# Usage: calc_pipeline.py [room_id]
+
+DB_CONFIG = {
+    'database': 'test',
+}
+
+logger = logging.getLogger()
+
+#room_id = '!kxwQeJPhRigXSZrHqf:matrix.org'
+room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
+
+tsp_solver = 'elkai' # see tsp_solvers.py
+tsp_time_budget = None
+state_cache_budget = 2 * 1024 * 1024 * 1024 # bytes
+
+class Room:
+    """The in-memory state of the pipeline for one room, shared between the phases"""
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        # as in calc_minhash.py & calc_state.py, event_ids and (type, state_key) pairs are interned as dense ints
+        self.events = SymbolTable()
+        self.pairs = SymbolTable()
+        self.type_dict = {} # type_dict[event_id] = pair_id
+        self.next_edges = {} # next_edges[prev_id] = [ next_ids ]
+        self.prev_edges = {} # prev_edges[next_id] = [ prev_ids ]
+        # deltas[sg_id] = (pair_ids, event_ids) int32 arrays of the state rows of the SG itself
+        self.deltas = {}
+        self.sg_ids = None # the SGs with state rows, in sg_id order
+        self.minhashes = None # (n, 128) int32, per sg_ids
+        self.lsh_bands = None # (n, 16) int32
+        self.add_counts = None
+        self.gone_counts = None
+        self.ordering = None # ordering[i] = the ordering value (and state index) of sg_ids[i]
+
+    def load_dag(self, cursor):
+        logger.info("loading SG DAG")
+        cursor.execute("SELECT state_group, prev_state_group FROM state_groups sg JOIN state_group_edges sge ON sg.id = sge.state_group where room_id=%s", [self.room_id])
+        sg_id_set = set()
+        for (sg_id, prev_id) in cursor.fetchall():
+            self.next_edges.setdefault(prev_id, []).append(sg_id)
+            self.prev_edges.setdefault(sg_id, []).append(prev_id)
+            sg_id_set.add(sg_id)
+            sg_id_set.add(prev_id)
+        return sorted(sg_id_set)
+
+    def load_state(self, read_conn, sg_id_list):
+        logger.info("loading SG state")
+        events = self.events
+        pairs = self.pairs
+        last_sg_id = None
+        pair_ids = []
+        event_ids = []
+        for (sg_id, event_type, state_key, event_id) in stream_state_groups_state(read_conn, sg_id_list):
+            if sg_id != last_sg_id:
+                if last_sg_id is not None:
+                    self.deltas[last_sg_id] = (np.array(pair_ids, dtype=np.int32), np.array(event_ids, dtype=np.int32))
+                last_sg_id = sg_id
+                pair_ids = []
+                event_ids = []
+            event_id = events.intern(event_id)
+            pair_id = pairs.intern((event_type, state_key))
+            self.type_dict[event_id] = pair_id
+            pair_ids.append(pair_id)
+            event_ids.append(event_id)
+        if last_sg_id is not None:
+            self.deltas[last_sg_id] = (np.array(pair_ids, dtype=np.int32), np.array(event_ids, dtype=np.int32))
+        self.sg_ids = np.array(sorted(self.deltas), dtype=np.int64)
+        logger.info(f"loaded {len(self.sg_ids)} SGs")
+
+    def sg_index(self, sg_id):
+        """The row of sg_id in sg_ids"""
+        return int(np.searchsorted(self.sg_ids, sg_id))
+
+    def delta(self, sg_id):
+        """The state rows of this SG itself, as { pair_id: event_id }"""
+        if sg_id not in self.deltas:
+            return {}
+        (pair_ids, event_ids) = self.deltas[sg_id]
+        return dict(zip(pair_ids.tolist(), event_ids.tolist()))
+
+    def walk(self, order):
+        """Yields (sg_id, added, removed) for each SG in the given order, with the event IDs added to and
+        removed from the state since the previous one"""
+        cache = StateCache.planned(order, self.prev_edges, state_cache_budget)
+        state_set = StateBitmap()
+        for sg_id in order:
+            cache.advance(sg_id)
+            new_state_set = resolve_state(sg_id, self.prev_edges, self.delta, cache)[1]
+            (added, removed) = state_set.diff(new_state_set)
+            yield (sg_id, added, removed)
+            state_set = new_state_set
+        cache.log_stats()
+
+    def calc_minhashes(self):
+        logger.info("calculating minhashes")
+        n = len(self.sg_ids)
+        state_minhash = IncrementalMinHash(MinHasher(symbols=self.events))
+        self.minhashes = np.empty((n, num_perm), dtype=np.int32)
+        self.lsh_bands = np.empty((n, lsh_band_count), dtype=np.int32)
+        self.add_counts = np.empty(n, dtype=np.int32)
+        self.gone_counts = np.empty(n, dtype=np.int32)
+        for (i, (sg_id, added, removed)) in enumerate(self.walk(self.sg_ids.tolist())):
+            state_minhash.update(added, removed)
+            self.minhashes[i] = to_s32(state_minhash.signature())
+            self.lsh_bands[i] = lsh_bands(self.minhashes[i])
+            self.add_counts[i] = len(added)
+            self.gone_counts[i] = len(removed)
+
+    def order(self):
+        logger.info("ordering SGs")
+        n = len(self.sg_ids)
+        index = LSHIndex(self.sg_ids, self.lsh_bands, self.minhashes)
+
+        (starts, ends) = find_segments(index, self.add_counts.astype(np.int64) + self.gone_counts)
+
+        distances = segment_distances(
+            self.lsh_bands[ends], self.lsh_bands[starts], self.minhashes[ends], self.minhashes[starts],
+        )
+        np.fill_diagonal(distances, 0)
+        tour = solve_tsp(distances, tsp_solver, tsp_time_budget)
+
+        ordered = np.concatenate([ np.arange(starts[s], ends[s] + 1) for s in tour ])
+        if len(ordered) != n:
+            raise RuntimeError(f"we've lost SGs: ordered {len(ordered)} of {n}")
+        # each SG's ordering is its index in the state table, as a gapped label (see ordering.py)
+        self.ordering = np.empty(n, dtype=np.int64)
+        self.ordering[ordered] = spaced_labels(n)
+
+    def write_minhashes(self, conn):
+        logger.info("writing minhashes")
+        with CopyWriter(
+            conn,
+            'minhashes',
+            ['sg_id', 'room_id', 'minhash', 'lsh_bands', 'add_count', 'gone_count', 'ordering'],
+            types=['int8', 'text', 'int4[]', 'int4[]', 'int4', 'int4', 'int8'],
+            format='binary',
+        ) as writer:
+            for i in range(len(self.sg_ids)):
+                writer.write([
+                    int(self.sg_ids[i]), self.room_id, self.minhashes[i].tolist(), self.lsh_bands[i].tolist(),
+                    int(self.add_counts[i]), int(self.gone_counts[i]), int(self.ordering[i]),
+                ])
+
+    def write_state(self, conn):
+        logger.info("writing state")
+        rows = 0
+        lifetimes = {} # event_id -> the open row for that event
+        order = self.sg_ids[np.argsort(self.ordering)].tolist()
+        with CopyWriter(
+            conn,
+            'state',
+            ['start_index', 'end_index', 'start_sg_id', 'end_sg_id', 'event_id', 'room_id', 'type', 'state_key'],
+            types=['int8', 'int8', 'int8', 'int8', 'text', 'text', 'text', 'text'],
+            format='binary',
+        ) as writer:
+            for (sg_id, added, removed) in self.walk(order):
+                index = int(self.ordering[self.sg_index(sg_id)])
+                for event_id in added.tolist():
+                    (event_type, state_key) = self.pairs.lookup(self.type_dict[event_id])
+                    lifetimes[event_id] = [index, None, sg_id, None, self.events.lookup(event_id), self.room_id, event_type, state_key]
+                for event_id in removed.tolist():
+                    row = lifetimes.pop(event_id)
+                    row[1] = index
+                    row[3] = sg_id
+                    writer.write(row)
+                    rows += 1
+            # write out the rows which are still in the current state
+            for row in lifetimes.values():
+                writer.write(row)
+                rows += 1
+        return rows
+
+def compress_room(room_id, conn=None, read_conn=None):
+    """Runs every phase of the pipeline for a room, replacing any minhashes & state rows from a previous
+    run. Returns a summary of what it did."""
+    opened = []
+    if conn is None:
+        conn = psycopg2.connect(**DB_CONFIG)
+        conn.set_session(autocommit=True)
+        opened.append(conn)
+    if read_conn is None:
+        # a separate non-autocommit connection, so we can stream state_groups_state through a server-side cursor
+        read_conn = psycopg2.connect(**DB_CONFIG)
+        opened.append(read_conn)
+    try:
+        return _compress_room(room_id, conn, read_conn)
+    finally:
+        for c in opened:
+            c.close()
+
+def _compress_room(room_id, conn, read_conn):
+    start = time.time()
+    room = Room(room_id)
+    cursor = conn.cursor()
+    sg_id_list = room.load_dag(cursor)
+    room.load_state(read_conn, sg_id_list)
+    if len(room.sg_ids) == 0:
+        logger.info(f"no state for {room_id}")
+        return { 'room_id': room_id, 'sgs': 0, 'state_rows': 0, 'seconds': time.time() - start }
+
+    room.calc_minhashes()
+    room.order()
+
+    cursor.execute("DELETE FROM minhashes WHERE room_id = %s", [room_id])
+    cursor.execute("DELETE FROM state WHERE room_id = %s", [room_id])
+    room.write_minhashes(conn)
+    state_rows = room.write_state(conn)
+
+    logger.info(f"compressed {room_id}: {len(room.sg_ids)} SGs into {state_rows} state rows in {time.time() - start:.1f}s")
+    return { 'room_id': room_id, 'sgs': len(room.sg_ids), 'state_rows': state_rows, 'seconds': time.time() - start }
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    compress_room(sys.argv[1] if len(sys.argv) > 1 else room_id)
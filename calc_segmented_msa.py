@@ -7,6 +7,8 @@ import sys
 import pprint
 from collections import deque
 import numpy as np
+from distance_matrix import overlap_matrix
+from knn_graph import knn_graph
 import networkx as nx
 
 # Go through the minhashes table, segmenting into regions where the
@@ -221,6 +223,24 @@ def distance(seg1, seg2):
     lsh_start = lsh_bands[seg2['ids'][0]]
     return 16 - len(set(lsh_end) & set(lsh_start))
 
+# If set, only consider the edges from each segment to its knn_k nearest neighbours (as found via LSH),
+# as a sparse graph, rather than every pair.
+knn_k = None
+
+def segment_knn_graph(segs):
+    # N.B. the weights are distance + 1, as sparse graphs treat 0 as no edge
+    ends = [ lsh_bands[seg['ids'][-1]] for seg in segs ]
+    starts = [ lsh_bands[seg['ids'][0]] for seg in segs ]
+    return knn_graph(ends, None, starts, None, k=knn_k)
+
+def distance_matrix(segs):
+    # the same as distance() for every pair of segs, but all in one go
+    ends = [ lsh_bands[seg['ids'][-1]] for seg in segs ]
+    starts = [ lsh_bands[seg['ids'][0]] for seg in segs ]
+    distances = 16 - overlap_matrix(ends, starts)
+    np.fill_diagonal(distances, 0)
+    return distances
+
 def order_segs(segs):
     n = len(segs)
     
@@ -230,14 +250,17 @@ def order_segs(segs):
     print("Building directed graph...")
     G = nx.DiGraph()
     
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                dist = distance(segs[i], segs[j])
-                G.add_edge(i, j, weight=dist)
-        
-        if (i + 1) % 1000 == 0:
-            print(f"Edges calculated: {i + 1}/{n}")
+    if knn_k:
+        graph = segment_knn_graph(segs).tocoo()
+        G.add_nodes_from(range(n))
+        G.add_weighted_edges_from(
+            (int(i), int(j), int(w) - 1) for (i, j, w) in zip(graph.row, graph.col, graph.data)
+        )
+    else:
+        distances = distance_matrix(segs)
+        G.add_weighted_edges_from(
+            (i, j, int(distances[i][j])) for i in range(n) for j in range(n) if i != j
+        )
     
     # Find minimum spanning arborescence
     print("Building minimum spanning arborescence...")
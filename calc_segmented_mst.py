@@ -7,6 +7,8 @@ import sys
 import pprint
 from collections import deque
 import numpy as np
+from distance_matrix import overlap_matrix
+from knn_graph import knn_graph
 from scipy.sparse.csgraph import minimum_spanning_tree
 from scipy.sparse import csr_matrix
 
@@ -236,6 +238,24 @@ def distance(seg1, seg2):
     lsh_start = lsh_bands[seg2['ids'][0]]
     return 16 - len(set(lsh_end) & set(lsh_start))
 
+# If set, only consider the edges from each segment to its knn_k nearest neighbours (as found via LSH),
+# as a sparse graph, rather than every pair.
+knn_k = None
+
+def segment_knn_graph(segs):
+    # N.B. the weights are distance + 1, as sparse graphs treat 0 as no edge
+    ends = [ lsh_bands[seg['ids'][-1]] for seg in segs ]
+    starts = [ lsh_bands[seg['ids'][0]] for seg in segs ]
+    return knn_graph(ends, None, starts, None, k=knn_k)
+
+def distance_matrix(segs):
+    # the same as distance() for every pair of segs, but all in one go
+    ends = [ lsh_bands[seg['ids'][-1]] for seg in segs ]
+    starts = [ lsh_bands[seg['ids'][0]] for seg in segs ]
+    distances = 16 - overlap_matrix(ends, starts)
+    np.fill_diagonal(distances, 0)
+    return distances
+
 def order_segs(segs):
     n = len(segs)
     
@@ -243,24 +263,20 @@ def order_segs(segs):
     
     # Build distance matrix
     print("Building distance matrix...")
-    distances = np.zeros((n, n))
-    for i in range(n):
-        for j in range(n):
-            # we allow high->low edges given the order may be shuffled.
-            # however, given distance is no longer symmetrical, we have
-            # to populate the whole matrix.
-            dist = distance(segs[i], segs[j])
-            # XXX: for MST, being undirected, the minimum of the two distance is used apparently
-            # which is going to give a weird outcome
-            distances[i][j] = dist
-        
-        if (i + 1) % 1000 == 0:
-            print(f"Distances calculated: {i + 1}/{n}")
+    # we allow high->low edges given the order may be shuffled.
+    # however, given distance is no longer symmetrical, we have
+    # to populate the whole matrix.
+    # XXX: for MST, being undirected, the minimum of the two distance is used apparently
+    # which is going to give a weird outcome
+    if knn_k:
+        distances = segment_knn_graph(segs)
+    else:
+        distances = csr_matrix(distance_matrix(segs))
     
     # Find MST
     print("Building minimum spanning tree...")
     
-    mst = minimum_spanning_tree(csr_matrix(distances))
+    mst = minimum_spanning_tree(distances)
     
     # Convert to adjacency list
     print("Converting MST to adjacency list...")
@@ -296,7 +312,7 @@ def order_segs(segs):
         ordered.append(node)
         
         # Add neighbors to queue in order of distance (closest first)
-        neighbors = [(distances[node][neighbor], neighbor) for neighbor in adj[node] if not visited[neighbor]]
+        neighbors = [(distances[node, neighbor], neighbor) for neighbor in adj[node] if not visited[neighbor]]
         neighbors.sort()  # Sort by distance, closest first
         
         for _, neighbor in neighbors:
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 import psycopg2
-from psycopg2.extras import execute_values
 import logging
 import sys
+import time
 import pprint
 from collections import deque
 import numpy as np
-import elkai
+from lsh_index import LSHIndex
+from segmenting import find_segments
+from distance_matrix import segment_distances
+from knn_graph import knn_graph, dense_distances
+from tsp_solvers import solve_tsp
+from tsp_clusters import band_clusters, solve_clusters, best_path
+from ordering import write_ordering
 
 # Go through the minhashes table, segmenting into regions where the
 # add_count and gone_count aren't too big.
@@ -40,278 +46,177 @@ logging.basicConfig(
 #room_id = '!kxwQeJPhRigXSZrHqf:matrix.org'
 room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
 
-conn = psycopg2.connect("dbname=test") #, cursor_factory=LoggingCursor)
-conn.set_session(autocommit=True)
-cursor = conn.cursor()
-
-cursor.execute("SELECT sg_id FROM minhashes WHERE room_id = %s order by sg_id", [room_id])
-sg_id_list = [ row[0] for row in cursor.fetchall() ]
-
-logging.debug("sg_id_list")
-logging.debug(' '.join(f'{id:10d}' for id in sg_id_list))
-
-lsh_bands = {} # sg_id => [ 16 band vals ]
-minhashes = {} # sg_id => [ 128 minhash vals ]
-
-# we partition into sections whenever there is a jump:
-
-section_starts = []
-section_ends = []
-cursor.execute("SELECT sg_id, lsh_bands, minhash FROM minhashes WHERE room_id = %s order by sg_id limit 1", [room_id])
-row = cursor.fetchone()
-section_starts.append( { "sg_id": row[0], "lsh_bands": row[1], "minhash": row[2] } )
-lsh_bands[row[0]] = row[1]
-minhashes[row[0]] = row[2]
-ends = []
-cursor.execute("SELECT sg_id, lsh_bands, minhash FROM minhashes where room_id = %s and add_count + gone_count > 10 order by sg_id", [room_id])
-for row in cursor.fetchall():
-    section_starts.append( { "sg_id": row[0], "lsh_bands": row[1], "minhash": row[2] } )
-    ends.append( sg_id_list[sg_id_list.index(row[0]) - 1] )
-    lsh_bands[row[0]] = row[1]
-    minhashes[row[0]] = row[2]
-cursor.execute("SELECT sg_id, lsh_bands, minhash FROM minhashes where room_id = %s and sg_id = any(%s) order by sg_id", [room_id, ends])
-for row in cursor.fetchall():
-    section_ends.append( { "sg_id": row[0], "lsh_bands": row[1], "minhash": row[2] } )
-    lsh_bands[row[0]] = row[1]
-    minhashes[row[0]] = row[2]
-cursor.execute("SELECT sg_id, lsh_bands, minhash FROM minhashes where room_id = %s order by sg_id desc limit 1", [room_id])
-row = cursor.fetchone()
-section_ends.append( { "sg_id": row[0], "lsh_bands": row[1], "minhash": row[2] } )
-lsh_bands[row[0]] = row[1]
-minhashes[row[0]] = row[2]
-
-sections = []
-for i, b in enumerate(section_starts):
-    sections.append({
-        # inclusive range
-        'start': section_starts[i],
-        'end': section_ends[i]
-    })
-
-for section in sections:
-    logging.debug(f"section { section['start']['sg_id'] } -> { section['end']['sg_id'] }")
-
-# cut points of nodes we cut before or after - due to branchpoints
-cut_after = set()  # we cut after the src of links from the past
-cut_before = set() # we cut before the dest of links to the future
-
-# find the branchpoints where these segments ideally belong from
-# in terms of minhash proximity
-c = conn.cursor()
-for i, section in enumerate(sections):
-    if i > 0:
-        # closest start point - looking only into the past:
-        start = section['start']
-        # XXX: check this actually does an efficient query
-        c.execute("""
-            WITH query_bands AS (
-                SELECT %s AS bands
-            )
-            SELECT sg_id, lsh_bands, minhash FROM minhashes, query_bands
-            -- WHERE (
-            --    SELECT COUNT(*)
-            --    FROM unnest(lsh_bands) AS band
-            --    WHERE band = ANY(query_bands.bands)
-            --) >= 8
-            WHERE lsh_bands && query_bands.bands
-            AND sg_id < %s
-            AND room_id = %s
-            ORDER BY jaccard_similarity(minhash, %s) DESC, sg_id DESC
-            LIMIT 1;
-        """, [ start['lsh_bands'], start['sg_id'], room_id, start['minhash'] ])
-        row = c.fetchone()
-        if row is not None:
-            logger.info(f"found start branch point {row[0]} for { start['sg_id'] }")
-            lsh_bands[row[0]] = row[1]
-            minhashes[row[0]] = row[2]
-            cut_after.add(row[0])
+# N.B. this only runs as a script: the TSP solvers' subprocesses (and tsp_clusters.py's workers) get
+# started from a forkserver, which re-imports the main module in each of them.
+if __name__ == "__main__":
+    conn = psycopg2.connect("dbname=test") #, cursor_factory=LoggingCursor)
+    conn.set_session(autocommit=True)
+    cursor = conn.cursor()
+
+    # we used to find the branchpoints with up to 4 queries per section, ordered by the jaccard_similarity()
+    # SQL function, which took 10 minutes for 2,400 branch points. Instead we load the whole room's minhashes
+    # into an in-memory LSH index once, and search that.
+    index = LSHIndex.load(cursor, room_id)
+    sg_id_list = index.sg_ids.tolist()
+
+    logging.debug("sg_id_list")
+    logging.debug(' '.join(f'{id:10d}' for id in sg_id_list))
+
+    # cut the SGs into segments at the jumps and the branchpoints (see segmenting.py)
+    cursor.execute("SELECT add_count + gone_count FROM minhashes WHERE room_id = %s order by sg_id", [room_id])
+    (starts, ends) = find_segments(index, [ row[0] for row in cursor.fetchall() ])
+
+    # grab the LSH bands and minhashes for either end of each segment
+    lsh_bands = {} # sg_id => [ 16 band vals ]
+    minhashes = {} # sg_id => [ 128 minhash vals ]
+    for row in np.union1d(starts, ends).tolist():
+        lsh_bands[sg_id_list[row]] = index.lsh_bands[row].tolist()
+        minhashes[sg_id_list[row]] = index.minhashes[row].tolist()
+
+    for sg_id in sorted(lsh_bands.keys()):
+        logging.debug(f"lsh {sg_id:10d}: { ','.join(f'{(x & 0xFFFFFFFF):08x}' for x in lsh_bands[sg_id]) }")
+
+    # split the sg_id_list into segments:
+    # [ {
+    #   'ids': [ sg_ids ],
+    # } ]
+    segments = [ { 'ids': sg_id_list[start:end + 1] } for (start, end) in zip(starts.tolist(), ends.tolist()) ]
+
+    for i, segment in enumerate(segments):
+        logging.debug(f"segment #{ i } { segment['ids'][0] } -> { segment['ids'][-1] }")
+
+    # We save the segments as (start_sg_id, end_sg_id) rows, and (in order_segs) their distance matrix, as .npy
+    # files which other solvers (e.g. aco.py) can np.load(..., mmap_mode='r'), rather than having to regex them
+    # back out of our debug log. Set these to None to skip saving them.
+    segments_file = 'hq-segs.npy'
+    distances_file = 'hq-matrix.npy'
+
+    if segments_file:
+        np.save(segments_file, np.array([ [ seg['ids'][0], seg['ids'][-1] ] for seg in segments ], dtype=np.int64).reshape(-1, 2))
+
+    # By default the distance between segments is based on the size of the set intersection of their LSH bands
+    # (falling back to that of their minhashes), as it always has been. Set this to count the matching fields
+    # instead (i.e. hamming distance), which is what the minhashes actually mean.
+    positional_distance = False
+
+    def segment_distance_matrix(from_segs, to_segs):
+        # distances from the end of each of from_segs to the start of each of to_segs, all in one go.
+        # normalised to [0,128] like hamming distance on minhashes.
+        ends = [ seg['ids'][-1] for seg in from_segs ]
+        starts = [ seg['ids'][0] for seg in to_segs ]
+        return segment_distances(
+            [ lsh_bands[id] for id in ends ], [ lsh_bands[id] for id in starts ],
+            [ minhashes[id] for id in ends ], [ minhashes[id] for id in starts ],
+            positional=positional_distance,
+        )
+
+    # If set, only calculate the distances from each segment to its knn_k nearest neighbours (as found via LSH),
+    # rather than between every pair. Missing edges are then given a distance worse than any real one.
+    knn_k = None
+
+    def segment_knn_graph(segs):
+        ends = [ seg['ids'][-1] for seg in segs ]
+        starts = [ seg['ids'][0] for seg in segs ]
+        return knn_graph(
+            [ lsh_bands[id] for id in ends ], [ minhashes[id] for id in ends ],
+            [ lsh_bands[id] for id in starts ], [ minhashes[id] for id in starts ],
+            k=knn_k, positional=positional_distance,
+        )
+
+    def distance(seg1, seg2):
+        if seg1 == seg2:
+            return 0
+        return int(segment_distance_matrix([seg1], [seg2])[0][0])
+
+    # which TSP solver to use: one of 'elkai', 'aco', 'aco_islands', 'greedy', 'chronological' or 'hybrid' (see tsp_solvers.py)
+    tsp_solver = 'elkai'
+    # give up and use the best tour so far after this many seconds (None for no limit)
+    tsp_time_budget = None
+
+    # If set, split the segments into clusters which share LSH bands (see tsp_clusters.py), solve each
+    # cluster's TSP concurrently in its own process, and then stitch the clusters' paths together with a
+    # meta-TSP, rather than solving one big TSP.
+    cluster_tsp = False
+    max_cluster_size = 500
+    tsp_processes = None # defaults to the number of CPUs
+    tsp_meta_share = 0.1 # of tsp_time_budget held back for the meta-TSP
+
+    def segment_distances_of(segs):
+        if knn_k:
+            distances = dense_distances(segment_knn_graph(segs), missing=256)
         else:
-            logger.info(f"failed to find start branch point for { start['sg_id'] } - fall back to minhashes")
-            c.execute("""
-                WITH query_minhash AS (
-                    SELECT %s AS minhash
-                )
-                SELECT sg_id, lsh_bands, minhashes.minhash FROM minhashes, query_minhash
-                WHERE minhashes.minhash && query_minhash.minhash
-                AND sg_id < %s
-                AND room_id = %s
-                ORDER BY jaccard_similarity(minhashes.minhash, %s) DESC, sg_id DESC
-                LIMIT 1;
-            """, [ start['minhash'], start['sg_id'], room_id, start['minhash'] ])
-            row = c.fetchone()
-            if row is not None:
-                logger.info(f"found start branch point {row[0]} for { start['sg_id'] } via minhash")
-                lsh_bands[row[0]] = row[1]
-                minhashes[row[0]] = row[2]
-                cut_after.add(row[0])
-            else:
-                logger.warning(f"failed to find start branch point for { start['sg_id'] } entirely")
-
-    if i < len(section_starts) - 1:
-        # closest end point - currently looking only into the future, to avoid risk of loops
-        end = section['end']
-        c.execute("""
-            WITH query_bands AS (
-                SELECT %s AS bands
-            )
-            SELECT sg_id, lsh_bands, minhash FROM minhashes, query_bands
-            -- WHERE (
-            --    SELECT COUNT(*)
-            --    FROM unnest(lsh_bands) AS band
-            --    WHERE band = ANY(query_bands.bands)
-            --) >= 8
-            WHERE lsh_bands && query_bands.bands
-            AND sg_id > %s
-            AND room_id = %s
-            ORDER BY jaccard_similarity(minhash, %s) DESC, sg_id ASC
-            LIMIT 1;
-        """, [ end['lsh_bands'], end['sg_id'], room_id, end['minhash'] ])
-        row = c.fetchone()
-        if row is not None:
-            logger.info(f"found end   branch point {row[0]} for { end['sg_id'] }")
-            lsh_bands[row[0]] = row[1]
-            minhashes[row[0]] = row[2]
-            cut_before.add(row[0])
-        else:
-            logger.info(f"failed to find end branch point for { end['sg_id'] } - fall back to minhashes")
-            c.execute("""
-                WITH query_minhash AS (
-                    SELECT %s AS minhash
-                )
-                SELECT sg_id, lsh_bands, minhashes.minhash FROM minhashes, query_minhash
-                WHERE minhashes.minhash && query_minhash.minhash
-                AND sg_id > %s
-                AND room_id = %s
-                ORDER BY jaccard_similarity(minhashes.minhash, %s) DESC, sg_id ASC
-                LIMIT 1;
-            """, [ end['minhash'], end['sg_id'], room_id, end['minhash'] ])
-            row = c.fetchone()
-            if row is not None:
-                logger.info(f"found end branch point {row[0]} for { end['sg_id'] } via minhash")
-                lsh_bands[row[0]] = row[1]
-                minhashes[row[0]] = row[2]
-                cut_before.add(row[0])
-            else:
-                logger.warning(f"failed to find end branch point for { end['sg_id'] } entirely")
-
-# grab the LSH bands for SGs on the other side of cut boundaries
-other_sgs = set()
-for cut in cut_before:
-    other_sgs.add( sg_id_list[sg_id_list.index(cut) - 1] )
-for cut in cut_after:
-    i = sg_id_list.index(cut) + 1
-    if i < len(sg_id_list):
-        other_sgs.add( sg_id_list[i] )
-cursor.execute("SELECT sg_id, lsh_bands, minhash FROM minhashes where room_id = %s and sg_id = any(%s) order by sg_id", [room_id, list(other_sgs)])
-for row in cursor.fetchall():
-    lsh_bands[row[0]] = row[1]
-    minhashes[row[0]] = row[2]
-
-# check we have all the LSH Bands
-for sg_id in sorted(lsh_bands.keys()):
-    logging.debug(f"lsh {sg_id:10d}: { ','.join(f'{(x & 0xFFFFFFFF):08x}' for x in lsh_bands[sg_id]) }")
-
-# turn all the cut_befores into cut_afters to make it easier to cut up the sections
-for cut in cut_before:
-    cut_after.add( sg_id_list[sg_id_list.index(cut) - 1] )
-
-# add all the jump points to cut_afters too to make it easier to cut things up
-# as we're going to walk the full SG list again
-for section in sections:
-    cut_after.add( section['end']['sg_id'] )
-
-for cut in sorted(list(cut_after)):
-    logging.debug(f"cut_after { cut }")
-
-# split the sg_id_list into segments based on the cut_after points we've now found.
-
-# [ {
-#   'ids': [ sg_ids ],
-# } ]
-segments = []
-first_segment = segment = { 'ids': [] }
-for i, sg_id in enumerate(sg_id_list):
-    segment['ids'].append(sg_id)
-    if sg_id in cut_after:
-        segments.append(segment)
-        segment = { 'ids': [] }
-#segments.append(segment)
-
-for i, segment in enumerate(segments):
-    logging.debug(f"segment #{ i } { segment['ids'][0] } -> { segment['ids'][-1] }")
-
-def distance(seg1, seg2):
-    if seg1 == seg2:
-        return 0
-    lsh_end = lsh_bands[seg1['ids'][-1]]
-    lsh_start = lsh_bands[seg2['ids'][0]]
-    # FIXME: this shouldn't just be the length of the set intersection, but the count of the matching fields
-    lsh_overlap = len(set(lsh_end) & set(lsh_start))
-    if lsh_overlap > 0:
-        return (16 - lsh_overlap) * 8 # normalise to [0,128] like hamming distance on minhashes
-    else:
-        # fall back to minhash overlap
-        minhash_end = minhashes[seg1['ids'][-1]]
-        minhash_start = minhashes[seg2['ids'][0]]
-        # FIXME: this shouldn't just be the length of the set intersection, but the count of the matching fields
-        minhash_overlap = len(set(minhash_start) & set(minhash_end))
-        return (128 - minhash_overlap)
-
-def order_segs(segs):
-    n = len(segs)
+            distances = segment_distance_matrix(segs, segs)
+            np.fill_diagonal(distances, 0)
+        return distances
+
+    def order_segs(segs):
+        n = len(segs)
+
+        if cluster_tsp:
+            return order_clustered_segs(segs)
     
-    logging.debug(f"Ordering {n} segs using TSP...")
+        logging.debug(f"Ordering {n} segs using TSP...")
     
-    # Build distance matrix
-    logging.debug("Building distance matrix...")
-    distances = np.zeros((n, n), dtype=int)
-    for i in range(n): # row
-        for j in range(n): # column
-            dist = distance(segs[i], segs[j])
-            distances[i][j] = dist
-        
-        if (i + 1) % 1000 == 0:
-            logging.debug(f"Distances calculated: {i + 1}/{n}")
-
-    logging.debug("  |" + " ".join(f'{i:2d}' for i in range(n)))
-    logging.debug("---" * (n + 1))
-    for i in range(n):
-        logging.debug(f"{i:2d}|" + " ".join(f'{d:2d}' for d in distances[i]))
-
-    #sys.exit(0)
-
-    tour = elkai.solve_int_matrix(distances)
-    return tour
-
-segment_ordering = order_segs(segments)
-for i, id in enumerate(segment_ordering):
-    this_seg = segments[id]
-    if i > 0:
-        prev_seg = segments[segment_ordering[i - 1]]
-    else:
-        prev_seg = segments[id]
-    logging.debug(f"ordered_segment index { id } { segments[id]['ids'][0] } -> { segments[id]['ids'][-1] } dist from prev: { distance(prev_seg, this_seg) }")
-
-ordered_ids = []
-for id in segment_ordering:
-    ordered_ids.extend(segments[id]['ids'])
-
-logging.debug("ordered_ids")
-logging.debug(' '.join(f'{id:10d}' for id in ordered_ids))
-
-logging.debug(f"length of ordered_ids = {len(ordered_ids)}")
-if len(ordered_ids) != len(sg_id_list):
-    logger.fatal("we've lost SGs")
-    sys.exit(1)
-
-# set the new ordering
-update_data = list(zip(sg_id_list, ordered_ids))
-# pprint.pp(update_data)
-
-execute_values(
-    cursor,
-    "UPDATE minhashes SET ordering = data.o FROM (VALUES %s) AS data(o, sg_id) WHERE minhashes.sg_id = data.sg_id",
-    update_data,
-    template=None,
-    page_size=1000
-)
+        # Build distance matrix
+        logging.debug("Building distance matrix...")
+        distances = segment_distances_of(segs)
+
+        if distances_file:
+            np.save(distances_file, distances)
+
+        #sys.exit(0)
+
+        tour = solve_tsp(distances, tsp_solver, tsp_time_budget)
+        return tour
+
+    def order_clustered_segs(segs):
+        # one deadline for the whole lot, holding back a share for stitching the clusters together
+        deadline = None if tsp_time_budget is None else time.time() + tsp_time_budget
+        remaining = lambda reserve=0: None if deadline is None else max(0, deadline - time.time() - reserve)
+
+        clusters = band_clusters(
+            [ lsh_bands[seg['ids'][-1]] for seg in segs ],
+            [ lsh_bands[seg['ids'][0]] for seg in segs ],
+            max_cluster_size=max_cluster_size,
+        )
+        logging.debug(f"Ordering {len(segs)} segs in {len(clusters)} clusters using TSP...")
+        cluster_distances = [ segment_distances_of([ segs[i] for i in cluster ]) for cluster in clusters ]
+        paths = [
+            [ int(cluster[i]) for i in path ]
+            for cluster, path in zip(clusters, solve_clusters(cluster_distances, tsp_solver, remaining(tsp_meta_share * (tsp_time_budget or 0)), tsp_processes))
+        ]
+
+        # stitch the paths together, from the end of each path to the start of the next
+        meta_distances = segment_distance_matrix([ segs[p[-1]] for p in paths ], [ segs[p[0]] for p in paths ])
+        np.fill_diagonal(meta_distances, 0)
+        logging.debug(f"Stitching {len(paths)} cluster paths using TSP...")
+        meta_tour = best_path(meta_distances, solve_tsp(meta_distances, tsp_solver, remaining()))
+
+        tour = []
+        for i in meta_tour:
+            tour.extend(paths[i])
+        return tour
+
+    segment_ordering = order_segs(segments)
+    for i, id in enumerate(segment_ordering):
+        this_seg = segments[id]
+        if i > 0:
+            prev_seg = segments[segment_ordering[i - 1]]
+        else:
+            prev_seg = segments[id]
+        logging.debug(f"ordered_segment index { id } { segments[id]['ids'][0] } -> { segments[id]['ids'][-1] } dist from prev: { distance(prev_seg, this_seg) }")
+
+    ordered_ids = []
+    for id in segment_ordering:
+        ordered_ids.extend(segments[id]['ids'])
+
+    logging.debug("ordered_ids")
+    logging.debug(' '.join(f'{id:10d}' for id in ordered_ids))
+
+    logging.debug(f"length of ordered_ids = {len(ordered_ids)}")
+    if len(ordered_ids) != len(sg_id_list):
+        logger.fatal("we've lost SGs")
+        sys.exit(1)
+
+    # set the new ordering, as gapped labels (see ordering.py) so segments can be moved around later
+    write_ordering(cursor, ordered_ids)
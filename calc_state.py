@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 
 import psycopg2
-from psycopg2.extras import execute_values
 # from psycopg2.extensions import AsIs
 import logging
 import sys
 from collections import defaultdict, deque
+from copy_writer import CopyWriter
+from state_loader import stream_state_groups_state
+from symbols import SymbolTable
+from state_sets import StateBitmap
+from state_cache import StateCache
+from state_resolver import resolve_state
+from ordering import spaced_labels, write_ordering, min_relabel_gap
+
+# Writes the temporal state table for a room, visiting its SGs in the order an orderer (e.g.
+# calc_segmented_tsp.py or aco.py) recorded in minhashes.ordering, and using each SG's ordering as its
+# index. We refuse to run if any SG has no ordering, or two share one, as there's no order to follow.
+#
+# N.B. the one time we write minhashes.ordering ourselves is when the ordering is dense, i.e. no two
+# consecutive SGs are min_relabel_gap or more apart (as with the older orderers, e.g. calc_branches.py).
+# Then we respace it as gapped labels (see ordering.py), keeping the SGs in the same relative order, so
+# that calc_state_incremental.py has room to slot new SGs in.
 
 # CREATE TABLE state (
 #   start_index bigint not null,
@@ -45,35 +60,46 @@ room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
 conn = psycopg2.connect("dbname=test")
 conn.set_session(autocommit=True)
 
-state_table = []
-lifetimes = {} # event_id -> ( start_sg, end_sg )
+# a separate non-autocommit connection, so we can stream state_groups_state through a server-side cursor
+read_conn = psycopg2.connect("dbname=test")
+
+# we intern event_ids and (type, state_key) pairs as dense ints as we load them, so state dicts
+# are { pair_id: event_id } and state sets are copy-on-write bitmaps of event IDs (see state_sets.py).
+# They only get turned back into strings when we write out the state table.
+events = SymbolTable()
+pairs = SymbolTable()
+
+# rows get streamed into the state table as soon as they're complete (i.e. once the event has gone
+# from the state set, or at the end for the ones still in the current state), so we only have to
+# hold the currently open rows in RAM.
+state_writer = CopyWriter(
+    conn,
+    'state',
+    ['start_index', 'end_index', 'start_sg_id', 'end_sg_id', 'event_id', 'room_id', 'type', 'state_key'],
+    types=['int8', 'int8', 'int8', 'int8', 'text', 'text', 'text', 'text'],
+    format='binary',
+)
+lifetimes = {} # event_id -> the open row for that event
 
 def add_state(index, sg_id, event_id):
     logger.debug(f"adding {index} {sg_id} {event_id}")
-    row = [index, None, sg_id, None, event_id, room_id]
-    state_table.append(row)
+    (event_type, state_key) = pairs.lookup(type_dict[event_id])
+    row = [index, None, sg_id, None, events.lookup(event_id), room_id, event_type, state_key]
     lifetimes[event_id] = row
 
 def mark_state_as_gone(last_index, last_sg_id, event_id):
     logger.debug(f"marking {event_id} as gone at index {last_index} sg_id {last_sg_id}")
-    row = lifetimes[event_id]
+    row = lifetimes.pop(event_id)
     row[1] = last_index
     row[3] = last_sg_id
+    state_writer.write(row)
 
 def dump_state():
-    c = conn.cursor()
-    execute_values(
-        c,
-        "INSERT INTO state (start_index, end_index, start_sg_id, end_sg_id, event_id, room_id) VALUES %s",
-        state_table,
-        page_size=1000,
-    )
-    c.execute("""
-        UPDATE state SET type=sq.type, state_key=sq.state_key
-        FROM (SELECT event_id, type, state_key FROM state_groups_state WHERE room_id=%s) AS sq
-        WHERE state.event_id = sq.event_id
-    """, [room_id])
-    c.close()
+    # write out the rows which are still in the current state
+    for row in lifetimes.values():
+        state_writer.write(row)
+    lifetimes.clear()
+    state_writer.close()
 
 cursor = conn.cursor()
 
@@ -89,19 +115,9 @@ for row in cursor.fetchall():
     prev_sg = prev_edges.setdefault(row[0], [])
     prev_sg.append(row[1])
 
-def get_state_dict(sg_id):
-    if sg_id in state_groups:
-        sg = state_groups[sg_id]
-        if sg_id in prev_edges:
-            prevs = prev_edges[sg_id]
-            for prev_id in prevs:
-                # logger.debug(f"merging: {get_state(prev_id)} with {sg}")
-                sg = get_state_dict(prev_id) | sg
-
-                # we can't memoize because that relies on SGs being deleted after we're done with them,
-                # whereas here we process SGs out of order.
-        return sg
-    else:
+def get_sg_delta(sg_id):
+    """The state rows of this SG itself, as { pair_id: event_id }"""
+    if sg_id not in state_groups:
         logger.info(f"failed to find sg {sg_id}; must be misordered, fetching from DB")
         cursor.execute("""
             SELECT type, state_key, event_id
@@ -111,98 +127,103 @@ def get_state_dict(sg_id):
         """, [sg_id])
         sg = {}
         for (event_type, state_key, event_id) in cursor.fetchall():
-            sg[(event_type, state_key)] = event_id
+            event_id = events.intern(event_id)
+            pair_id = pairs.intern((event_type, state_key))
+            sg[pair_id] = event_id
+            type_dict[event_id] = pair_id
         state_groups[sg_id] = sg
-        return get_state_dict(sg_id)
+    return state_groups[sg_id]
 
 logger.info("loading SG state")
 
-# state_groups[sg_id] = { (event_type, state_key): event_id }
+# state_groups[sg_id] = { pair_id: event_id }, for the rows of the SG itself
 state_groups = {}
 
-state_set = set() # the set of event_ids in current state as of last_sg_id
+state_set = StateBitmap() # the event IDs in current state as of last_sg_id
 last_sg_id = None # the SG id being accumulated
-sg = {} # sg[(type,key)] = event_id. the current stategroup being accumulated (with id last_sg_id)
-type_dict = {} # type_dict[evemt_id] = (type,key) for remembering the type of a given event id
-
-cursor.execute("select sg_id from minhashes where room_id=%s order by ordering, sg_id", [room_id])
-sg_id_list = [row[0] for row in cursor.fetchall()]
+sg = {} # sg[pair_id] = event_id. the current stategroup being accumulated (with id last_sg_id)
+type_dict = {} # type_dict[event_id] = pair_id for remembering the type of a given event id
+
+cursor.execute("select sg_id, ordering from minhashes where room_id=%s order by ordering, sg_id", [room_id])
+rows = cursor.fetchall()
+sg_id_list = [row[0] for row in rows]
+
+# Each SG's index is its label from ordering.py, which the orderers leave gaps between, so that SGs
+# can be slotted in or moved later without renumbering everything (see calc_state_incremental.py).
+orderings = [row[1] for row in rows]
+if None in orderings:
+    logger.fatal(f"{orderings.count(None)} SGs have no ordering; run an orderer (e.g. calc_segmented_tsp.py) first")
+    sys.exit(1)
+if any(a == b for (a, b) in zip(orderings, orderings[1:])):
+    logger.fatal("some SGs share an ordering, so there's no order to follow; rerun the orderer")
+    sys.exit(1)
+# a dense ordering gets respaced in the same order (see above)
+respace = len(orderings) > 1 and all(b - a < min_relabel_gap for (a, b) in zip(orderings, orderings[1:]))
+if respace:
+    logger.info("respacing the dense ordering as gapped labels")
+    orderings = spaced_labels(len(sg_id_list))
+index_of = dict(zip(sg_id_list, orderings))
+
+# state_cache[sg_id] = (StateMap, StateBitmap) of the resolved state as of that SG.
+# As we know the order we'll visit SGs in, we can evict whichever state will be needed farthest in the
+# future (as itself, or as an ancestor of a later SG) whenever we go over budget.
+state_cache_budget = 2 * 1024 * 1024 * 1024 # bytes
+state_cache = StateCache.planned(sg_id_list, prev_edges, state_cache_budget)
 
 # to visualise the resulting reordering:
 # select * from (select branch, sg_id, sg_id-lag(sg_id) over (order by branch, sg_id) as l from minhashes order by branch, sg_id) l where l.l<0;
 # The flipflopping now looks like:
 # select start_index, start_sg_id, count(*) from state group by start_index, start_sg_id having count(*)>10 order by start_index;
 
-batch_size = 100
-index = 0
-for i in range(0, len(sg_id_list), batch_size):
-    slice = sg_id_list[i:i+batch_size]
-    #logger.debug(slice)
-
-    logger.info(f"i={i}, (sg {sg_id_list[i]})")
-
-    # ordered_sg_ids = [(sg_id, i) for i, sg_id in enumerate(slice)]
-
-    # # jump through hoops to preserve the ordering in which we process the state
-    # cursor.execute("""
-    #     WITH ordered_sg_ids (sg_id, sort_order) AS (VALUES %s)
-    #     SELECT state_group, type, state_key, event_id
-    #     FROM state_groups_state 
-    #     JOIN ordered_sg_ids o on state_group = sg_id
-    #     WHERE state_group = ANY(%s)
-    #     ORDER BY o.sort_order
-    # """,  (AsIs(','.join(cursor.mogrify("(%s,%s)", x).decode('utf-8') for x in ordered_sg_ids)), slice))
-
-    cursor.execute("""
-        SELECT state_group, type, state_key, event_id
-        FROM state_groups_state 
-        WHERE state_group = ANY(%s)
-    """,  [slice])
-    # manually reorder rows in python rather than mess around with sql
-    sg_to_i = { sg: i for (i, sg) in enumerate(slice) }
-    rows = cursor.fetchall()
-    rows.sort(key=lambda row: sg_to_i[row[0]])
-
-    for (sg_id, event_type, state_key, event_id) in rows:
-        logger.debug('')
-        logger.debug(f"Checking {sg_id} {event_type} {state_key} {event_id}")
-        logger.debug('')
-        type_dict[event_id] = (event_type, state_key)
-
-        def handle_last_sg(state_set, index):
-            state_groups[last_sg_id] = sg
-            logger.debug(f"Handling sg {last_sg_id}")
-            logger.debug(f"prev_edges[{last_sg_id}] = { prev_edges.get(last_sg_id, None) }")
-            for prev in prev_edges.get(last_sg_id, []):
-                logger.debug(f"next_edges[{prev}] = { next_edges.get(prev, None) }")
-
-            new_state_set = set(get_state_dict(last_sg_id).values())
-
-            new_ids = new_state_set - state_set
-            gone_ids = state_set - new_state_set
-            logger.debug(f"new_ids {new_ids}")
-            logger.debug(f"gone_ids {gone_ids}")
-            for id in new_ids:
-                add_state(index, last_sg_id, id)
-            for id in gone_ids:
-                mark_state_as_gone(index, last_sg_id, id)
-            return new_state_set
-
-        # build up the event IDs in this state group
-        if sg_id == last_sg_id:
-            sg[(event_type, state_key)] = event_id
-            continue
-        else:
-            if last_sg_id is not None:
-                state_set = handle_last_sg(state_set, index)
-                index = index + 1
-
-            # get going on the new sg
-            last_sg_id = sg_id
-            sg = { (event_type, state_key): event_id }
+# the loader streams the state back in the order of sg_id_list, so we don't have to reorder it ourselves
+for (sg_id, event_type, state_key, event_id) in stream_state_groups_state(read_conn, sg_id_list):
+    logger.debug('')
+    logger.debug(f"Checking {sg_id} {event_type} {state_key} {event_id}")
+    logger.debug('')
+    event_id = events.intern(event_id)
+    pair_id = pairs.intern((event_type, state_key))
+    type_dict[event_id] = pair_id
+
+    def handle_last_sg(state_set):
+        index = index_of[last_sg_id]
+        state_groups[last_sg_id] = sg
+        logger.debug(f"Handling sg {last_sg_id}")
+        logger.debug(f"prev_edges[{last_sg_id}] = { prev_edges.get(last_sg_id, None) }")
+        for prev in prev_edges.get(last_sg_id, []):
+            logger.debug(f"next_edges[{prev}] = { next_edges.get(prev, None) }")
+
+        state_cache.advance(last_sg_id)
+        new_state_set = resolve_state(last_sg_id, prev_edges, get_sg_delta, state_cache)[1]
+
+        (new_ids, gone_ids) = state_set.diff(new_state_set)
+        logger.debug(f"new_ids {new_ids}")
+        logger.debug(f"gone_ids {gone_ids}")
+        for id in new_ids.tolist():
+            add_state(index, last_sg_id, id)
+        for id in gone_ids.tolist():
+            mark_state_as_gone(index, last_sg_id, id)
+        return new_state_set
+
+    # build up the event IDs in this state group
+    if sg_id == last_sg_id:
+        sg[pair_id] = event_id
+        continue
+    else:
+        if last_sg_id is not None:
+            state_set = handle_last_sg(state_set)
+
+        # get going on the new sg
+        last_sg_id = sg_id
+        sg = { pair_id: event_id }
 
 # flush the last sg
-handle_last_sg(state_set, index)
+handle_last_sg(state_set)
+
+state_cache.log_stats()
 
 # finally, dump the state table to the DB.
 dump_state()
+
+# and record the respaced labels as the ordering, if we had to respace it
+if respace:
+    write_ordering(cursor, sg_id_list)
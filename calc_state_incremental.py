@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import psycopg2
+import logging
+import sys
+import time
+import numpy as np
+from minhashing import minhasher, permute, to_s32, lsh_bands
+from ordering import label_of, next_label, last_label, live_rows, make_room, splice_in
+
+# Keeps the state table up to date as new SGs get appended to a room, without recompressing it.
+#
+# calc_state.py (or calc_pipeline.py) leaves gaps between the indices of consecutive SGs, and records each
+# SG's index in minhashes.ordering (see ordering.py). Everything in minhashes is already placed; any
+# SG above the room's high-water mark (its highest sg_id in minhashes) is new. For each new SG, in sg_id
+# order, we:
+#  * derive its minhash from its prev's, folding in its delta (as calc_minhash.py does incrementally),
+#  * pick its nearest neighbour N: the best minhash match amongst its prev and the SGs it shares an LSH
+#    band with (ties going to its prev),
+#  * give it an index X halfway between N's index and the next one used (or label_spacing after the end,
+#    if N is the last SG), relabelling the SGs around N if there's no gap left after it,
+#  * and edit the state rows so that the state live at X is the new SG's: the events which aren't in its
+#    state get their rows cut short at X (and continued from the next index on, if they were live there),
+#    and its events which weren't live at N get a row from X to the next index (or extend the row
+#    starting there back to X), as per ordering.splice_in().
+# Nothing else moves, so placing an SG costs O(delta): when N is its prev, we only need the rows for the
+# (type, state_key)s in its delta. Otherwise we have to diff the full states of N and the new SG.
+#
+# Each SG is placed in its own transaction, so an interrupted run can just be rerun.
+#
+# N.B. the add_count & gone_count we record are relative to the new SG's prev, rather than to the SG before
+# it in sg_id order (as calc_minhash.py's are), as that would mean diffing full states every time. They only
+# differ where the DAG forks.
+#
+# This (plus the indexes in ordering.py) makes the stabbing queries cheap:
+# CREATE INDEX state_room_id_type_state_key_start_index_idx ON state (room_id, type, state_key, start_index);
+#
+# Usage: calc_state_incremental.py [room_id]
+
+DB_CONFIG = {
+    'database': 'test',
+}
+
+logger = logging.getLogger()
+
+#room_id = '!kxwQeJPhRigXSZrHqf:matrix.org'
+room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
+
+max_candidates = 1000 # LSH matches to consider as neighbours
+
+def fetch_delta(cursor, sg_id):
+    """The state rows of this SG itself, as { (type, state_key): event_id }"""
+    cursor.execute("SELECT type, state_key, event_id FROM state_groups_state WHERE state_group = %s", [sg_id])
+    return { (event_type, state_key): event_id for (event_type, state_key, event_id) in cursor.fetchall() }
+
+def fetch_prevs(cursor, sg_id):
+    cursor.execute("SELECT prev_state_group FROM state_group_edges WHERE state_group = %s", [sg_id])
+    return [ row[0] for row in cursor.fetchall() ]
+
+def minhash_row(cursor, sg_id):
+    """(ordering, minhash) of an SG which has already been placed, or None"""
+    cursor.execute("SELECT ordering, minhash FROM minhashes WHERE sg_id = %s", [sg_id])
+    row = cursor.fetchone()
+    return (row[0], np.array(row[1], dtype=np.int32)) if row else None
+
+def resolve_state(cursor, room_id, sg_id):
+    """The full state as of sg_id, as { (type, state_key): event_id }: from the state table if it has
+    already been placed, or from its ancestors otherwise"""
+    placed = minhash_row(cursor, sg_id)
+    if placed is not None:
+        return { pair: row[0] for (pair, row) in live_rows(cursor, room_id, placed[0]).items() }
+    state = {}
+    for prev_id in fetch_prevs(cursor, sg_id):
+        state |= resolve_state(cursor, room_id, prev_id)
+    state |= fetch_delta(cursor, sg_id)
+    return state
+
+def derive_signature(prev_minhash, added, removed, full_state):
+    """The unsigned minhash of the prev's state plus added minus removed (as lists of event_ids). Additions
+    fold in with an elementwise min; if a removed event held the min of any slot we have to recalculate
+    from scratch over full_state()."""
+    sig = (prev_minhash.astype(np.int64) + 2**31).astype(np.uint64)
+    if removed and (permute(minhasher.hash_events(removed)) == sig).any():
+        return minhasher.signature(list(full_state().values()))
+    if added:
+        sig = np.minimum(sig, permute(minhasher.hash_events(added)).min(axis=0))
+    return sig
+
+def place_sg(cursor, room_id, sg_id, delta):
+    """Works out where the new SG goes, and updates the state rows around it. Returns whether it was
+    appended after the last SG (rather than inserted between two)."""
+    prevs = fetch_prevs(cursor, sg_id)
+    prev = minhash_row(cursor, prevs[0]) if len(prevs) == 1 else None
+    full_state = None
+
+    if prev is not None:
+        # the common case: derive the new SG from its prev, just looking at the pairs in its delta
+        prev_rows = live_rows(cursor, room_id, prev[0], delta.keys())
+        added = [ event_id for (pair, event_id) in delta.items() if pair not in prev_rows or prev_rows[pair][0] != event_id ]
+        removed = [ row[0] for (pair, row) in prev_rows.items() if row[0] != delta[pair] ]
+
+        def get_full_state():
+            nonlocal full_state
+            if full_state is None:
+                full_state = resolve_state(cursor, room_id, prevs[0]) | delta
+            return full_state
+
+        sig = derive_signature(prev[1], added, removed, get_full_state)
+        (add_count, gone_count) = (len(added), len(removed))
+    else:
+        # a root, or a merge, or a prev which was never placed
+        full_state = {}
+        for prev_id in prevs:
+            full_state |= resolve_state(cursor, room_id, prev_id)
+        full_state |= delta
+        sig = minhasher.signature(list(full_state.values()))
+        (add_count, gone_count) = (len(full_state), 0)
+
+    minhash = to_s32(sig)
+    bands = lsh_bands(minhash)
+
+    # find the nearest neighbour amongst the LSH matches and the prev
+    cursor.execute("""
+        SELECT sg_id, ordering, minhash FROM minhashes WHERE room_id = %s AND lsh_bands && %s::int4[] LIMIT %s
+    """, [room_id, bands.tolist(), max_candidates])
+    candidates = { row[0]: (row[1], np.array(row[2], dtype=np.int32)) for row in cursor.fetchall() }
+    if prev is not None:
+        candidates[prevs[0]] = prev
+    if candidates:
+        neighbour = max(candidates, key=lambda c: (np.count_nonzero(candidates[c][1] == minhash), prev is not None and c == prevs[0]))
+        neighbour_index = candidates[neighbour][0]
+    else:
+        # nothing similar, so append after the last SG
+        (neighbour_index, neighbour) = last_label(cursor, room_id)
+    appended = next_label(cursor, room_id, neighbour_index) is None
+    [index] = make_room(cursor, room_id, neighbour_index, 1)
+    # N.B. making room may have relabelled the neighbour
+    neighbour_index = label_of(cursor, neighbour)
+
+    # diff the new SG's state against the neighbour's
+    if prev is not None and neighbour == prevs[0]:
+        prev_rows = live_rows(cursor, room_id, neighbour_index, delta.keys())
+        gone_rows = [ row for (pair, row) in prev_rows.items() if row[0] != delta[pair] ]
+        new_events = [ (pair, delta[pair]) for pair in delta if pair not in prev_rows or prev_rows[pair][0] != delta[pair] ]
+    else:
+        if full_state is None:
+            full_state = resolve_state(cursor, room_id, prevs[0]) | delta
+        neighbour_rows = live_rows(cursor, room_id, neighbour_index)
+        gone_rows = [ row for (pair, row) in neighbour_rows.items() if full_state.get(pair) != row[0] ]
+        new_events = [ (pair, event_id) for (pair, event_id) in full_state.items() if pair not in neighbour_rows or neighbour_rows[pair][0] != event_id ]
+    splice_in(cursor, room_id, sg_id, index, gone_rows, new_events)
+
+    cursor.execute("""
+        INSERT INTO minhashes (sg_id, room_id, minhash, lsh_bands, add_count, gone_count, ordering)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, [sg_id, room_id, minhash.tolist(), bands.tolist(), add_count, gone_count, index])
+    logger.debug(f"placed {sg_id} at {index} after {neighbour}: {len(new_events)} added, {len(gone_rows)} gone")
+    return appended
+
+def extend_room(room_id, conn=None):
+    """Places every SG above the room's high-water mark. Returns a summary of what it did."""
+    opened = conn is None
+    if opened:
+        conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        return _extend_room(room_id, conn)
+    finally:
+        if opened:
+            conn.close()
+
+def _extend_room(room_id, conn):
+    start = time.time()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT max(sg_id) FROM minhashes WHERE room_id = %s", [room_id])
+        high_water = cursor.fetchone()[0]
+        if high_water is None:
+            raise RuntimeError(f"{room_id} has never been compressed; run calc_pipeline.py on it first")
+        cursor.execute("SELECT id FROM state_groups WHERE room_id = %s AND id > %s ORDER BY id", [room_id, high_water])
+        sg_ids = [ row[0] for row in cursor.fetchall() ]
+    logger.info(f"placing {len(sg_ids)} new SGs above {high_water}")
+
+    placed = 0
+    appended = 0
+    for sg_id in sg_ids:
+        with conn:
+            cursor = conn.cursor()
+            delta = fetch_delta(cursor, sg_id)
+            if not delta:
+                # as per calc_minhash.py, SGs with no state rows of their own don't get placed
+                continue
+            appended += place_sg(cursor, room_id, sg_id, delta)
+            placed += 1
+
+    logger.info(f"placed {placed} SGs ({appended} appended at the end) in {time.time() - start:.1f}s")
+    return { 'room_id': room_id, 'sgs': placed, 'appended': appended, 'seconds': time.time() - start }
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    extend_room(sys.argv[1] if len(sys.argv) > 1 else room_id)
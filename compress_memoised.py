@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 import psycopg2
-from psycopg2.extras import execute_values
 import logging
 import tracemalloc
 import gc
 import sys
+from copy_writer import CopyWriter
 
 # tracemalloc.start()
 
@@ -68,29 +68,35 @@ room_id = '!kxwQeJPhRigXSZrHqf:matrix.org'
 conn = psycopg2.connect(**DB_CONFIG)
 conn.set_session(autocommit=True)
 
-state_table = []
-lifetimes = {} # event_id -> ( start_sg, end_sg )
+# rows get streamed into the mstate table as soon as they're complete (i.e. once the event has gone
+# from the state set, or at the end for the ones still in the current state), so we only have to
+# hold the currently open rows in RAM.
+state_writer = CopyWriter(
+    conn,
+    'mstate',
+    ['start_sg_id', 'end_sg_id', 'event_id', 'room_id', 'type', 'state_key'],
+    types=['int8', 'int8', 'text', 'text', 'text', 'text'],
+    format='binary',
+)
+lifetimes = {} # event_id -> the open row for that event
 
 def add_state(sg_id, event_id, event_type, state_key):
     logger.debug(f"adding {sg_id} {event_id} {event_type} {state_key}")
     row = [sg_id, None, event_id, room_id, event_type, state_key]
-    state_table.append(row)
     lifetimes[event_id] = row
 
 def mark_state_as_gone(last_sg_id, event_id):
     logger.debug(f"marking {event_id} as gone in {last_sg_id}")
-    row = lifetimes[event_id]
+    row = lifetimes.pop(event_id)
     row[1] = last_sg_id
+    state_writer.write(row)
 
 def dump_state():
-    c = conn.cursor()
-    execute_values(
-        c,
-        "INSERT INTO mstate (start_sg_id, end_sg_id, event_id, room_id, type, state_key) VALUES %s",
-        state_table,
-        page_size=1000,
-    )
-    c.close()
+    # write out the rows which are still in the current state
+    for row in lifetimes.values():
+        state_writer.write(row)
+    lifetimes.clear()
+    state_writer.close()
 
 cursor = conn.cursor()
 
@@ -6,8 +6,7 @@ import logging
 import tracemalloc
 import gc
 import sys
-import numpy as np
-from datasketch import MinHashLSH, MinHash
+from minhashing import calc_minhash, lsh_bands
 
 # tracemalloc.start()
 
@@ -77,9 +76,9 @@ conn.set_session(autocommit=True)
 state_table = []
 lifetimes = {} # event_id -> ( start_sg, end_sg )
 
-def add_state(sg_id, event_id, event_type, state_key, minhash, add_count, gone_count):
+def add_state(sg_id, event_id, event_type, state_key, minhash, bands, add_count, gone_count):
     logger.debug(f"adding {sg_id} {event_id} {event_type} {state_key} {minhash} {add_count} {gone_count}")
-    row = [sg_id, None, event_id, room_id, event_type, state_key, minhash, add_count, gone_count]
+    row = [sg_id, None, event_id, room_id, event_type, state_key, minhash, bands, add_count, gone_count]
     state_table.append(row)
     lifetimes[event_id] = row
 
@@ -92,34 +91,11 @@ def dump_state():
     c = conn.cursor()
     execute_values(
         c,
-        "INSERT INTO mhstate (start_sg_id, end_sg_id, event_id, room_id, type, state_key, minhash, add_count, gone_count) VALUES %s",
+        "INSERT INTO mhstate (start_sg_id, end_sg_id, event_id, room_id, type, state_key, minhash, lsh_bands, add_count, gone_count) VALUES %s",
         state_table,
         page_size=1000,
     )
 
-    # FIXME: lots of scope for memoizing obviously
-    c.execute("""
-    UPDATE mhstate
-    SET lsh_bands = ARRAY[
-        hash_array(minhash[1:8]),
-        hash_array(minhash[9:16]),
-        hash_array(minhash[17:24]),
-        hash_array(minhash[25:32]),
-        hash_array(minhash[33:40]),
-        hash_array(minhash[41:48]),
-        hash_array(minhash[49:56]),
-        hash_array(minhash[57:64]),
-        hash_array(minhash[65:72]),
-        hash_array(minhash[73:80]),
-        hash_array(minhash[81:88]),
-        hash_array(minhash[89:96]),
-        hash_array(minhash[97:104]),
-        hash_array(minhash[105:112]),
-        hash_array(minhash[113:120]),
-        hash_array(minhash[121:128])
-    ];
-    """)
-
     # we can visualise the LSH bands with:
     # select start_sg_id, end_sg_id, left(event_id,16), left(type,16), left(state_key,32), array(select lpad(to_hex(x), 8, '0') from unnest(lsh_bands) as x) from mhstate order by start_sg_id;
     #
@@ -260,18 +236,15 @@ for i in range(0, len(sg_id_list), batch_size):
 
             logger.debug(f"len(new_state_set)={len(new_state_set)} len(state_set)={len(state_set)}")
 
-            mh = MinHash()
-            for e in new_state_set:
-                mh.update(e.encode('utf8'))
-            minhash = mh.hashvalues.astype(np.int64)
-            minhash_s32 = ((minhash % (2**32)) - 2**31).astype(np.int32).tolist()
+            minhash_s32 = calc_minhash(new_state_set)
+            bands = lsh_bands(minhash_s32).tolist()
             add_count = len(new_ids)
             gone_count = len(gone_ids) + last_gone_count
             #logger.debug(f"calculated minhash {minhash}")
 
             for id in new_ids:
                 (et, esk) = type_dict[id]
-                add_state(last_sg_id, id, et, esk, minhash_s32, add_count, gone_count)
+                add_state(last_sg_id, id, et, esk, minhash_s32, bands, add_count, gone_count)
             for id in gone_ids:
                 mark_state_as_gone(last_sg_id, id)
 
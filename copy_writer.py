@@ -0,0 +1,135 @@
+import io
+import struct
+import logging
+
+# A shared output sink which streams rows into postgres via COPY ... FROM STDIN as they're produced,
+# rather than buffering the whole output table in RAM and pushing it through execute_values at the
+# very end. Rows are buffered up to buffer_size and then flushed as one COPY, so memory use is
+# bounded, and (given we run with autocommit) everything flushed so far survives a failure.
+#
+# Usage:
+#
+#   writer = CopyWriter(conn, 'minhashes', ['sg_id', 'room_id', 'minhash'], types=['int8', 'text', 'int4[]'])
+#   writer.write([sg_id, room_id, minhash])
+#   ...
+#   writer.close()
+#
+# format='binary' needs the postgres type of each column (one of the keys of _binary_encoders, with
+# a [] suffix for arrays), which must match the table exactly. format='csv' just needs the columns.
+
+logger = logging.getLogger()
+
+_binary_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_binary_trailer = struct.pack('>h', -1)
+
+_binary_encoders = {
+    # type: (element oid, encoder)
+    'int2': (21, lambda v: struct.pack('>h', v)),
+    'int4': (23, lambda v: struct.pack('>i', v)),
+    'int8': (20, lambda v: struct.pack('>q', v)),
+    'float8': (701, lambda v: struct.pack('>d', v)),
+    'bool': (16, lambda v: b'\x01' if v else b'\x00'),
+    'text': (25, lambda v: v.encode('utf8')),
+}
+
+def _encode_binary_field(value, type):
+    if value is None:
+        return struct.pack('>i', -1)
+
+    if type.endswith('[]'):
+        (oid, encode) = _binary_encoders[type[:-2]]
+        if len(value) == 0:
+            data = struct.pack('>iii', 0, 0, oid)
+        else:
+            has_null = any(v is None for v in value)
+            parts = [struct.pack('>iiiii', 1, 1 if has_null else 0, oid, len(value), 1)]
+            for v in value:
+                if v is None:
+                    parts.append(struct.pack('>i', -1))
+                else:
+                    d = encode(v)
+                    parts.append(struct.pack('>i', len(d)))
+                    parts.append(d)
+            data = b''.join(parts)
+    else:
+        (oid, encode) = _binary_encoders[type]
+        data = encode(value)
+
+    return struct.pack('>i', len(data)) + data
+
+def _encode_csv_field(value):
+    # N.B. we quote all strings, so that an empty string (e.g. most state_keys) doesn't get confused
+    # with an unquoted empty field, which COPY treats as NULL.
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        # only really intended for integer arrays
+        return '"{' + ','.join('NULL' if v is None else str(v) for v in value) + '}"'
+    return str(value)
+
+class CopyWriter:
+    def __init__(self, conn, table, columns, types=None, format='csv', buffer_size=10000):
+        if format == 'binary' and (types is None or len(types) != len(columns)):
+            raise ValueError("binary COPY needs the postgres type of every column")
+        if format not in ('binary', 'csv'):
+            raise ValueError(f"unknown COPY format {format}")
+
+        self.conn = conn
+        self.table = table
+        self.columns = columns
+        self.types = types
+        self.format = format
+        self.buffer_size = buffer_size
+        self.sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT {format})"
+
+        self.buffer = []
+        self.rows_written = 0
+
+    def write(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        if self.format == 'binary':
+            types = self.types
+            ncols = struct.pack('>h', len(self.columns))
+            data = io.BytesIO()
+            data.write(_binary_header)
+            for row in self.buffer:
+                data.write(ncols)
+                for value, type in zip(row, types):
+                    data.write(_encode_binary_field(value, type))
+            data.write(_binary_trailer)
+        else:
+            data = io.StringIO()
+            for row in self.buffer:
+                data.write(','.join(_encode_csv_field(value) for value in row))
+                data.write('\n')
+        data.seek(0)
+
+        c = self.conn.cursor()
+        c.copy_expert(self.sql, data)
+        c.close()
+
+        self.rows_written += len(self.buffer)
+        logger.debug(f"copied {len(self.buffer)} rows into {self.table} ({self.rows_written} so far)")
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        logger.info(f"copied {self.rows_written} rows into {self.table}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # flush what we have even on failure, so that the work so far isn't lost
+        self.close()
@@ -0,0 +1,162 @@
+import logging
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# Sparse k-nearest-neighbour candidate graphs, for ordering more nodes than fit in a dense N×N distance
+# matrix (e.g. every SG in a room: 82K for HQ, or 410K, rather than just the segments).
+#
+# Rather than comparing every pair of nodes, we use the LSH bands to find candidates: for each band, we
+# sort the nodes by their band value and pair up nodes within `window` places of each other in the same
+# bucket (so huge buckets of near-identical state don't blow up quadratically). We then calculate the real
+# distances for just those candidate pairs, and keep the k nearest neighbours of each node.
+#
+# To avoid islands:
+#  * nodes with fewer than k candidates (e.g. which share no band with anything) also get candidates via
+#    their individual minhash values (cf. the minhash fallback in calc_segmented_tsp's distance())
+#  * every node also gets an edge to the next one in the original (i.e. sg_id) order, so the graph is
+#    always connected, and always has a hamiltonian path for TSP solvers to find.
+#
+# The result is a CSR matrix of weights. N.B. as sparse graphs treat zero entries as missing edges, the
+# weights are distance + 1 (which doesn't change which spanning tree, arborescence or tour is optimal).
+
+logger = logging.getLogger()
+
+def _bucket_pairs(values, window):
+    """Pairs of row numbers (i, j) with equal values, within window places of each other in sorted order"""
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    pairs = []
+    for offset in range(1, window + 1):
+        same = np.flatnonzero(sorted_values[:-offset] == sorted_values[offset:])
+        pairs.append(np.stack([order[same], order[same + offset]]))
+    return np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), dtype=np.int64)
+
+def _candidates(src, dst, window):
+    """Candidate (src row, dst row) pairs which have the same value in some column of src and dst"""
+    n = len(src)
+    directed = dst is not src
+    pairs = []
+    for c in range(src.shape[1]):
+        if directed:
+            # interleave the two sides, so each src row lands next to the dst rows of its neighbours
+            values = np.concatenate([src[:, c], dst[:, c]]).astype(np.int64)
+            local = np.concatenate([np.arange(n), np.arange(len(dst))])
+            order = np.lexsort((local, values))
+            p = _bucket_pairs(values[order], window)
+            (i, j) = (order[p[0]], order[p[1]])
+            # keep the pairs with one end on each side, as (src, dst)
+            a = np.where(i < n, i, j)
+            b = np.where(i < n, j, i) - n
+            keep = (i < n) != (j < n)
+            p = np.stack([a[keep], b[keep]])
+        else:
+            p = _bucket_pairs(src[:, c], window)
+            p = np.concatenate([p, p[::-1]], axis=1)
+        pairs.append(p)
+    return np.concatenate(pairs, axis=1)
+
+def _overlaps(a, b, positional, chunk_bytes=64 * 1024 * 1024):
+    """Overlap between each pair of rows a[i] and b[i]"""
+    out = np.empty(len(a), dtype=np.int32)
+    chunk_size = max(1, chunk_bytes // (a.shape[1] * (1 if positional else a.shape[1])))
+    for i in range(0, len(a), chunk_size):
+        x = a[i:i + chunk_size]
+        y = b[i:i + chunk_size]
+        if positional:
+            out[i:i + chunk_size] = (x == y).sum(axis=1)
+        else:
+            # len(set(x) & set(y)), assuming the values within a row are distinct (true for LSH bands & minhashes, bar collisions)
+            out[i:i + chunk_size] = (x[:, :, np.newaxis] == y[:, np.newaxis, :]).any(axis=2).sum(axis=1)
+    return out
+
+def pair_distances(src_bands, src_minhashes, dst_bands, dst_minhashes, i, j, positional=False):
+    """The distance from src i to dst j for each pair, with the same LSH-then-minhash fallback semantics as
+    distance_matrix.segment_distances(). Without minhashes, it's just band_count - LSH overlap."""
+    band_count = src_bands.shape[1]
+    lsh_overlap = _overlaps(src_bands[i], dst_bands[j], positional)
+    if src_minhashes is None:
+        return band_count - lsh_overlap
+    num_perm = src_minhashes.shape[1]
+    distances = (band_count - lsh_overlap) * (num_perm // band_count)
+    fallback = np.flatnonzero(lsh_overlap == 0)
+    if len(fallback):
+        distances[fallback] = num_perm - _overlaps(src_minhashes[i[fallback]], dst_minhashes[j[fallback]], positional)
+    return distances
+
+def knn_graph(bands, minhashes, dst_bands=None, dst_minhashes=None, k=16, window=8, positional=False):
+    """Returns a sparse (N, M) CSR matrix of distance + 1 between each node and its k nearest neighbours.
+
+    If dst_bands & dst_minhashes are given, the graph is directed from the N rows of bands/minhashes
+    (e.g. segment ends) to the M rows of dst_bands/dst_minhashes (e.g. segment starts), where row i of
+    each is the same node, and each node keeps its k nearest outgoing and k nearest incoming edges.
+    Otherwise it's undirected (and symmetric) between the rows of bands/minhashes.
+
+    minhashes may be None, in which case there's no minhash fallback, and the distance is just
+    band_count - LSH overlap (as in calc_segmented_mst.py & calc_segmented_msa.py).
+    """
+    bands = np.asarray(bands, dtype=np.int32)
+    minhashes = None if minhashes is None else np.asarray(minhashes, dtype=np.int32)
+    directed = dst_bands is not None
+    if directed:
+        dst_bands = np.asarray(dst_bands, dtype=np.int32)
+        dst_minhashes = None if dst_minhashes is None else np.asarray(dst_minhashes, dtype=np.int32)
+    else:
+        (dst_bands, dst_minhashes) = (bands, minhashes)
+    n = len(bands)
+    if n < 2:
+        return csr_matrix((n, len(dst_bands)), dtype=np.int32)
+
+    pairs = _candidates(bands, dst_bands, window)
+    pairs = np.unique(pairs[:, pairs[0] != pairs[1]], axis=1)
+    logger.info(f"{pairs.shape[1]} LSH candidate pairs for {n} nodes")
+
+    # fall back to the minhashes for the nodes without enough LSH candidates (in either direction)
+    lonely_src = np.flatnonzero(np.bincount(pairs[0], minlength=n) < k)
+    lonely_dst = np.flatnonzero(np.bincount(pairs[1], minlength=len(dst_bands)) < k) if directed else lonely_src
+    if minhashes is not None and (len(lonely_src) or len(lonely_dst)):
+        logger.info(f"{len(np.union1d(lonely_src, lonely_dst))} nodes have fewer than {k} LSH candidates; falling back to minhashes")
+        fallback = _candidates(minhashes, dst_minhashes, window)
+        fallback = fallback[:, np.isin(fallback[0], lonely_src) | np.isin(fallback[1], lonely_dst)]
+        pairs = np.unique(np.concatenate([pairs, fallback[:, fallback[0] != fallback[1]]], axis=1), axis=1)
+    distances = pair_distances(bands, minhashes, dst_bands, dst_minhashes, pairs[0], pairs[1], positional)
+
+    # keep each node's k nearest neighbours (outgoing, plus incoming if directed)
+    keep = np.zeros(pairs.shape[1], dtype=bool)
+    for side in ((0, 1) if directed else (0,)):
+        order = np.lexsort((distances, pairs[side]))
+        nodes = pairs[side][order]
+        starts = np.searchsorted(nodes, nodes, side='left')
+        keep[order[np.arange(len(order)) - starts < k]] = True
+    (i, j, distances) = (pairs[0][keep], pairs[1][keep], distances[keep])
+    if not directed:
+        # as an undirected graph, keep an edge if it's in either end's top k
+        (i, j, distances) = (np.concatenate([i, j]), np.concatenate([j, i]), np.concatenate([distances, distances]))
+
+    # link each node to the next one in the original order, so there are no islands
+    chain_i = np.arange(n - 1)
+    chain_j = chain_i + 1
+    chain_distances = pair_distances(bands, minhashes, dst_bands, dst_minhashes, chain_i, chain_j, positional)
+    if directed:
+        (i, j, distances) = (np.concatenate([i, chain_i]), np.concatenate([j, chain_j]), np.concatenate([distances, chain_distances]))
+    else:
+        (i, j, distances) = (
+            np.concatenate([i, chain_i, chain_j]),
+            np.concatenate([j, chain_j, chain_i]),
+            np.concatenate([distances, chain_distances, chain_distances]),
+        )
+
+    # drop duplicate edges, as csr_matrix would sum them
+    (_, first) = np.unique(i * len(dst_bands) + j, return_index=True)
+    graph = csr_matrix((distances[first] + 1, (i[first], j[first])), shape=(n, len(dst_bands)))
+
+    logger.info(f"kNN graph has {graph.nnz} edges for {n} nodes (k={k})")
+    return graph
+
+def dense_distances(graph, missing):
+    """Turn a kNN graph back into a dense distance matrix, with the given distance for missing edges,
+    for solvers which need one (e.g. elkai)"""
+    distances = np.full(graph.shape, missing, dtype=np.int64)
+    coo = graph.tocoo()
+    distances[coo.row, coo.col] = coo.data - 1
+    np.fill_diagonal(distances, 0)
+    return distances
@@ -0,0 +1,148 @@
+import logging
+import time
+import numpy as np
+from numba import njit, prange
+
+# Parallel local search for improving asymmetric (i.e. directed) TSP tours, from any starting tour
+# (chronological, greedy nearest-neighbour, ACO output...), in the same style as aco.py's numba kernels.
+#
+# As the distances are asymmetric, we can't use 2-opt (which reverses part of the tour), so the only
+# move is the reversal-free 3-opt "segment exchange": cut the tour A B C D into A C B D, i.e. cut the
+# edges after positions i < j < k, and reconnect them as i -> j+1, k -> i+1 and j -> k+1. Or-opt (moving
+# a run of 1..3 nodes elsewhere) is the special case where B or C is short.
+#
+# Rather than trying every (i, j, k), we only consider new edges to each node's nearest neighbours:
+#  * 3-opt: i -> j+1 must be to one of tour[i]'s nearest successors, and k -> i+1 from one of tour[i+1]'s
+#    nearest predecessors.
+#  * Or-opt: the run starting at s gets inserted after one of tour[s]'s nearest predecessors.
+#
+# Each pass evaluates the best move for every position in parallel, and then applies as many of the
+# improving moves as don't overlap, best first. A move only rearranges positions i+1..k, so moves on
+# disjoint ranges don't affect each other. The edge from the end of the tour back to the start is never
+# cut, so we rotate the tour between passes.
+
+logger = logging.getLogger()
+
+def neighbour_lists(distances, k=10):
+    """Returns (successors, predecessors), each (N, k): the k nearest nodes to and from each node"""
+    d = np.array(distances, dtype=np.float64)
+    np.fill_diagonal(d, np.inf)
+    k = min(k, len(d) - 1)
+    successors = np.argsort(d, axis=1, kind='stable')[:, :k].astype(np.int32)
+    predecessors = np.argsort(d, axis=0, kind='stable')[:k, :].T.astype(np.int32)
+    return (successors, predecessors)
+
+@njit(nogil=True)
+def _exchange_gain(distances, tour, i, j, k):
+    return (
+        distances[tour[i], tour[i + 1]] + distances[tour[j], tour[j + 1]] + distances[tour[k], tour[k + 1]]
+        - distances[tour[i], tour[j + 1]] - distances[tour[k], tour[i + 1]] - distances[tour[j], tour[k + 1]]
+    )
+
+@njit(nogil=True, parallel=True)
+def _best_moves(distances, tour, pos, successors, predecessors, max_segment_length):
+    """For each position p, the best (gain, i, j, k) move found starting from p"""
+    n = len(tour)
+    gains = np.zeros(n, dtype=np.float64)
+    moves = np.zeros((n, 3), dtype=np.int64)
+    for p in prange(n - 1):
+        best_gain = 0.0
+        best_i = best_j = best_k = -1
+
+        # 3-opt, with i = p
+        for v in successors[tour[p]]:
+            j = pos[v] - 1
+            if j < p + 1:
+                continue
+            for u in predecessors[tour[p + 1]]:
+                k = pos[u]
+                if k < j + 1 or k > n - 2:
+                    continue
+                gain = _exchange_gain(distances, tour, p, j, k)
+                if gain > best_gain:
+                    best_gain = gain
+                    best_i, best_j, best_k = p, j, k
+
+        # Or-opt, moving the run starting at p to after one of tour[p]'s nearest predecessors
+        if p >= 1:
+            for length in range(1, max_segment_length + 1):
+                e = p + length - 1
+                if e > n - 2:
+                    break
+                for u in predecessors[tour[p]]:
+                    a = pos[u]
+                    if a > e and a <= n - 2:
+                        (x, y, z) = (p - 1, e, a) # move it forwards
+                    elif a < p - 1:
+                        (x, y, z) = (a, p - 1, e) # move it backwards
+                    else:
+                        continue
+                    gain = _exchange_gain(distances, tour, x, y, z)
+                    if gain > best_gain:
+                        best_gain = gain
+                        best_i, best_j, best_k = x, y, z
+
+        gains[p] = best_gain
+        moves[p, 0] = best_i
+        moves[p, 1] = best_j
+        moves[p, 2] = best_k
+    return gains, moves
+
+@njit(nogil=True)
+def _apply_moves(tour, gains, moves):
+    """Apply the non-overlapping improving moves, best first. Returns the total gain."""
+    n = len(tour)
+    used = np.zeros(n, dtype=np.bool_)
+    total_gain = 0.0
+    for p in np.argsort(-gains):
+        if gains[p] <= 0:
+            break
+        (i, j, k) = (moves[p, 0], moves[p, 1], moves[p, 2])
+        clash = False
+        for q in range(i, k + 2):
+            if used[q]:
+                clash = True
+                break
+        if clash:
+            continue
+        for q in range(i, k + 2):
+            used[q] = True
+        # A B C D -> A C B D
+        b = tour[i + 1:j + 1].copy()
+        c = tour[j + 1:k + 1].copy()
+        tour[i + 1:i + 1 + len(c)] = c
+        tour[i + 1 + len(c):k + 1] = b
+        total_gain += gains[p]
+    return total_gain
+
+def local_search(distances, tour, deadline=None, neighbours=10, max_segment_length=3, candidates=None, verbose=True):
+    """Improve a tour with parallel Or-opt and reversal-free 3-opt moves until convergence, or until the
+    deadline (a time.time()). candidates may be precomputed neighbour_lists(), for repeated calls on the
+    same distances. Returns the improved tour as an int32 array."""
+    tour = np.array(tour, dtype=np.int32)
+    n = len(tour)
+    if n < 4:
+        return tour
+
+    distances = np.asarray(distances)
+    (successors, predecessors) = candidates if candidates is not None else neighbour_lists(distances, neighbours)
+    pos = np.empty(n, dtype=np.int32)
+    quiet_passes = 0
+    passes = 0
+    total_gain = 0.0
+    while deadline is None or time.time() < deadline:
+        pos[tour] = np.arange(n, dtype=np.int32)
+        (gains, moves) = _best_moves(distances, tour, pos, successors, predecessors, max_segment_length)
+        gain = _apply_moves(tour, gains, moves)
+        total_gain += gain
+        passes += 1
+        # rotate, so the edge back to the start gets considered too. We only stop once a couple of
+        # passes (at different rotations) have found nothing.
+        tour = np.roll(tour, n // 3 + 1)
+        quiet_passes = quiet_passes + 1 if gain <= 0 else 0
+        if quiet_passes >= 2:
+            break
+
+    if verbose:
+        logger.info(f"local search: improved by {total_gain:.0f} in {passes} passes")
+    return tour
@@ -0,0 +1,110 @@
+import logging
+import numpy as np
+
+# An in-memory LSH index over a room's minhashes table, for finding the most similar SG to a given
+# one (e.g. branch points in calc_segmented_tsp.py) without a round trip to postgres per query.
+#
+# The equivalent SQL:
+#
+#   SELECT sg_id FROM minhashes
+#   WHERE lsh_bands && %s AND sg_id < %s AND room_id = %s
+#   ORDER BY jaccard_similarity(minhash, %s) DESC, sg_id DESC
+#   LIMIT 1;
+#
+# evaluates the jaccard_similarity SQL function row by row over every candidate, and took ~10 minutes
+# for 2,400 branch points. Here we load the whole room once, keep each band's values sorted (with the
+# rows they came from) so candidates are found by a binary search per band, and then score all the
+# candidates at once with a vectorised jaccard over their minhash arrays.
+#
+# The fallback, for when nothing shares a band, is the same query with `minhash && x` in place of
+# `lsh_bands && x`: candidates share any minhash value, in any position, and then get ranked by jaccard.
+#
+# N.B. `lsh_bands && x` matches a band value at any position, whereas we only match bands in the same
+# position (which is what LSH intends). They only differ on collisions between the 32-bit hashes of
+# different bands, which are vanishingly rare.
+
+logger = logging.getLogger()
+
+class LSHIndex:
+    def __init__(self, sg_ids, lsh_bands, minhashes):
+        order = np.argsort(sg_ids, kind='stable')
+        self.sg_ids = np.asarray(sg_ids, dtype=np.int64)[order]
+        self.lsh_bands = np.asarray(lsh_bands, dtype=np.int32)[order] # (n, band_count)
+        self.minhashes = np.asarray(minhashes, dtype=np.int32)[order] # (n, num_perm)
+
+        # band_rows[b] = row numbers sorted by their value of band b, and band_values[b] those values
+        self.band_rows = np.argsort(self.lsh_bands, axis=0, kind='stable').T.copy()
+        self.band_values = np.take_along_axis(self.lsh_bands, self.band_rows.T, axis=0).T.copy()
+
+    @classmethod
+    def load(cls, cursor, room_id):
+        """Load a room's minhashes table into an index"""
+        cursor.execute("SELECT sg_id, lsh_bands, minhash FROM minhashes WHERE room_id = %s ORDER BY sg_id", [room_id])
+        rows = cursor.fetchall()
+        logger.info(f"loaded {len(rows)} minhashes into LSH index")
+        if not rows:
+            return cls(np.zeros(0, dtype=np.int64), np.zeros((0, 16), dtype=np.int32), np.zeros((0, 128), dtype=np.int32))
+        return cls([ r[0] for r in rows ], [ r[1] for r in rows ], [ r[2] for r in rows ])
+
+    def __len__(self):
+        return len(self.sg_ids)
+
+    def row(self, sg_id):
+        i = int(np.searchsorted(self.sg_ids, sg_id))
+        if i == len(self.sg_ids) or self.sg_ids[i] != sg_id:
+            raise KeyError(sg_id)
+        return i
+
+    def bands_of(self, sg_id):
+        return self.lsh_bands[self.row(sg_id)].tolist()
+
+    def minhash_of(self, sg_id):
+        return self.minhashes[self.row(sg_id)].tolist()
+
+    def candidates(self, bands):
+        """Rows sharing at least one LSH band with the given bands"""
+        rows = []
+        for b, value in enumerate(bands):
+            values = self.band_values[b]
+            lo = np.searchsorted(values, value, side='left')
+            hi = np.searchsorted(values, value, side='right')
+            if hi > lo:
+                rows.append(self.band_rows[b][lo:hi])
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(rows))
+
+    def jaccard(self, rows, minhash):
+        """Estimated jaccard similarity of the given rows to a minhash, i.e. the fraction of matching positions"""
+        return (self.minhashes[rows] == np.asarray(minhash, dtype=np.int32)).mean(axis=1)
+
+    def _window(self, before, after):
+        lo = 0 if after is None else int(np.searchsorted(self.sg_ids, after, side='right'))
+        hi = len(self.sg_ids) if before is None else int(np.searchsorted(self.sg_ids, before, side='left'))
+        return (lo, hi)
+
+    def _best(self, rows, minhash, before, after):
+        if len(rows) == 0:
+            return None
+        scores = self.jaccard(rows, minhash)
+        best = rows[scores == scores.max()]
+        # ties go to the nearest SG in the direction we're looking, as per the sg_id DESC/ASC in the SQL
+        return int(self.sg_ids[best.max() if after is None else best.min()])
+
+    def best_match(self, bands, minhash, before=None, after=None):
+        """The most similar SG sharing an LSH band, looking only at sg_ids < before and/or > after.
+        Returns None if nothing shares a band."""
+        (lo, hi) = self._window(before, after)
+        rows = self.candidates(bands)
+        rows = rows[(rows >= lo) & (rows < hi)]
+        return self._best(rows, minhash, before, after)
+
+    def best_minhash_match(self, minhash, before=None, after=None):
+        """The fallback for when nothing shares an LSH band: the most similar SG sharing any minhash value
+        (in any position, as per `minhash && x`), looking only at sg_ids < before and/or > after."""
+        (lo, hi) = self._window(before, after)
+        rows = np.arange(lo, hi)
+        if len(rows) == 0:
+            return None
+        rows = rows[np.isin(self.minhashes[rows], np.asarray(minhash, dtype=np.int32)).any(axis=1)]
+        return self._best(rows, minhash, before, after)
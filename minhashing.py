@@ -0,0 +1,203 @@
+import hashlib
+import numpy as np
+
+# Shared minhash helpers for calc_minhash.py and friends.
+#
+# These live in their own module (rather than in the calc_* scripts, which do all their work
+# at import time) so that they can be safely imported by worker processes.
+#
+# Rather than calling datasketch's MinHash.update() once per event (rehashing every event of
+# every state set at every SG), we hash each event_id once into a base hash, cache it, and then
+# apply all 128 permutations to a whole state set as a single numpy matrix op.
+#
+# The signatures are bit-compatible with datasketch's original (pre-2.0, aka scheme='legacy')
+# MinHash with the default num_perm=128, seed=1 and sha1_hash32, which is what the existing
+# minhashes table was built with.
+
+num_perm = 128
+
+_mersenne_prime = np.uint64((1 << 61) - 1)
+_max_hash = np.uint64((1 << 32) - 1)
+
+def _init_permutations(num_perm, seed=1):
+    # as per datasketch's MinHash._init_permutations (for the legacy scheme)
+    gen = np.random.RandomState(seed)
+    return np.array([
+        (
+            gen.randint(1, _mersenne_prime, dtype=np.uint64),
+            gen.randint(0, _mersenne_prime, dtype=np.uint64),
+        ) for _ in range(num_perm)
+    ], dtype=np.uint64).T
+
+perm_a, perm_b = _init_permutations(num_perm)
+
+def base_hash(event_id):
+    """datasketch's sha1_hash32 of an event_id"""
+    return int.from_bytes(hashlib.sha1(event_id.encode('utf8')).digest()[:4], 'little')
+
+def permute(hvs):
+    """Apply all the permutations to an array of base hashes, returning an (n, num_perm) array"""
+    # N.B. a * hv deliberately wraps at 64 bits, exactly as datasketch's uint64 arithmetic does.
+    return ((hvs[:, np.newaxis] * perm_a + perm_b) % _mersenne_prime) & _max_hash
+
+def to_s32(minhash):
+    """Convert unsigned 32-bit minhash values to the signed ints we store in minhashes.minhash"""
+    return (minhash.astype(np.int64) - 2**31).astype(np.int32)
+
+# LSH bands: the minhash is split into lsh_band_count bands of lsh_band_width values each, and each band
+# is hashed down to a single signed 32-bit int (as stored in minhashes.lsh_bands).
+lsh_band_count = 16
+lsh_band_width = 8
+
+_fnv_offset = np.uint64(0xcbf29ce484222325)
+_fnv_prime = np.uint64(0x100000001b3)
+
+def lsh_bands(minhashes, band_count=lsh_band_count, band_width=lsh_band_width):
+    """Hash signed 32-bit minhashes of shape (..., num_perm) into LSH bands of shape (..., band_count)"""
+    minhashes = np.asarray(minhashes)
+    if band_count * band_width > minhashes.shape[-1]:
+        raise ValueError(f"{band_count} bands of {band_width} need at least {band_count * band_width} minhash values")
+
+    values = (minhashes[..., :band_count * band_width].astype(np.int64) & 0xFFFFFFFF).astype(np.uint64)
+    values = values.reshape(minhashes.shape[:-1] + (band_count, band_width))
+
+    # FNV-1a over the 32-bit values of each band (wrapping at 64 bits), all bands at once,
+    # followed by a murmur-style finalizer so that all the bits get mixed into the top 32.
+    h = np.full(values.shape[:-1], _fnv_offset, dtype=np.uint64)
+    for i in range(band_width):
+        h = (h ^ values[..., i]) * _fnv_prime
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xff51afd7ed558ccd)
+    h ^= h >> np.uint64(33)
+    return (h >> np.uint64(32)).astype(np.uint32).view(np.int32)
+
+class MinHasher:
+    """Batched minhash engine, caching the base hash of every event it has seen.
+
+    If given a SymbolTable of event_ids, it works in terms of the interned int IDs instead
+    of event_id strings, and the cache becomes a flat array indexed by ID.
+    """
+
+    def __init__(self, chunk_size=4096, symbols=None):
+        self.chunk_size = chunk_size # rows permuted at a time, to bound the size of the temporary matrix
+        self.symbols = symbols
+        if symbols is None:
+            self.base_hashes = {} # base_hashes[event_id] = sha1_hash32 of the event_id
+        else:
+            self.base_hashes = np.zeros(0, dtype=np.uint64) # base_hashes[id] = sha1_hash32 of the event_id
+            self.hashed = 0 # IDs below this have been hashed
+
+    def hash_events(self, event_ids):
+        if self.symbols is not None:
+            return self._hash_ids(event_ids)
+
+        base_hashes = self.base_hashes
+        hvs = np.empty(len(event_ids), dtype=np.uint64)
+        for i, e in enumerate(event_ids):
+            hv = base_hashes.get(e)
+            if hv is None:
+                hv = base_hashes[e] = base_hash(e)
+            hvs[i] = hv
+        return hvs
+
+    def _hash_ids(self, ids):
+        # symbol IDs are dense and handed out in order, so we just hash any new ones up to the latest
+        n = len(self.symbols)
+        if n > self.hashed:
+            if n > len(self.base_hashes):
+                grown = np.zeros(max(n, 2 * len(self.base_hashes)), dtype=np.uint64)
+                grown[:self.hashed] = self.base_hashes[:self.hashed]
+                self.base_hashes = grown
+            values = self.symbols.values
+            for id in range(self.hashed, n):
+                self.base_hashes[id] = base_hash(values[id])
+            self.hashed = n
+        return self.base_hashes[np.asarray(ids, dtype=np.int64)]
+
+    def signature(self, event_ids):
+        """Calculate the unsigned minhash signature of a set of event IDs"""
+        hvs = self.hash_events(event_ids)
+        sig = np.full(num_perm, _max_hash, dtype=np.uint64)
+        for i in range(0, len(hvs), self.chunk_size):
+            np.minimum(sig, permute(hvs[i:i + self.chunk_size]).min(axis=0), out=sig)
+        return sig
+
+def _as_list(ids):
+    # N.B. numpy arrays of interned IDs become lists of python ints, to keep dict lookups fast
+    return ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+
+class IncrementalMinHash:
+    """Maintains the minhash signature of a state set as events are added to and removed from it,
+    so that the cost per SG is proportional to the delta rather than the size of the state set.
+
+    Additions are folded in with an elementwise min. For removals, we track which event
+    (by base hash) holds the minimum in each slot, and only recalculate the slots whose
+    minimum was removed, over the surviving members. Each removed event holds ~num_perm / n
+    of the slots, so for big rooms with small deltas this is rarely needed at all.
+    """
+
+    def __init__(self, hasher=None):
+        self.hasher = hasher or minhasher
+        self.members = {} # members[event_id] = base hash, for each event in the set
+        self.sig = np.full(num_perm, _max_hash, dtype=np.uint64)
+        self.argmin = np.zeros(num_perm, dtype=np.uint64) # base hash of the event giving the min in each slot
+
+    def update(self, added_ids, removed_ids):
+        members = self.members
+
+        dirty = None
+        if len(removed_ids):
+            removed_hvs = np.array([ members.pop(e) for e in _as_list(removed_ids) ], dtype=np.uint64)
+            dirty = np.flatnonzero(np.isin(self.argmin, removed_hvs) & (self.sig != _max_hash))
+
+        if len(added_ids):
+            added_ids = _as_list(added_ids)
+            hvs = self.hasher.hash_events(added_ids)
+            for e, hv in zip(added_ids, hvs.tolist()):
+                members[e] = hv
+            phvs = permute(hvs)
+            rows = phvs.argmin(axis=0)
+            mins = phvs[rows, np.arange(num_perm)]
+            better = mins < self.sig
+            self.sig[better] = mins[better]
+            self.argmin[better] = hvs[rows[better]]
+
+        if dirty is not None and len(dirty):
+            self._recalc_slots(dirty)
+
+    def _recalc_slots(self, slots):
+        if not self.members:
+            self.sig[slots] = _max_hash
+            self.argmin[slots] = 0
+            return
+        hvs = np.fromiter(self.members.values(), dtype=np.uint64, count=len(self.members))
+        a = perm_a[slots]
+        b = perm_b[slots]
+        sig = np.full(len(slots), _max_hash, dtype=np.uint64)
+        argmin = np.zeros(len(slots), dtype=np.uint64)
+        chunk_size = self.hasher.chunk_size
+        for i in range(0, len(hvs), chunk_size):
+            chunk = hvs[i:i + chunk_size]
+            phvs = ((chunk[:, np.newaxis] * a + b) % _mersenne_prime) & _max_hash
+            rows = phvs.argmin(axis=0)
+            mins = phvs[rows, np.arange(len(slots))]
+            better = mins < sig
+            sig[better] = mins[better]
+            argmin[better] = chunk[rows[better]]
+        self.sig[slots] = sig
+        self.argmin[slots] = argmin
+
+    def signature(self):
+        """The current unsigned minhash signature (a copy, so it's safe to hang onto)"""
+        return self.sig.copy()
+
+# each process (including each pool worker) gets its own cache
+minhasher = MinHasher()
+
+def calc_minhash(event_ids):
+    """Calculate the 128-long minhash of a state set, as signed 32-bit ints (as stored in minhashes.minhash)"""
+    return to_s32(minhasher.signature(list(event_ids))).tolist()
+
+def calc_minhash_batch(batch):
+    """Worker entry point: takes a list of (sg_id, event_ids) and returns a list of (sg_id, minhash)"""
+    return [ (sg_id, calc_minhash(event_ids)) for (sg_id, event_ids) in batch ]
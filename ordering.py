@@ -0,0 +1,266 @@
+import logging
+from psycopg2.extras import execute_values
+
+# Gapped ordering labels, shared by the orderers (calc_segmented_tsp.py, aco.py, calc_pipeline.py),
+# calc_state.py and calc_state_incremental.py.
+#
+# Each SG's minhashes.ordering is also its index in the state table, and consecutive SGs' labels are
+# label_spacing apart, rather than dense. So an SG (or a run of them) can be spliced out of the order and
+# back in somewhere else by giving it labels in the gap it lands in: the only state rows which change
+# are the ones which start or end at the SGs being moved, and the ones which cross their new position and
+# differ there. When there's no gap left, make_room() respaces a window of the neighbouring labels, which
+# grows (doubling) until it's sparse enough, and only rewrites the labels (and the state rows which start
+# or end on them) within that window, as per the usual order-maintenance scheme.
+#
+# These make relabelling (and the stabbing queries) cheap:
+# CREATE INDEX minhashes_room_id_ordering_idx ON minhashes (room_id, ordering);
+# CREATE INDEX state_room_id_start_index_idx ON state (room_id, start_index);
+# CREATE INDEX state_room_id_end_index_idx ON state (room_id, end_index);
+#
+# N.B. state_lookup.py's GiST index on int8range(start_index, end_index) checks that start <= end on every
+# row update, so relabel() has to move both ends of a row in the same statement.
+
+logger = logging.getLogger()
+
+label_spacing = 1024 # gap between the labels of consecutive SGs, when laid out from scratch
+min_relabel_gap = 16 # the average gap a relabelled window must end up with
+
+def spaced_labels(n, start=0):
+    return [ start + i * label_spacing for i in range(n) ]
+
+def write_ordering(cursor, ordered_sg_ids):
+    """Label the given SGs in order, label_spacing apart"""
+    execute_values(
+        cursor,
+        "UPDATE minhashes SET ordering = data.o FROM (VALUES %s) AS data(o, sg_id) WHERE minhashes.sg_id = data.sg_id",
+        list(zip(spaced_labels(len(ordered_sg_ids)), ordered_sg_ids)),
+        template=None,
+        page_size=1000
+    )
+
+def label_of(cursor, sg_id):
+    cursor.execute("SELECT ordering FROM minhashes WHERE sg_id = %s", [sg_id])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def next_label(cursor, room_id, label):
+    """(label, sg_id) of the next SG after label (or the first, if label is None), or None"""
+    if label is None:
+        cursor.execute("SELECT ordering, sg_id FROM minhashes WHERE room_id = %s AND ordering IS NOT NULL ORDER BY ordering LIMIT 1", [room_id])
+    else:
+        cursor.execute("SELECT ordering, sg_id FROM minhashes WHERE room_id = %s AND ordering > %s ORDER BY ordering LIMIT 1", [room_id, label])
+    return cursor.fetchone()
+
+def prev_label(cursor, room_id, label):
+    """(label, sg_id) of the SG before label, or None"""
+    cursor.execute("SELECT ordering, sg_id FROM minhashes WHERE room_id = %s AND ordering < %s ORDER BY ordering DESC LIMIT 1", [room_id, label])
+    return cursor.fetchone()
+
+def last_label(cursor, room_id):
+    cursor.execute("SELECT ordering, sg_id FROM minhashes WHERE room_id = %s ORDER BY ordering DESC NULLS LAST LIMIT 1", [room_id])
+    return cursor.fetchone()
+
+def live_rows(cursor, room_id, index, pairs=None, event_ids=None):
+    """The state rows live at index (optionally just for the given (type, state_key)s or event_ids), as
+    { (type, state_key): (event_id, start_index, end_index, end_sg_id) }"""
+    sql = """
+        SELECT type, state_key, event_id, start_index, end_index, end_sg_id FROM state
+        WHERE room_id = %s AND start_index <= %s AND (end_index > %s OR end_index IS NULL)
+    """
+    args = [room_id, index, index]
+    if pairs is not None:
+        pairs = list(pairs)
+        sql += " AND (type, state_key) IN (SELECT * FROM unnest(%s::text[], %s::text[]))"
+        args += [[ p[0] for p in pairs ], [ p[1] for p in pairs ]]
+    if event_ids is not None:
+        sql += " AND event_id = ANY(%s)"
+        args.append(list(event_ids))
+    cursor.execute(sql, args)
+    return { (row[0], row[1]): row[2:] for row in cursor.fetchall() }
+
+def relabel(cursor, room_id, mapping):
+    """Apply [ (old_label, new_label) ] to minhashes.ordering and the state rows' indices. The new labels
+    must keep the same order, and not cross any label outside the mapping."""
+    rows = [ (room_id, old, new) for (old, new) in mapping if old != new ]
+    if not rows:
+        return
+    # N.B. each in a single statement, as the new labels may clash with old ones we haven't updated yet
+    execute_values(
+        cursor,
+        "UPDATE minhashes SET ordering = data.new FROM (VALUES %s) AS data(room_id, old, new) "
+        "WHERE minhashes.room_id = data.room_id AND minhashes.ordering = data.old",
+        rows,
+        template=None,
+        page_size=len(rows)
+    )
+    # and both ends of each state row at once, as a row must never have its new start_index with its old
+    # end_index (or vice versa): that could put start after end, which the int8range index in
+    # state_lookup.py rejects.
+    execute_values(
+        cursor,
+        """
+        WITH data(room_id, old, new) AS (VALUES %s),
+        touched AS (
+            SELECT s.room_id, s.event_id, s.start_index, s.end_index FROM state s
+            JOIN data d ON s.room_id = d.room_id AND s.start_index = d.old
+            UNION
+            SELECT s.room_id, s.event_id, s.start_index, s.end_index FROM state s
+            JOIN data d ON s.room_id = d.room_id AND s.end_index = d.old
+        )
+        UPDATE state SET
+            start_index = COALESCE(ds.new, state.start_index),
+            end_index = COALESCE(de.new, state.end_index)
+        FROM touched t
+        LEFT JOIN data ds ON ds.room_id = t.room_id AND ds.old = t.start_index
+        LEFT JOIN data de ON de.room_id = t.room_id AND de.old = t.end_index
+        WHERE state.room_id = t.room_id AND state.event_id = t.event_id AND state.start_index = t.start_index
+        """,
+        rows,
+        template=None,
+        page_size=len(rows)
+    )
+    logger.debug(f"relabelled {len(rows)} SGs in {room_id}")
+
+def make_room(cursor, room_id, after, count):
+    """Returns count increasing labels which fit between the label after (or the start, if None) and the
+    next one, relabelling the SGs around it if there isn't enough of a gap"""
+    succ = next_label(cursor, room_id, after)
+    if succ is None:
+        start = 0 if after is None else after + label_spacing
+        return spaced_labels(count, start)
+    if after is None:
+        return spaced_labels(count, succ[0] - count * label_spacing)
+    if succ[0] - after > count:
+        return [ after + (i + 1) * (succ[0] - after) // (count + 1) for i in range(count) ]
+
+    # find a window of labels around after which is sparse enough, doubling it each time
+    radius = max(count, 1)
+    while True:
+        cursor.execute("""
+            SELECT ordering FROM minhashes WHERE room_id = %s AND ordering <= %s ORDER BY ordering DESC LIMIT %s
+        """, [room_id, after, radius + 1])
+        before = [ row[0] for row in reversed(cursor.fetchall()) ]
+        cursor.execute("""
+            SELECT ordering FROM minhashes WHERE room_id = %s AND ordering > %s ORDER BY ordering LIMIT %s
+        """, [room_id, after, radius + 1])
+        following = [ row[0] for row in cursor.fetchall() ]
+
+        # the labels either side of the window stay put (or there's nothing there to get in the way)
+        if len(before) > radius:
+            left = before.pop(0)
+        else:
+            left = before[0] - label_spacing
+        if len(following) > radius:
+            right = following.pop()
+        else:
+            right = (following[-1] if following else after) + (len(before) + len(following) + count + 1) * max(label_spacing, min_relabel_gap)
+        items = len(before) + count + len(following)
+        if (right - left) // (items + 1) >= min_relabel_gap:
+            break
+        radius *= 2
+
+    labels = [ left + (i + 1) * (right - left) // (items + 1) for i in range(items) ]
+    relabel(cursor, room_id, list(zip(before + following, labels[:len(before)] + labels[len(before) + count:])))
+    logger.info(f"relabelled {len(before) + len(following)} SGs around {after} to make room for {count}")
+    return labels[len(before):len(before) + count]
+
+def splice_in(cursor, room_id, sg_id, index, gone_rows, new_events):
+    """Update the state rows for sg_id being put at index, given how its state differs from the state
+    at the label before index: gone_rows are the rows live there whose events aren't in its state, as
+    [ (event_id, start_index, end_index, end_sg_id) ], and new_events are the events in its state which
+    aren't live there, as [ ((type, state_key), event_id) ]. Doesn't touch minhashes."""
+    (succ_index, succ_sg_id) = next_label(cursor, room_id, index) or (None, None)
+    for (event_id, start_index, end_index, end_sg_id) in gone_rows:
+        cursor.execute("""
+            UPDATE state SET end_index = %s, end_sg_id = %s WHERE room_id = %s AND event_id = %s AND start_index = %s
+        """, [index, sg_id, room_id, event_id, start_index])
+        if succ_index is not None and (end_index is None or end_index > succ_index):
+            # it's still live after us, so carry on from the next SG
+            cursor.execute("""
+                INSERT INTO state (start_index, end_index, start_sg_id, end_sg_id, event_id, room_id, type, state_key)
+                SELECT %s, %s, %s, %s, event_id, room_id, type, state_key FROM state
+                WHERE room_id = %s AND event_id = %s AND start_index = %s
+            """, [succ_index, end_index, succ_sg_id, end_sg_id, room_id, event_id, start_index])
+
+    for ((event_type, state_key), event_id) in new_events:
+        if succ_index is not None:
+            # if it starts at the next SG, just start it at us instead
+            cursor.execute("""
+                UPDATE state SET start_index = %s, start_sg_id = %s WHERE room_id = %s AND event_id = %s AND start_index = %s
+            """, [index, sg_id, room_id, event_id, succ_index])
+            if cursor.rowcount:
+                continue
+        cursor.execute("""
+            INSERT INTO state (start_index, end_index, start_sg_id, end_sg_id, event_id, room_id, type, state_key)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, [index, succ_index, sg_id, succ_sg_id, event_id, room_id, event_type, state_key])
+
+def splice_out(cursor, room_id, sg_id):
+    """Take sg_id out of the order, updating just the state rows which start or end at it, and clearing
+    its label. Returns how its state differed from the SG before it, as ([ ((type, state_key), event_id) ]
+    added, [ event_id ] removed)."""
+    index = label_of(cursor, sg_id)
+    (succ_index, succ_sg_id) = next_label(cursor, room_id, index) or (None, None)
+
+    cursor.execute("SELECT event_id, type, state_key, end_index FROM state WHERE room_id = %s AND start_index = %s", [room_id, index])
+    starting = cursor.fetchall()
+    cursor.execute("SELECT event_id, start_index FROM state WHERE room_id = %s AND end_index = %s", [room_id, index])
+    ending = cursor.fetchall()
+
+    for (event_id, start_index) in ending:
+        # it's live again without us, up to the next SG (and beyond, if it was re-added there)
+        following = None
+        if succ_index is not None:
+            cursor.execute("""
+                DELETE FROM state WHERE room_id = %s AND event_id = %s AND start_index = %s RETURNING end_index, end_sg_id
+            """, [room_id, event_id, succ_index])
+            following = cursor.fetchone()
+        (end_index, end_sg_id) = following or (succ_index, succ_sg_id)
+        cursor.execute("""
+            UPDATE state SET end_index = %s, end_sg_id = %s WHERE room_id = %s AND event_id = %s AND start_index = %s
+        """, [end_index, end_sg_id, room_id, event_id, start_index])
+
+    for (event_id, event_type, state_key, end_index) in starting:
+        if succ_index is None or end_index == succ_index:
+            cursor.execute("DELETE FROM state WHERE room_id = %s AND event_id = %s AND start_index = %s", [room_id, event_id, index])
+        else:
+            cursor.execute("""
+                UPDATE state SET start_index = %s, start_sg_id = %s WHERE room_id = %s AND event_id = %s AND start_index = %s
+            """, [succ_index, succ_sg_id, room_id, event_id, index])
+
+    cursor.execute("UPDATE minhashes SET ordering = NULL WHERE sg_id = %s", [sg_id])
+    return ([ ((t, k), e) for (e, t, k, _) in starting ], [ e for (e, _) in ending ])
+
+def move_segment(cursor, room_id, sg_ids, after_sg_id=None):
+    """Move a run of consecutive SGs (in their current order) to just after after_sg_id (or to the start,
+    if None). Only the first SG's state has to be diffed in full against its new neighbour's; the rest keep
+    their deltas from the SG before them."""
+    labels = [ label_of(cursor, sg_id) for sg_id in sg_ids ]
+    cursor.execute("""
+        SELECT count(*) FROM minhashes WHERE room_id = %s AND ordering >= %s AND ordering <= %s
+    """, [room_id, labels[0], labels[-1]])
+    if labels != sorted(labels) or cursor.fetchone()[0] != len(sg_ids):
+        raise ValueError(f"{sg_ids[0]}..{sg_ids[-1]} aren't consecutive in the ordering")
+    if after_sg_id in sg_ids:
+        raise ValueError(f"can't move {sg_ids[0]}..{sg_ids[-1]} after one of its own SGs")
+
+    first_state = { pair: row[0] for (pair, row) in live_rows(cursor, room_id, labels[0]).items() }
+    # splice out backwards, so each SG's delta is relative to the SG before it in the run
+    deltas = [ splice_out(cursor, room_id, sg_id) for sg_id in reversed(sg_ids) ][::-1]
+
+    after = label_of(cursor, after_sg_id) if after_sg_id is not None else None
+    new_labels = make_room(cursor, room_id, after, len(sg_ids))
+    # N.B. making room may have relabelled the neighbour
+    after = label_of(cursor, after_sg_id) if after_sg_id is not None else None
+
+    neighbour_rows = live_rows(cursor, room_id, after) if after is not None else {}
+    gone_rows = [ row for (pair, row) in neighbour_rows.items() if first_state.get(pair) != row[0] ]
+    new_events = [ (pair, event_id) for (pair, event_id) in first_state.items() if pair not in neighbour_rows or neighbour_rows[pair][0] != event_id ]
+    for (i, sg_id) in enumerate(sg_ids):
+        if i > 0:
+            (new_events, removed) = deltas[i]
+            gone_rows = list(live_rows(cursor, room_id, new_labels[i - 1], event_ids=removed).values()) if removed else []
+        splice_in(cursor, room_id, sg_id, new_labels[i], gone_rows, new_events)
+        cursor.execute("UPDATE minhashes SET ordering = %s WHERE sg_id = %s", [new_labels[i], sg_id])
+    logger.info(f"moved {len(sg_ids)} SGs {sg_ids[0]}..{sg_ids[-1]} after {after_sg_id}")
+    return new_labels
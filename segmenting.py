@@ -0,0 +1,55 @@
+import logging
+import numpy as np
+
+# Cutting a room's SGs (in sg_id order) into the segments which the orderers then rearrange, as shared by
+# calc_segmented_tsp.py and calc_pipeline.py:
+#
+#  * we partition into sections whenever there is a jump, i.e. an SG whose add_count + gone_count exceeds
+#    jump_threshold starts a new section.
+#  * we find the branch points where each section ideally belongs, in terms of minhash proximity: the SG
+#    its start is closest to (looking only into the past), which we cut after, and the SG its end is
+#    closest to (looking only into the future, to avoid risk of loops), which we cut before. Each is the
+#    best LSH band match (see lsh_index.py), falling back to the best minhash match.
+#  * we also cut after the end of every section, and the segments are then the runs of SGs between cuts.
+
+logger = logging.getLogger()
+
+jump_threshold = 10 # start a new section when add_count + gone_count exceeds this
+
+def _branch_point(index, row, before=None, after=None):
+    sg_id = int(index.sg_ids[row])
+    match = index.best_match(index.lsh_bands[row], index.minhashes[row], before=before, after=after)
+    if match is None:
+        logger.debug(f"failed to find branch point for {sg_id} - fall back to minhashes")
+        match = index.best_minhash_match(index.minhashes[row], before=before, after=after)
+        if match is None:
+            logger.warning(f"failed to find {'start' if before is not None else 'end'} branch point for {sg_id} entirely")
+            return None
+    logger.debug(f"found {'start' if before is not None else 'end'} branch point {match} for {sg_id}")
+    return index.row(match)
+
+def find_segments(index, change_counts, jump_threshold=jump_threshold):
+    """Cuts the SGs of an LSHIndex into segments, given each one's add_count + gone_count (in the index's
+    sg_id order). Returns (starts, ends): the first and last row of each segment, in sg_id order."""
+    n = len(index)
+    jumps = np.flatnonzero(np.asarray(change_counts, dtype=np.int64) > jump_threshold)
+    section_starts = np.union1d([0], jumps)
+    section_ends = np.append(section_starts[1:] - 1, n - 1)
+
+    cut_after = set(section_ends.tolist())
+    for i, (start, end) in enumerate(zip(section_starts.tolist(), section_ends.tolist())):
+        if i > 0:
+            # closest start point - looking only into the past
+            row = _branch_point(index, start, before=index.sg_ids[start])
+            if row is not None:
+                cut_after.add(row)
+        if i < len(section_starts) - 1:
+            # closest end point - looking only into the future, to avoid risk of loops
+            row = _branch_point(index, end, after=index.sg_ids[end])
+            if row is not None and row > 0:
+                cut_after.add(row - 1)
+
+    ends = np.array(sorted(cut_after), dtype=np.int64)
+    starts = np.append([0], ends[:-1] + 1)
+    logger.info(f"{len(section_starts)} sections, {len(starts)} segments")
+    return (starts, ends)
@@ -0,0 +1,143 @@
+import heapq
+import logging
+from bisect import bisect_right
+from collections import OrderedDict
+
+# A bounded cache of resolved state sets for calc_state.py, which visits SGs out of (chronological)
+# order and so can't memoise by deleting SGs once their children are done, as calc_minhash.py does.
+#
+# Entries are whatever the caller resolves a SG to (in practice a (StateMap, StateBitmap) pair from
+# state_sets.py). As those share structure with their ancestors, a cached entry only really costs
+# the chunks its delta touched, so we can afford to keep a lot of them.
+#
+# By default it's a plain LRU. But calc_state.py knows its whole processing order up front (and the
+# DAG), so it can plan ahead: StateCache.planned() works out when each SG's state will next be
+# needed (as itself or as an ancestor of a later SG), and evicts the entry needed farthest in the
+# future (Belady's optimal policy) whenever the cache goes over its memory budget.
+
+logger = logging.getLogger()
+
+_never = float('inf')
+
+def plan_uses(sg_id_list, prev_edges):
+    """Returns { sg_id: [ positions in sg_id_list where its state is needed ] }, in ascending order.
+
+    A SG's state is needed at position t if it's sg_id_list[t] itself or any of its ancestors.
+    Synapse caps delta chains at 100 hops, so this is O(len(sg_id_list) * 100) at worst.
+    """
+    uses = {}
+    for (t, sg_id) in enumerate(sg_id_list):
+        seen = set()
+        todo = [sg_id]
+        while todo:
+            id = todo.pop()
+            if id in seen:
+                continue
+            seen.add(id)
+            uses.setdefault(id, []).append(t)
+            todo.extend(prev_edges.get(id, []))
+    return uses
+
+class StateCache:
+    """Cache of resolved state, bounded to max_entries SGs, and to max_bytes if sizes are given to put()"""
+
+    def __init__(self, max_entries=50000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # entries[sg_id] = resolved state, least recently used first
+        self.sizes = {} # sizes[sg_id] = approximate size of the entry in bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # when planned:
+        self.uses = None # uses[sg_id] = ascending positions at which the SG's state is needed
+        self.positions = None # positions[sg_id] = the position at which we process the SG
+        self.prev_edges = None
+        self.now = -1 # the position we're currently processing
+        self.next_use = {} # next_use[sg_id] = the next position > now at which a cached SG will be needed
+        self.heap = [] # (-next_use, sg_id), for finding the entry needed farthest in the future. may be stale.
+
+    @classmethod
+    def planned(cls, sg_id_list, prev_edges, max_bytes, max_entries=None):
+        """A cache which evicts by farthest next use, given the order in which SGs will be processed"""
+        cache = cls(max_entries or len(sg_id_list) + 1, max_bytes)
+        cache.uses = plan_uses(sg_id_list, prev_edges)
+        cache.positions = { sg_id: t for (t, sg_id) in enumerate(sg_id_list) }
+        cache.prev_edges = prev_edges
+        logger.info(f"planned state cache for {len(sg_id_list)} SGs ({sum(len(u) for u in cache.uses.values())} uses)")
+        return cache
+
+    def _schedule(self, sg_id):
+        uses = self.uses.get(sg_id, ())
+        i = bisect_right(uses, self.now)
+        next_use = uses[i] if i < len(uses) else _never
+        if self.next_use.get(sg_id) != next_use:
+            self.next_use[sg_id] = next_use
+            heapq.heappush(self.heap, (-next_use, sg_id))
+            if len(self.heap) > 4 * len(self.next_use) + 1024:
+                # throw away the stale heap items, to stop them piling up
+                self.heap = [ (-n, id) for (id, n) in self.next_use.items() ]
+                heapq.heapify(self.heap)
+
+    def advance(self, sg_id):
+        """Tell a planned cache that we're now processing sg_id, so the next uses of it and its
+        cached ancestors (which may not get looked up, if a nearer ancestor is cached) move on."""
+        if self.uses is None or sg_id not in self.positions:
+            return
+        self.now = self.positions[sg_id]
+        seen = set()
+        todo = [sg_id]
+        while todo:
+            id = todo.pop()
+            if id in seen:
+                continue
+            seen.add(id)
+            if id in self.entries:
+                self._schedule(id)
+            todo.extend(self.prev_edges.get(id, []))
+
+    def get(self, sg_id):
+        entry = self.entries.get(sg_id)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(sg_id)
+        return entry
+
+    def put(self, sg_id, entry, size=0):
+        if sg_id in self.entries:
+            self.bytes -= self.sizes[sg_id]
+        self.entries[sg_id] = entry
+        self.entries.move_to_end(sg_id)
+        self.sizes[sg_id] = size
+        self.bytes += size
+        if self.uses is not None:
+            self._schedule(sg_id)
+
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self._evict()
+
+    def _evict(self):
+        if self.uses is None:
+            (sg_id, _) = self.entries.popitem(last=False)
+        else:
+            while True:
+                (next_use, sg_id) = heapq.heappop(self.heap)
+                if sg_id in self.entries and self.next_use[sg_id] == -next_use:
+                    break
+            del self.entries[sg_id]
+            del self.next_use[sg_id]
+        self.bytes -= self.sizes.pop(sg_id)
+        self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def log_stats(self):
+        logger.info(
+            f"state cache: {len(self.entries)} entries ({self.bytes / 1024 / 1024:.1f}MB), "
+            f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+        )
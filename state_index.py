@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import psycopg2
+import bisect
+import logging
+import random
+import sys
+import time
+import numpy as np
+
+# An in-RAM index over a room's state rows, for serving "state as of sg_id X" without postgres.
+#
+# The rows are intervals [start_index, end_index) of event IDs, and a lookup is a stabbing query. We keep
+# them in a centered interval tree: each node has a center, and holds the intervals which contain it, both
+# sorted by start and sorted by end. The intervals entirely before the center go left, and the ones
+# entirely after it go right. To stab at X, walk down from the root: if X is before a node's center, its
+# intervals which contain X are the prefix of its by-start list which start at or before X (then go left);
+# otherwise they're the suffix of its by-end list which end after X (then go right). So each node costs a
+# binary search plus the intervals it returns, and with centers at the median start the tree is O(log n)
+# deep: O(log n + k) per lookup. Nodes with few enough intervals are left as leaves, which get scanned.
+#
+# It's all flattened into numpy arrays so it stays compact: the per-node lists are just (key, event ID)
+# pairs of int32s where the indices fit (a null end_index becomes the dtype's max), and event_ids and
+# (type, state_key)s are interned into StringPools (one blob plus offsets) rather than python strings.
+# Synthetic data the size of HQ (253K state rows, 78K events, 82K SGs) comes to ~8MB, over half of which is
+# the event_id strings, with stabbing queries taking ~0.1ms.
+#
+# Running this directly loads a room, checks it against state_lookup.py, and times lookups.
+#
+# Usage: state_index.py [room_id] [samples]
+
+DB_CONFIG = {
+    'database': 'test',
+}
+
+logger = logging.getLogger()
+
+#room_id = '!kxwQeJPhRigXSZrHqf:matrix.org'
+room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
+
+leaf_size = 64 # nodes with this many intervals or fewer aren't split any further
+
+def _compact_dtype(values):
+    """int32 if the values (plus a sentinel above them) fit, otherwise int64"""
+    info = np.iinfo(np.int32)
+    if len(values) == 0 or (values.min() > info.min and values.max() < info.max - 1):
+        return np.int32
+    return np.int64
+
+class StringPool:
+    """An immutable list of strings, stored as one utf8 blob and an array of offsets into it"""
+
+    def __init__(self, strings):
+        encoded = [ s.encode('utf8') for s in strings ]
+        self.blob = b''.join(encoded)
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int32 if len(self.blob) < 2**31 else np.int64)
+        np.cumsum([ len(e) for e in encoded ], out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode('utf8')
+
+    @property
+    def nbytes(self):
+        return len(self.blob) + self.offsets.nbytes
+
+class _SortedPool(StringPool):
+    """A StringPool of sorted strings, which can be searched"""
+
+    def index(self, s):
+        """The position of s in the pool, or None"""
+        i = bisect.bisect_left(self, s)
+        return i if i < len(self) and self[i] == s else None
+
+# (type, state_key) pairs go in a _SortedPool joined by a NUL, which can't appear in either
+_pair_separator = '\0'
+
+class StateIntervalIndex:
+    """A room's state rows, held in RAM for stabbing queries"""
+
+    def __init__(self, starts, ends, event_ids, event_strings, event_pairs, pairs, sg_ids=None, labels=None):
+        """starts, ends & event_ids describe the rows, as arrays (with ends of -1 for null). event_strings is a
+        StringPool of the event_ids, event_pairs the pair ID of each event, and pairs a _SortedPool of the pairs.
+        sg_ids & labels map SGs to indices (as sorted sg_ids, and their labels)."""
+        self.events = event_strings
+        self.event_pairs = event_pairs.astype(np.int32)
+        self.pairs = pairs
+        self.sg_ids = np.asarray(sg_ids if sg_ids is not None else [], dtype=np.int64)
+        self.labels = np.asarray(labels if labels is not None else [], dtype=np.int64)
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        finite = np.concatenate([starts, ends[ends >= 0]])
+        self.key_dtype = _compact_dtype(finite)
+        self.key_info = np.iinfo(self.key_dtype)
+        ends = np.where(ends < 0, self.key_info.max, ends)
+        self._build(starts.astype(self.key_dtype), ends.astype(self.key_dtype), np.asarray(event_ids, dtype=np.int32))
+
+    def _build(self, starts, ends, events):
+        n = len(starts)
+        centers = []
+        lefts = []
+        rights = []
+        bounds = [] # (offset, count) of each node's intervals in the flattened lists
+        is_leaf = []
+        start_keys = np.empty(n, dtype=self.key_dtype)
+        start_events = np.empty(n, dtype=np.int32)
+        end_keys = np.empty(n, dtype=self.key_dtype)
+        end_events = np.empty(n, dtype=np.int32)
+        offset = 0
+
+        def add_node(rows):
+            node = len(centers)
+            centers.append(0)
+            lefts.append(-1)
+            rights.append(-1)
+            bounds.append((0, 0))
+            is_leaf.append(False)
+            stack.append((node, rows))
+            return node
+
+        stack = []
+        add_node(np.arange(n))
+        while stack:
+            (node, rows) = stack.pop()
+            if len(rows) <= leaf_size:
+                # leaves keep both lists in start order, so they can be masked together
+                here = rows[np.argsort(starts[rows], kind='stable')]
+                left = right = np.empty(0, dtype=np.int64)
+                is_leaf[node] = True
+            else:
+                # the median start, which (as intervals aren't empty) at least one interval contains
+                center = np.partition(starts[rows], len(rows) // 2)[len(rows) // 2]
+                contains = (starts[rows] <= center) & (ends[rows] > center)
+                left = rows[~contains & (ends[rows] <= center)]
+                right = rows[~contains & (starts[rows] > center)]
+                here = rows[contains]
+                centers[node] = int(center)
+
+            count = len(here)
+            by_start = here if is_leaf[node] else here[np.argsort(starts[here], kind='stable')]
+            by_end = here if is_leaf[node] else here[np.argsort(ends[here], kind='stable')]
+            start_keys[offset:offset + count] = starts[by_start]
+            start_events[offset:offset + count] = events[by_start]
+            end_keys[offset:offset + count] = ends[by_end]
+            end_events[offset:offset + count] = events[by_end]
+            bounds[node] = (offset, count)
+            offset += count
+
+            if len(left):
+                lefts[node] = add_node(left)
+            if len(right):
+                rights[node] = add_node(right)
+
+        self.centers = np.array(centers, dtype=self.key_dtype)
+        self.children = np.array([lefts, rights], dtype=np.int32).T.copy()
+        self.bounds = np.array(bounds, dtype=np.int64)
+        self.is_leaf = np.array(is_leaf, dtype=bool)
+        (self.start_keys, self.start_events) = (start_keys, start_events)
+        (self.end_keys, self.end_events) = (end_keys, end_events)
+
+    @classmethod
+    def load(cls, cursor, room_id):
+        """Load a room's state rows, and its SGs' indices from minhashes.ordering"""
+        start = time.time()
+        cursor.execute("SELECT start_index, end_index, event_id, type, state_key FROM state WHERE room_id = %s", [room_id])
+        starts = []
+        ends = []
+        event_ids = []
+        events = {} # event_id -> (ID, pair)
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            for (start_index, end_index, event_id, event_type, state_key) in rows:
+                event = events.get(event_id)
+                if event is None:
+                    event = events[event_id] = (len(events), event_type + _pair_separator + state_key)
+                starts.append(start_index)
+                ends.append(-1 if end_index is None else end_index)
+                event_ids.append(event[0])
+
+        sorted_pairs = sorted({ pair for (_, pair) in events.values() })
+        pairs = _SortedPool(sorted_pairs)
+        pair_ids = { pair: i for (i, pair) in enumerate(sorted_pairs) }
+        event_strings = StringPool(events.keys())
+        event_pairs = np.fromiter((pair_ids[pair] for (_, pair) in events.values()), dtype=np.int32, count=len(events))
+        del events, pair_ids, sorted_pairs
+
+        cursor.execute("SELECT sg_id, ordering FROM minhashes WHERE room_id = %s AND ordering IS NOT NULL ORDER BY sg_id", [room_id])
+        sg_rows = cursor.fetchall()
+        index = cls(starts, ends, event_ids, event_strings, event_pairs, pairs,
+                    [ r[0] for r in sg_rows ], [ r[1] for r in sg_rows ])
+        logger.info(
+            f"loaded {len(starts)} state rows for {len(event_strings)} events and {len(sg_rows)} SGs of {room_id} "
+            f"in {time.time() - start:.1f}s, into {index.nbytes / 2**20:.1f}MB"
+        )
+        return index
+
+    @property
+    def nbytes(self):
+        arrays = (
+            self.centers, self.children, self.bounds, self.is_leaf,
+            self.start_keys, self.start_events, self.end_keys, self.end_events,
+            self.event_pairs, self.sg_ids, self.labels,
+        )
+        return sum(a.nbytes for a in arrays) + self.events.nbytes + self.pairs.nbytes
+
+    def index_of(self, sg_id):
+        """The index of sg_id in the state table, or None if it hasn't been placed"""
+        i = int(np.searchsorted(self.sg_ids, sg_id))
+        return int(self.labels[i]) if i < len(self.sg_ids) and self.sg_ids[i] == sg_id else None
+
+    def event_ids_at(self, index):
+        """The interned IDs of the events live at index, as an int32 array"""
+        # clamp into the key dtype; everything's indices (bar the null sentinel) lie strictly within it
+        x = min(max(int(index), int(self.key_info.min)), int(self.key_info.max) - 1)
+        found = []
+        node = 0 if len(self.centers) else -1
+        while node >= 0:
+            (offset, count) = self.bounds[node]
+            if self.is_leaf[node]:
+                keys = self.start_keys[offset:offset + count]
+                live = (keys <= x) & (self.end_keys[offset:offset + count] > x)
+                found.append(self.start_events[offset:offset + count][live])
+                break
+            center = self.centers[node]
+            if x < center:
+                i = np.searchsorted(self.start_keys[offset:offset + count], x, side='right')
+                found.append(self.start_events[offset:offset + i])
+                node = self.children[node, 0]
+            else:
+                i = np.searchsorted(self.end_keys[offset:offset + count], x, side='right')
+                found.append(self.end_events[offset + i:offset + count])
+                node = self.children[node, 1] if x > center else -1
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int32)
+
+    def state_at_index(self, index, pairs=None):
+        """The state live at index, as { (type, state_key): event_id }, optionally just for the given pairs"""
+        ids = self.event_ids_at(index)
+        if pairs is not None:
+            wanted = [ self.pairs.index(t + _pair_separator + k) for (t, k) in pairs ]
+            ids = ids[np.isin(self.event_pairs[ids], [ p for p in wanted if p is not None ])]
+        state = {}
+        for id in ids.tolist():
+            (event_type, state_key) = self.pairs[self.event_pairs[id]].split(_pair_separator, 1)
+            state[(event_type, state_key)] = self.events[id]
+        return state
+
+    def state_at(self, sg_id, pairs=None):
+        """The state as of sg_id, as { (type, state_key): event_id }, or None if it hasn't been placed"""
+        index = self.index_of(sg_id)
+        return None if index is None else self.state_at_index(index, pairs)
+
+if __name__ == "__main__":
+    from state_lookup import states_at
+
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.set_session(autocommit=True)
+    cursor = conn.cursor()
+    room = sys.argv[1] if len(sys.argv) > 1 else room_id
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    index = StateIntervalIndex.load(cursor, room)
+    sg_ids = random.Random(0).sample(index.sg_ids.tolist(), min(samples, len(index.sg_ids)))
+    expected = states_at(cursor, room, sg_ids)
+    start = time.perf_counter()
+    states = { sg_id: index.state_at(sg_id) for sg_id in sg_ids }
+    elapsed = time.perf_counter() - start
+    for sg_id in sg_ids:
+        if states[sg_id] != expected.get(sg_id, {}):
+            raise RuntimeError(f"state of {sg_id} disagrees with state_lookup.py")
+    logger.info(f"{len(sg_ids)} lookups agree with state_lookup.py, at {elapsed * 1000 / max(1, len(sg_ids)):.3f}ms each")
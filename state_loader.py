@@ -0,0 +1,39 @@
+import logging
+
+# Streams a room's state_groups_state rows out of postgres via a named server-side cursor, rather than
+# querying them in slices of 100 SGs and fetchall()ing each slice. This means one query for the
+# whole room, fetched prefetch rows per round trip, without materialising the result set in RAM.
+#
+# N.B. on an autocommit connection, named cursors have to be declared WITH HOLD, which makes
+# postgres materialise the whole result set server-side before the first fetch. So for real streaming,
+# pass a dedicated read connection which isn't in autocommit mode.
+
+logger = logging.getLogger()
+
+def stream_state_groups_state(conn, sg_ids, prefetch=20000, log_every=1000):
+    """Yields (sg_id, type, state_key, event_id) for the given SGs, grouped by SG in the order of sg_ids"""
+    c = conn.cursor(name='state_groups_state_stream', withhold=conn.autocommit)
+    c.itersize = prefetch
+    try:
+        # ordering by the position in sg_ids lets us stream in an arbitrary order (e.g. by minhashes.ordering)
+        # as well as by sg_id.
+        c.execute("""
+            SELECT state_group, type, state_key, event_id
+            FROM unnest(%s::bigint[]) WITH ORDINALITY AS o(sg_id, ord)
+            JOIN state_groups_state ON state_group = o.sg_id
+            ORDER BY o.ord
+        """, [list(sg_ids)])
+
+        last_sg_id = None
+        i = 0
+        for row in c:
+            if row[0] != last_sg_id:
+                if i % log_every == 0:
+                    logger.info(f"i={i}, (sg {row[0]})")
+                last_sg_id = row[0]
+                i += 1
+            yield row
+    finally:
+        c.close()
+        if not conn.autocommit:
+            conn.rollback()
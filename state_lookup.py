@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import psycopg2
+import logging
+import random
+import statistics
+import sys
+import time
+
+# Point-in-time state lookups over the temporal state table: the state as of an SG is the set of rows
+# live at its index, i.e. start_index <= X < end_index (with a null end_index meaning it's still current),
+# where X is the SG's minhashes.ordering (see ordering.py).
+#
+# states_at() looks up any number of SGs in one round trip, by joining them against minhashes and doing
+# a stabbing query per SG via a LATERAL subquery. There are two ways of indexing the stabbing query:
+#
+#  * 'range': a GiST index on int8range(start_index, end_index), queried with @>. int8range(x, NULL) is
+#    unbounded above, so the current state needs no special casing. With btree_gist available, room_id
+#    goes in the same index; otherwise the index covers every room's ranges (which all start at 0), so
+#    it's only a good idea for a single room.
+#  * 'partial': the UNION ALL from compress_memoised.py, of the rows which are still current (via a
+#    partial index on end_index IS NULL) and the ones which end after X.
+#
+# Running this directly benchmarks both, singly and in batches, against the recursive state_group_edges
+# query from compress.py (as synapse does today), and checks that they all agree.
+#
+# CREATE EXTENSION btree_gist;
+# CREATE INDEX state_room_id_range_idx ON state USING GIST (room_id, int8range(start_index, end_index));
+# or without btree_gist:
+# CREATE INDEX state_range_idx ON state USING GIST (int8range(start_index, end_index));
+#
+# CREATE INDEX state_room_id_start_index_null_end_idx ON state (room_id, start_index) WHERE end_index IS NULL;
+# CREATE INDEX state_room_id_end_index_start_index_idx ON state (room_id, end_index, start_index) WHERE end_index IS NOT NULL;
+#
+# CREATE INDEX minhashes_sg_id_idx ON minhashes (sg_id);
+#
+# Usage: state_lookup.py [room_id] [samples]
+
+DB_CONFIG = {
+    'database': 'test',
+}
+
+logger = logging.getLogger()
+
+#room_id = '!kxwQeJPhRigXSZrHqf:matrix.org'
+room_id = '!OGEhHVWSdvArJzumhm:matrix.org'
+
+strategies = ('range', 'partial')
+
+# the stabbing query for the SG m, with {filter} for any extra conditions
+_stabbing_queries = {
+    'range': """
+        SELECT type, state_key, event_id FROM state
+        WHERE room_id = %(room_id)s AND int8range(start_index, end_index) @> m.ordering {filter}
+    """,
+    'partial': """
+        SELECT type, state_key, event_id FROM state
+        WHERE room_id = %(room_id)s AND end_index IS NULL AND start_index <= m.ordering {filter}
+        UNION ALL
+        SELECT type, state_key, event_id FROM state
+        WHERE room_id = %(room_id)s AND end_index > m.ordering AND start_index <= m.ordering {filter}
+    """,
+}
+
+def ensure_indexes(cursor, strategy):
+    """Create the indexes the given strategy needs, if they don't already exist"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS minhashes_sg_id_idx ON minhashes (sg_id)")
+    if strategy == 'range':
+        # N.B. this expects an autocommit connection, so a failure here doesn't abort anything else
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+            cursor.execute("CREATE INDEX IF NOT EXISTS state_room_id_range_idx ON state USING GIST (room_id, int8range(start_index, end_index))")
+        except psycopg2.Error as e:
+            logger.warning(f"no btree_gist ({str(e).strip().splitlines()[0]}), so indexing the ranges alone")
+            cursor.execute("CREATE INDEX IF NOT EXISTS state_range_idx ON state USING GIST (int8range(start_index, end_index))")
+    elif strategy == 'partial':
+        cursor.execute("CREATE INDEX IF NOT EXISTS state_room_id_start_index_null_end_idx ON state (room_id, start_index) WHERE end_index IS NULL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS state_room_id_end_index_start_index_idx ON state (room_id, end_index, start_index) WHERE end_index IS NOT NULL")
+    else:
+        raise ValueError(f"unknown strategy {strategy}; pick one of {strategies}")
+    cursor.execute("ANALYZE state")
+    cursor.execute("ANALYZE minhashes")
+
+def states_at(cursor, room_id, sg_ids, strategy='range', pairs=None):
+    """The state as of each of the given SGs, as { sg_id: { (type, state_key): event_id } }, in a single
+    query. If pairs is given, only those (type, state_key)s are returned. SGs which haven't been placed
+    in the state table are missing from the result."""
+    args = { 'room_id': room_id, 'sg_ids': list(sg_ids) }
+    filter = ""
+    if pairs is not None:
+        pairs = list(pairs)
+        filter = "AND (type, state_key) IN (SELECT * FROM unnest(%(types)s::text[], %(state_keys)s::text[]))"
+        args['types'] = [ p[0] for p in pairs ]
+        args['state_keys'] = [ p[1] for p in pairs ]
+    cursor.execute(f"""
+        SELECT m.sg_id, s.type, s.state_key, s.event_id
+        FROM minhashes m CROSS JOIN LATERAL ({_stabbing_queries[strategy].format(filter=filter)}) s
+        WHERE m.room_id = %(room_id)s AND m.sg_id = ANY(%(sg_ids)s) AND m.ordering IS NOT NULL
+    """, args)
+    states = {}
+    for (sg_id, event_type, state_key, event_id) in cursor.fetchall():
+        states.setdefault(sg_id, {})[(event_type, state_key)] = event_id
+    return states
+
+def state_at(cursor, room_id, sg_id, strategy='range', pairs=None):
+    """The state as of sg_id, as { (type, state_key): event_id }"""
+    return states_at(cursor, room_id, [sg_id], strategy, pairs).get(sg_id, {})
+
+def recursive_state_at(cursor, sg_id):
+    """The state as of sg_id from state_groups_state, walking state_group_edges as compress.py (and synapse) does"""
+    cursor.execute("""
+        WITH RECURSIVE sgs(state_group) AS (
+            VALUES(%s::bigint)
+            UNION ALL
+            SELECT prev_state_group FROM state_group_edges e, sgs s
+            WHERE s.state_group = e.state_group
+        )
+        SELECT DISTINCT ON (type, state_key)
+            type, state_key, event_id
+            FROM state_groups_state
+            WHERE state_group IN (
+                SELECT state_group FROM sgs
+            )
+            ORDER BY type, state_key, state_group DESC
+    """, [sg_id])
+    return { (event_type, state_key): event_id for (event_type, state_key, event_id) in cursor.fetchall() }
+
+def _time_ms(f):
+    start = time.perf_counter()
+    result = f()
+    return ((time.perf_counter() - start) * 1000, result)
+
+def benchmark(cursor, room_id, samples=200, batch_size=50, seed=0):
+    cursor.execute("SELECT sg_id FROM minhashes WHERE room_id = %s AND ordering IS NOT NULL", [room_id])
+    all_sg_ids = [ row[0] for row in cursor.fetchall() ]
+    sg_ids = random.Random(seed).sample(all_sg_ids, min(samples, len(all_sg_ids)))
+    logger.info(f"looking up {len(sg_ids)} of {len(all_sg_ids)} SGs in {room_id}")
+
+    timings = {}
+    results = {}
+    timings['recursive'] = []
+    for sg_id in sg_ids:
+        (ms, results[sg_id]) = _time_ms(lambda: recursive_state_at(cursor, sg_id))
+        timings['recursive'].append(ms)
+
+    for strategy in strategies:
+        ensure_indexes(cursor, strategy)
+        timings[strategy] = []
+        for sg_id in sg_ids:
+            (ms, state) = _time_ms(lambda: state_at(cursor, room_id, sg_id, strategy))
+            timings[strategy].append(ms)
+            if state != results[sg_id]:
+                raise RuntimeError(f"{strategy} lookup of {sg_id} disagrees with the recursive query")
+
+        timings[f"{strategy} batched"] = []
+        for i in range(0, len(sg_ids), batch_size):
+            batch = sg_ids[i:i + batch_size]
+            (ms, states) = _time_ms(lambda: states_at(cursor, room_id, batch, strategy))
+            timings[f"{strategy} batched"].extend([ ms / len(batch) ] * len(batch))
+            for sg_id in batch:
+                if states.get(sg_id, {}) != results[sg_id]:
+                    raise RuntimeError(f"batched {strategy} lookup of {sg_id} disagrees with the recursive query")
+
+    baseline = statistics.mean(timings['recursive'])
+    for (name, ms) in timings.items():
+        logger.info(
+            f"{name:>16}: mean {statistics.mean(ms):7.2f}ms, median {statistics.median(ms):7.2f}ms, "
+            f"max {max(ms):7.2f}ms per SG ({baseline / statistics.mean(ms):.1f}x the recursive query)"
+        )
+    return timings
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.set_session(autocommit=True)
+    benchmark(
+        conn.cursor(),
+        sys.argv[1] if len(sys.argv) > 1 else room_id,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+    )
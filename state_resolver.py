@@ -0,0 +1,43 @@
+from state_sets import StateBitmap, StateMap
+from symbols import state_set_array
+
+# Resolving the state as of an SG from the SG DAG and each SG's own state rows, as shared by calc_state.py
+# and calc_pipeline.py.
+#
+# We used to recursively re-merge get_state_dict(prev_id) | sg all the way up to the root for every SG, as
+# we couldn't memoise by deleting SGs once we were done with them (as calc_minhash does), given we process
+# SGs out of order. Instead, we walk up to the nearest ancestor in the state cache (see state_cache.py), and
+# derive each SG on the way back down from its prev. As maps and bitmaps share all the chunks their delta
+# doesn't touch, each step costs O(delta), as does caching the result.
+
+def resolve_state(sg_id, prev_edges, delta_of, cache):
+    """Resolves the state as of this SG, as a (StateMap, StateBitmap) pair. prev_edges[sg_id] lists each
+    SG's prevs, delta_of(sg_id) returns the SG's own state rows as { pair_id: event_id }, and cache is a
+    StateCache."""
+    chain = []
+    state = cache.get(sg_id)
+    while state is None:
+        chain.append(sg_id)
+        prevs = prev_edges.get(sg_id, [])
+        if len(prevs) != 1:
+            break
+        sg_id = prevs[0]
+        state = cache.get(sg_id)
+
+    for sg_id in reversed(chain):
+        delta = delta_of(sg_id)
+        if state is None:
+            # a root, or a merge of several prevs (which doesn't seem to happen for uncompressed SGs),
+            # so resolve it from scratch.
+            state_dict = {}
+            for prev_id in prev_edges.get(sg_id, []):
+                state_dict |= resolve_state(prev_id, prev_edges, delta_of, cache)[0].to_dict()
+            state_dict |= delta
+            state = (StateMap.from_dict(state_dict), StateBitmap.from_ids(state_set_array(state_dict)))
+        else:
+            (state_map, state_bitmap) = state
+            state = (state_map.with_delta(delta), state_bitmap.with_delta(state_map, delta))
+        # N.B. this only counts the chunks allocated for this SG; the rest belong to its ancestors
+        cache.put(sg_id, state, state[0].own_bytes + state[1].own_bytes + 8 * (len(state[0].chunks) + len(state[1].chunks)))
+
+    return state
@@ -0,0 +1,177 @@
+import numpy as np
+
+# State sets as chunked, copy-on-write bitmaps over interned event IDs (see symbols.py).
+#
+# Diffing two state sets as python sets (or sorted arrays) is O(|state|) per SG, even when only
+# one event changed. Instead, the ID space is cut into fixed-size chunks of bits, and each SG's
+# bitmap is derived from its prev SG's by copying just the chunks its delta touches; all the
+# other chunks are shared by reference. So two state sets which have a recent common ancestor
+# share most of their chunks, and diffing them skips every shared chunk without looking at it.
+#
+# It's roaring-ish, without the run/array containers: HQ has ~78K events, i.e. ~20 chunks.
+
+_chunk_bits = 4096
+_chunk_shift = 12
+_chunk_words = _chunk_bits // 64
+
+def _bits(chunk, base):
+    """The IDs of the set bits in a chunk, offset by base"""
+    return np.flatnonzero(np.unpackbits(chunk.view(np.uint8), bitorder='little')).astype(np.int32) + base
+
+def _popcount(chunk):
+    return int(np.unpackbits(chunk.view(np.uint8)).sum())
+
+class StateBitmap:
+    """An immutable set of interned event IDs. Chunks may be shared with other StateBitmaps,
+    so must never be modified in place once the bitmap has been built."""
+
+    def __init__(self, chunks=None, count=0, own_bytes=0):
+        self.chunks = chunks or [] # chunks[i] = uint64 array of the bits for IDs i * _chunk_bits onwards, or None if empty
+        self.count = count
+        self.own_bytes = own_bytes # the size of the chunks allocated for this bitmap, rather than shared with the one it came from
+
+    @classmethod
+    def from_ids(cls, ids):
+        return cls().with_changes(ids, ())
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        chunk = self.chunks[id >> _chunk_shift] if (id >> _chunk_shift) < len(self.chunks) else None
+        if chunk is None:
+            return False
+        id &= _chunk_bits - 1
+        return bool((int(chunk[id >> 6]) >> (id & 63)) & 1)
+
+    def with_changes(self, added, removed):
+        """Returns a new bitmap with the given IDs added and removed, sharing all untouched chunks with this one"""
+        added = np.asarray(added, dtype=np.int64)
+        removed = np.asarray(removed, dtype=np.int64)
+        chunks = list(self.chunks)
+        count = self.count
+        own_bytes = 0
+
+        touched = np.union1d(added >> _chunk_shift, removed >> _chunk_shift).tolist()
+        if touched and touched[-1] >= len(chunks):
+            chunks.extend([None] * (touched[-1] + 1 - len(chunks)))
+
+        for i in touched:
+            old = chunks[i]
+            chunk = np.zeros(_chunk_words, dtype=np.uint64) if old is None else old.copy()
+            ids = added[(added >> _chunk_shift) == i] & (_chunk_bits - 1)
+            np.bitwise_or.at(chunk, ids >> 6, np.left_shift(np.uint64(1), (ids & 63).astype(np.uint64)))
+            ids = removed[(removed >> _chunk_shift) == i] & (_chunk_bits - 1)
+            np.bitwise_and.at(chunk, ids >> 6, ~np.left_shift(np.uint64(1), (ids & 63).astype(np.uint64)))
+
+            count += _popcount(chunk) - (0 if old is None else _popcount(old))
+            if chunk.any():
+                chunks[i] = chunk
+                own_bytes += chunk.nbytes
+            else:
+                chunks[i] = None
+
+        return StateBitmap(chunks, count, own_bytes)
+
+    def with_delta(self, base_state, delta):
+        """Given that this is the bitmap of the state dict base_state ({ pair_id: event_id }), returns
+        the bitmap of base_state | delta, in time proportional to the size of the delta."""
+        added = []
+        removed = []
+        for (pair_id, event_id) in delta.items():
+            old_id = base_state.get(pair_id)
+            if old_id != event_id:
+                added.append(event_id)
+                if old_id is not None:
+                    removed.append(old_id)
+        return self.with_changes(added, removed)
+
+    def diff(self, new):
+        """Returns (added, removed) event IDs going from this bitmap to new, as sorted int32 arrays"""
+        added = []
+        removed = []
+        old_chunks = self.chunks
+        new_chunks = new.chunks
+        for i in range(max(len(old_chunks), len(new_chunks))):
+            old = old_chunks[i] if i < len(old_chunks) else None
+            chunk = new_chunks[i] if i < len(new_chunks) else None
+            if old is chunk:
+                # shared (or both empty), so nothing changed here
+                continue
+            base = i << _chunk_shift
+            if old is None:
+                added.append(_bits(chunk, base))
+            elif chunk is None:
+                removed.append(_bits(old, base))
+            else:
+                changed = old ^ chunk
+                if changed.any():
+                    added.append(_bits(changed & chunk, base))
+                    removed.append(_bits(changed & old, base))
+
+        empty = np.zeros(0, dtype=np.int32)
+        return (
+            np.concatenate(added) if added else empty,
+            np.concatenate(removed) if removed else empty,
+        )
+
+    def to_array(self):
+        """All the IDs in the set, as a sorted int32 array"""
+        return StateBitmap().diff(self)[0]
+
+# State dicts ({ pair_id: event_id }) as persistent chunked arrays in the same vein: a SG's map is
+# its prev's with just the chunks its delta touches copied, so resolving a child from its parent
+# costs O(delta) rather than the O(|state|) of prev_state | sg.
+
+_map_chunk_size = 1024
+
+class StateMap:
+    """An immutable mapping of interned pair IDs to interned event IDs, sharing chunks with the
+    maps it was derived from. Chunks must never be modified in place once the map has been built."""
+
+    def __init__(self, chunks=None, count=0, own_bytes=0):
+        self.chunks = chunks or [] # chunks[i] = int32 array of the event IDs for pair IDs i * _map_chunk_size onwards (-1 if absent), or None
+        self.count = count
+        self.own_bytes = own_bytes # the size of the chunks allocated for this map, rather than shared with the one it came from
+
+    @classmethod
+    def from_dict(cls, state_dict):
+        return cls().with_delta(state_dict)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, pair_id, default=None):
+        i = pair_id // _map_chunk_size
+        chunk = self.chunks[i] if i < len(self.chunks) else None
+        if chunk is None:
+            return default
+        event_id = int(chunk[pair_id % _map_chunk_size])
+        return default if event_id < 0 else event_id
+
+    def with_delta(self, delta):
+        """Returns a new map of self | delta, sharing all untouched chunks with this one"""
+        chunks = list(self.chunks)
+        count = self.count
+        copied = set()
+        for (pair_id, event_id) in delta.items():
+            i = pair_id // _map_chunk_size
+            if i >= len(chunks):
+                chunks.extend([None] * (i + 1 - len(chunks)))
+            if i not in copied:
+                chunk = chunks[i]
+                chunks[i] = np.full(_map_chunk_size, -1, dtype=np.int32) if chunk is None else chunk.copy()
+                copied.add(i)
+            chunk = chunks[i]
+            if chunk[pair_id % _map_chunk_size] < 0:
+                count += 1
+            chunk[pair_id % _map_chunk_size] = event_id
+        return StateMap(chunks, count, len(copied) * _map_chunk_size * 4)
+
+    def to_dict(self):
+        state_dict = {}
+        for (i, chunk) in enumerate(self.chunks):
+            if chunk is not None:
+                pair_ids = np.flatnonzero(chunk >= 0)
+                state_dict.update(zip((pair_ids + i * _map_chunk_size).tolist(), chunk[pair_ids].tolist()))
+        return state_dict
@@ -0,0 +1,42 @@
+import numpy as np
+
+# Symbol tables for interning the strings we shuffle around in bulk: event_ids, and (type, state_key)
+# pairs. HQ has ~78K distinct events but ~16.9M state rows, so rather than hashing and storing
+# millions of strings and tuples, we map each distinct value to a dense int32 ID as we load it,
+# work in ints throughout (so state sets can be sorted numpy int arrays), and only decode back to
+# strings when writing output.
+
+class SymbolTable:
+    """Maps hashable values to dense int IDs (0, 1, 2...) in order of first appearance, and back again"""
+
+    def __init__(self):
+        self.ids = {} # ids[value] = id
+        self.values = [] # values[id] = value
+
+    def intern(self, value):
+        id = self.ids.get(value)
+        if id is None:
+            id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return id
+
+    def lookup(self, id):
+        return self.values[id]
+
+    def lookup_many(self, ids):
+        values = self.values
+        return [ values[id] for id in ids ]
+
+    def __len__(self):
+        return len(self.values)
+
+def state_set_array(state_dict):
+    """Turn an interned state dict ({ pair_id: event_id }) into its state set, as a sorted numpy int32 array"""
+    # an event only ever has one (type, state_key), so the values are already unique
+    a = np.fromiter(state_dict.values(), dtype=np.int32, count=len(state_dict))
+    a.sort()
+    return a
+
+def diff_state_sets(old, new):
+    """Returns (added, removed) event IDs between two sorted state set arrays"""
+    return (np.setdiff1d(new, old, assume_unique=True), np.setdiff1d(old, new, assume_unique=True))
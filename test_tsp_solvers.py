@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+# Runs the solvers which start subprocesses in a fresh interpreter, as a hang there would otherwise hang
+# the test run. Usage: python -m pytest test_tsp_solvers.py
+
+_hybrid_script = """
+import time
+import numpy as np
+from tsp_solvers import hybrid_tour, local_search
+
+distances = np.random.default_rng(0).integers(0, 128, size=(60, 60))
+np.fill_diagonal(distances, 0)
+# as an earlier solve in the same process would, start up numba's parallel threads
+local_search(distances, np.arange(60), verbose=False)
+tour = hybrid_tour(distances, time.time() + 2)
+assert sorted(tour) == list(range(60)), tour
+print("ok")
+"""
+
+def test_hybrid_tour_exits():
+    # elkai's subprocess used to be forked, which left the parent hung at exit once local_search.py's
+    # numba parallel kernels had run
+    result = subprocess.run(
+        [sys.executable, "-c", _hybrid_script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith("ok")
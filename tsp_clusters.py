@@ -0,0 +1,117 @@
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from tsp_solvers import solve_tsp
+
+# Decomposing a big segment TSP into clusters which can be solved independently (and concurrently), as
+# per the README's TODO of deliberately creating islands to speed up the TSP solver. elkai's runtime is
+# superlinear in the number of nodes, so lots of small solves are much quicker than one big one.
+#
+#  * band_clusters() puts segments in the same cluster if one's end shares an LSH band with another's
+#    start, i.e. the connected components of the graph of edges shorter than the fallback distances.
+#    Components which are too big get split up chronologically (i.e. by segment index), and runs of small
+#    ones get packed together chronologically, so we don't end up with thousands of singletons.
+#  * solve_clusters() solves each cluster's TSP in its own process, and cuts each tour into a path at its
+#    most expensive edge. The processes come from a forkserver (as forking after numba's parallel kernels
+#    have run leaves the parent hung at exit), and share the cores out between their numba threads. Its time budget covers all the clusters: with P processes they get solved in
+#    ceil(clusters / P) rounds, so each cluster gets time_budget / rounds.
+#  * The caller then solves a meta-TSP over the paths (from each path's last segment to the next one's first)
+#    to stitch them back together, so it should hold back some of its time budget for that.
+
+logger = logging.getLogger()
+
+def band_clusters(end_bands, start_bands, max_cluster_size=500, min_cluster_size=32):
+    """Returns clusters of segment indices (each sorted, and ordered by their first segment), linking
+    segments where the end of one shares an LSH band (in the same position) with the start of another"""
+    end_bands = np.asarray(end_bands, dtype=np.int64)
+    start_bands = np.asarray(start_bands, dtype=np.int64)
+    n = len(end_bands)
+    if n == 0:
+        return []
+
+    # for each band, link consecutive entries of each bucket which has both ends and starts in it
+    rows = []
+    cols = []
+    nodes = np.concatenate([np.arange(n), np.arange(n)])
+    is_end = np.concatenate([np.ones(n, dtype=bool), np.zeros(n, dtype=bool)])
+    for c in range(end_bands.shape[1]):
+        values = np.concatenate([end_bands[:, c], start_bands[:, c]])
+        order = np.argsort(values, kind='stable')
+        sorted_values = values[order]
+        bucket = np.concatenate([[0], np.cumsum(sorted_values[1:] != sorted_values[:-1])])
+        has_end = np.bincount(bucket, weights=is_end[order]) > 0
+        has_start = np.bincount(bucket, weights=~is_end[order]) > 0
+        same = np.flatnonzero((sorted_values[1:] == sorted_values[:-1]) & (has_end & has_start)[bucket[1:]])
+        rows.append(nodes[order[same]])
+        cols.append(nodes[order[same + 1]])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n, n))
+    (count, labels) = connected_components(graph, directed=False)
+    logger.info(f"{count} LSH components for {n} segments")
+
+    # components as sorted arrays of segment indices, in order of their first segment
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    components = sorted(np.split(order, bounds), key=lambda c: c[0])
+
+    clusters = []
+    small = []
+    for component in components:
+        if len(component) < min_cluster_size:
+            if len(small) + len(component) > max_cluster_size:
+                clusters.append(np.sort(small))
+                small = []
+            small.extend(component)
+            if len(small) >= min_cluster_size:
+                clusters.append(np.sort(small))
+                small = []
+            continue
+        for i in range(0, len(component), max_cluster_size):
+            clusters.append(component[i:i + max_cluster_size])
+    if small:
+        clusters.append(np.sort(small))
+    clusters.sort(key=lambda c: c[0])
+
+    logger.info(f"{len(clusters)} clusters of up to {max(len(c) for c in clusters)} segments")
+    return clusters
+
+def best_path(distances, tour):
+    """Cut a tour into a path, by dropping its most expensive edge"""
+    tour = np.asarray(tour)
+    if len(tour) < 2:
+        return tour.tolist()
+    costs = distances[tour, np.roll(tour, -1)]
+    return np.roll(tour, -(int(np.argmax(costs)) + 1)).tolist()
+
+def _init_worker(threads):
+    from numba import set_num_threads
+    set_num_threads(threads)
+
+def _solve_cluster(distances, solver, time_budget):
+    tour = solve_tsp(distances, solver, time_budget)
+    return best_path(distances, tour)
+
+def solve_clusters(cluster_distances, solver='elkai', time_budget=None, processes=None):
+    """Solve the TSP for each of the given distance matrices in a pool of processes, returning a path
+    through each. time_budget is for solving all of them, rather than each. The caller's main module
+    has to be safe to import, as the workers are started from a forkserver."""
+    cpus = os.cpu_count() or 1
+    processes = processes or cpus
+    if time_budget is not None and cluster_distances:
+        rounds = math.ceil(len(cluster_distances) / processes)
+        time_budget = max(0, time_budget) / rounds
+        logger.info(f"solving {len(cluster_distances)} clusters in {rounds} rounds of {time_budget:.1f}s")
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['tsp_clusters'])
+    # N.B. numba uses every core by default, so share them out rather than oversubscribing them processes times over
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=ctx, initializer=_init_worker, initargs=(max(1, cpus // processes),),
+    ) as executor:
+        futures = [ executor.submit(_solve_cluster, d, solver, time_budget) for d in cluster_distances ]
+        return [ f.result() for f in futures ]
@@ -0,0 +1,175 @@
+import logging
+import multiprocessing
+import queue
+import time
+import numpy as np
+from numba import njit
+from scipy.optimize import linear_sum_assignment
+from local_search import local_search
+
+# Pluggable (asymmetric) TSP solvers for ordering segments, with a wall-clock budget.
+#
+# elkai gives the best tours, but took 4.5h for HQ's 2,400 segments, whereas ACO (aco.py) is quicker
+# but ~5x worse, and a greedy tour plus local search is quicker still. So order_segs picks one of:
+#
+#  * 'elkai':  LKH via elkai, run in a subprocess so it can be killed when the budget runs out.
+#  * 'aco':    aco.py's FastAntColonyTSP, stopping when the budget runs out, then polished by local search.
+#  * 'aco_islands': several ACO colonies in separate processes, sharing their best tours (aco_islands.py).
+#  * 'greedy': nearest-neighbour tour improved by local search (local_search.py: parallel Or-opt and
+#              reversal-free 3-opt) until convergence or the budget runs out.
+#  * 'chronological': the segments in their original order, improved by local search.
+#  * 'hybrid': 'greedy' first, so we always have a decent tour, then elkai with whatever budget is left.
+#
+# When the budget runs out, we return the best tour found so far. We also log the tour's length against the
+# assignment problem lower bound, so we know how much compression we're trading away for runtime.
+#
+# N.B. the elkai subprocess is started from a forkserver rather than forked: once local_search.py's
+# numba parallel kernels have run (as they have by the time 'hybrid' gets to elkai), TBB's worker threads
+# stop a forked parent from ever exiting. So the caller's main module has to be safe to import.
+#
+# Tours are lists of node indices, as returned by elkai, and their lengths include the edge back to the start.
+
+logger = logging.getLogger()
+
+def tour_length(distances, tour):
+    tour = np.asarray(tour)
+    return int(distances[tour, np.roll(tour, -1)].sum())
+
+def assignment_lower_bound(distances):
+    """Lower bound on the length of any tour: the cheapest way for every node to have one successor and
+    one predecessor, without requiring that to be a single cycle"""
+    costs = np.array(distances, dtype=np.float64)
+    np.fill_diagonal(costs, costs.max() * len(costs) + 1) # no self-loops
+    (rows, cols) = linear_sum_assignment(costs)
+    return int(costs[rows, cols].sum())
+
+@njit(nogil=True)
+def greedy_tour(distances, start=0):
+    """Nearest-neighbour tour, starting at start"""
+    n = len(distances)
+    tour = np.empty(n, dtype=np.int32)
+    visited = np.zeros(n, dtype=np.bool_)
+    tour[0] = start
+    visited[start] = True
+    for step in range(1, n):
+        current = tour[step - 1]
+        best = -1
+        for city in range(n):
+            if not visited[city] and (best == -1 or distances[current, city] < distances[current, best]):
+                best = city
+        tour[step] = best
+        visited[best] = True
+    return tour
+
+def chronological_tour(distances, deadline=None):
+    """The segments in their original order, improved by local search"""
+    return local_search(distances, np.arange(len(distances)), deadline).tolist()
+
+def greedy_local_search_tour(distances, deadline=None):
+    tour = greedy_tour(distances)
+    logger.info(f"greedy tour length {tour_length(distances, tour)}")
+    return local_search(distances, tour, deadline).tolist()
+
+def _elkai_worker(distances, results):
+    import elkai
+    results.put(elkai.solve_int_matrix(distances))
+
+def elkai_tour(distances, deadline=None):
+    """Solve with elkai, or return None if it didn't finish by the deadline"""
+    if deadline is None:
+        import elkai
+        return list(elkai.solve_int_matrix(distances))
+
+    # elkai can't be interrupted, so we run it in a subprocess we can kill
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['tsp_solvers'])
+    results = ctx.Queue()
+    process = ctx.Process(target=_elkai_worker, args=(distances, results), daemon=True)
+    process.start()
+    try:
+        return list(results.get(timeout=max(0, deadline - time.time())))
+    except queue.Empty:
+        logger.warning("elkai ran out of time")
+        return None
+    finally:
+        process.terminate()
+        process.join()
+
+aco_local_search = True # polish ACO's tour with local search
+# run ACO as a MAX-MIN Ant System, with local search on each iteration's best tour (see aco.py)
+aco_options = dict(mmas=True, local_search_time=1.0)
+
+def aco_tour(distances, deadline=None):
+    from aco import FastAntColonyTSP
+    aco = FastAntColonyTSP(
+        distance_matrix=np.asarray(distances),
+        n_ants=100, # apparently 100 ants should be enough, despite the number of cities
+        n_iterations=100,
+        alpha=1.0,
+        beta=2.0,
+        evaporation_rate=0.3,
+        q=100,
+        symmetric=False,
+        **aco_options,
+    )
+    (path, _) = aco.solve(verbose=True, deadline=deadline)
+    if aco_local_search and (deadline is None or time.time() < deadline):
+        logger.info(f"aco tour length {tour_length(distances, path)}")
+        path = local_search(distances, path, deadline).tolist()
+    return path
+
+def aco_islands_tour(distances, deadline=None):
+    from aco_islands import solve_islands
+    ((path, _), _) = solve_islands(
+        np.asarray(distances),
+        n_ants=100,
+        n_iterations=100,
+        alpha=1.0,
+        beta=2.0,
+        evaporation_rate=0.3,
+        q=100,
+        symmetric=False,
+        deadline=deadline,
+        **aco_options,
+    )
+    if aco_local_search and (deadline is None or time.time() < deadline):
+        path = local_search(distances, path, deadline).tolist()
+    return path
+
+def hybrid_tour(distances, deadline=None):
+    best = greedy_local_search_tour(distances, deadline)
+    if deadline is None or time.time() < deadline:
+        tour = elkai_tour(distances, deadline)
+        if tour is not None and tour_length(distances, tour) < tour_length(distances, best):
+            best = tour
+    return best
+
+solvers = {
+    'elkai': elkai_tour,
+    'aco': aco_tour,
+    'aco_islands': aco_islands_tour,
+    'greedy': greedy_local_search_tour,
+    'chronological': chronological_tour,
+    'hybrid': hybrid_tour,
+}
+
+def solve_tsp(distances, solver='elkai', time_budget=None):
+    """Returns a tour through the given (N, N) distance matrix using the named solver, taking no more than
+    about time_budget seconds (if given)"""
+    n = len(distances)
+    if n < 3:
+        return list(range(n))
+
+    start = time.time()
+    deadline = None if time_budget is None else start + time_budget
+    tour = solvers[solver](distances, deadline)
+    if tour is None:
+        # only elkai can fail to come up with anything in time
+        logger.warning("no tour found in time; falling back to a greedy tour")
+        tour = greedy_tour(np.asarray(distances)).tolist()
+
+    length = tour_length(distances, tour)
+    bound = assignment_lower_bound(distances)
+    gap = (length - bound) / bound * 100 if bound else 0
+    logger.info(f"{solver} tour of {n} nodes: length {length}, lower bound {bound} ({gap:.1f}% over), took {time.time() - start:.1f}s")
+    return tour